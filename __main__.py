@@ -2,34 +2,20 @@
 import argparse
 import asyncio
 import logging
+import sys
 
-import binder_bot
+import bots
 import config
-import db
-import emote_bot
-import face_replace_bot
-import frog_bot
-import haiku_bot
-import jeff_bot
-import markov_bot
-import money_bot
-from mongoengine import connect
+from cpu_pool import cpu_pool
+import index_check
 # from league.league_api import LeagueApi
 # from league.monitor import LeagueMonitor
-import qanta_bot
-import quote_bot
-import react_bot
 import reddit.monitor
-import sentiment_bot
-# import stock_bot
-import twitch_bot
-import wordcloud_bot
-import casino_bot
-import poll_bot
 from util import handle_async_exception
 
+from slack import history
+from slack.shard import ShardedSlack, WorkerSlack
 from slack.slack_api import Slack, SlackConfig
-import tensorflow as tf
 
 
 logging.basicConfig(level=logging.INFO)
@@ -40,8 +26,33 @@ def main():
     """Instantiate all bots and launch Slack"""
 
     parser = argparse.ArgumentParser(description='A simple slack bot')
-    parser.add_argument('--load_history', action='store_true')
+    parser.add_argument('--load_history', action='store_true',
+                        help='Wipe the stored history and reload it from Slack')
+    parser.add_argument('--sync_history', action='store_true',
+                        help='On each connect, load messages newer than the last sync from Slack')
     parser.add_argument('--clear_commands', action='store_true')
+    parser.add_argument('--event_workers', type=int, default=8,
+                        help='Number of events which may be handled at once')
+    parser.add_argument('--max_queued_events', type=int, default=1000,
+                        help='Number of unhandled events to buffer before pausing the websocket reader')
+    parser.add_argument('--lazy', action='store_true',
+                        help='Load models, corpora and API clients when each bot is first used instead of at startup')
+    parser.add_argument('--cpu_workers', type=int,
+                        help='Number of processes for CPU heavy commands like wordclouds. Defaults to the CPU count')
+    parser.add_argument('--record_events', metavar='PATH',
+                        help='Record every websocket event to a compressed log for scripts/load_harness.py')
+    parser.add_argument('--history_cache_mb', type=int, default=64,
+                        help='Message text to keep in memory for history commands. 0 disables the cache')
+    parser.add_argument('--history_schema', type=int, choices=[1, 2], default=1,
+                        help='Write new messages as HistoryDoc (1) or the compact HistoryDocV2 (2). '
+                             'See scripts/migrate_history_v2.py')
+    parser.add_argument('--compress_history_bytes', type=int,
+                        help='With --history_schema 2, compress message texts of at least this many bytes')
+    parser.add_argument('--shards', type=int,
+                        help='Run the bots in this many worker processes behind one Slack connection')
+    # Used by the main process to start workers when --shards is given
+    parser.add_argument('--worker_socket', help=argparse.SUPPRESS)
+    parser.add_argument('--worker_bots', help=argparse.SUPPRESS)
     args = parser.parse_args()
 
     slack_config = SlackConfig(
@@ -50,65 +61,58 @@ def main():
         alert=config.ALERT,
         name=config.NAME,
         load_history=args.load_history,
+        sync_history=args.sync_history,
         clear_commands=args.clear_commands,
-        admins=config.ADMINS)
+        admins=config.ADMINS,
+        event_workers=args.event_workers,
+        max_queued_events=args.max_queued_events,
+        record_events=args.record_events,
+        history_cache_bytes=args.history_cache_mb * 2 ** 20)
 
-    slackapp = Slack(slack_config)
+    cpu_pool.configure(args.cpu_workers)
+    history.set_schema(args.history_schema, args.compress_history_bytes)
+    loop = asyncio.get_event_loop()
 
-    emote_bot.EmoteBot(channels=config.EMOJI_CHANNELS, slack=slackapp)
-    binder_bot.BinderBot(admins=config.ADMINS, max_len=config.MAX_BIND_LEN, slack=slackapp)
-    frog_bot.FrogBot(config.FROG_CHANNELS, slack=slackapp)
-    react_bot.ReactBot(
-        admins=config.ADMINS,
-        out_channels=config.REACTION_CHANNELS,
-        max_per_user=config.MAX_REACTS_PER_CHANNEL,
-        slack=slackapp)
-    quote_bot.QuoteBot(slack=slackapp)
-    wordcloud_bot.WordcloudBot(slack=slackapp)
-    jeff_bot.JeffBot(
-        probability=config.JEFF_BOT_PROBABILITY,
-        emojis=config.JEFF_BOT_EMOJIS,
-        target=config.JEFF_BOT_TARGET,
-        dead_user=config.JEFF_DEAD_USER,
-        death_date=config.JEFF_DEATH_DATE,
-        channels=config.JEFF_CHANNELS,
-        slack=slackapp)
-
-    markov_bot.MarkovBot(slack=slackapp)
-    money_bot.MoneyBot(config.MONEY_CHANNELS, config.MONEY_NAME, slack=slackapp)
-
-    q_bot = qanta_bot.QantaBot(slack=slackapp)
-
-    # s_bot = stock_bot.StockBot(
-    #     stock_users=config.STOCK_USERS,
-    #     currency_name=config.MONEY_NAME,
-    #     timezone=config.TIMEZONE,
-    #     index_name=config.INDEX_NAME,
-    #     slack=slackapp)
-    # loop = asyncio.get_event_loop()
-    # loop.create_task(handle_async_exception(s_bot.dividend_loop))
-
-    twitch_alias = 'twitch_db'
-    connect(config.TWITCH_DB_NAME, alias=twitch_alias)
-
-    twitch_bot.TwitchBot(twitch_alias, min_length=config.MIN_MARKOV_LENGTH, slack=slackapp)
-
-    haiku_bot.HaikuBot(slack=slackapp)
-    face_replace_bot.FaceReplaceBot(slack=slackapp)
-    casino_bot.CasinoBot(config.MONEY_NAME, slack=slackapp)
-    poll_bot.PollBot(slack=slackapp)
+    if args.worker_socket:
+        run_worker(loop, slack_config, args)
+        return
 
     # League stuff
     # league_api = LeagueApi(config.LEAGUE_KEY)
     # league_monitor = LeagueMonitor(league_api, monitor_names=list(config.STOCK_USERS.values()))
 
-    with tf.Graph().as_default(), tf.Session() as session:
-        sentiment_bot.SentimentBot(session=session, slack=slackapp)
-        loop = asyncio.get_event_loop()
-        # loop.create_task(handle_async_exception(league_monitor.run))
-        loop.create_task(handle_async_exception(reddit.monitor.run))
-        logger.info('Launching slack app')
+    if args.shards:
+        slackapp = ShardedSlack(slack_config)
+        worker_argv = [sys.argv[0]] + (['--lazy'] if args.lazy else [])
+        if args.cpu_workers:
+            worker_argv += ['--cpu_workers', str(args.cpu_workers)]
+        worker_argv += ['--history_schema', str(args.history_schema)]
+        if args.compress_history_bytes:
+            worker_argv += ['--compress_history_bytes', str(args.compress_history_bytes)]
+        loop.run_until_complete(slackapp.start_workers(bots.shard_groups(args.shards), worker_argv))
+    else:
+        slackapp = Slack(slack_config)
+        bots.add_bots(slackapp, lazy=args.lazy)
+    # loop.create_task(handle_async_exception(league_monitor.run))
+    loop.create_task(handle_async_exception(reddit.monitor.run))
+    loop.create_task(index_check.check_query_plans())
+    logger.info('Launching slack app')
+    try:
         loop.run_until_complete(slackapp.run())
+    finally:
+        loop.run_until_complete(slackapp.shutdown())
+        cpu_pool.shutdown()
+
+
+def run_worker(loop, slack_config, args):
+    """Run some of the bots in a worker process for a --shards main process"""
+    slackapp = WorkerSlack(slack_config)
+    bots.add_bots(slackapp, lazy=args.lazy, specs=bots.specs_named(args.worker_bots.split(',')))
+    try:
+        loop.run_until_complete(slackapp.run_worker(args.worker_socket))
+    finally:
+        loop.run_until_complete(slackapp.shutdown())
+        cpu_pool.shutdown()
 
 
 if __name__ == '__main__':
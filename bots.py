@@ -0,0 +1,126 @@
+"""Assembles the full set of bots which the Slack app runs"""
+import importlib
+import logging
+import time
+
+import config
+from mongoengine import connect
+from util import lazy_attributes
+
+logger = logging.getLogger(__name__)
+
+
+def _twitch_bot(module, slack):
+    twitch_alias = 'twitch_db'
+    connect(config.TWITCH_DB_NAME, alias=twitch_alias)
+    return module.TwitchBot(twitch_alias, min_length=config.MIN_MARKOV_LENGTH, slack=slack)
+
+
+# (module name, function of (module, slack) which creates the bot)
+BOT_SPECS = [
+    ('emote_bot', lambda m, slack: m.EmoteBot(channels=config.EMOJI_CHANNELS, slack=slack)),
+    ('binder_bot', lambda m, slack: m.BinderBot(admins=config.ADMINS, max_len=config.MAX_BIND_LEN, slack=slack)),
+    ('frog_bot', lambda m, slack: m.FrogBot(config.FROG_CHANNELS, slack=slack)),
+    ('react_bot', lambda m, slack: m.ReactBot(
+        admins=config.ADMINS,
+        out_channels=config.REACTION_CHANNELS,
+        max_per_user=config.MAX_REACTS_PER_CHANNEL,
+        slack=slack)),
+    ('quote_bot', lambda m, slack: m.QuoteBot(slack=slack)),
+    ('search_bot', lambda m, slack: m.SearchBot(slack=slack)),
+    ('wordcloud_bot', lambda m, slack: m.WordcloudBot(slack=slack)),
+    ('jeff_bot', lambda m, slack: m.JeffBot(
+        probability=config.JEFF_BOT_PROBABILITY,
+        emojis=config.JEFF_BOT_EMOJIS,
+        target=config.JEFF_BOT_TARGET,
+        dead_user=config.JEFF_DEAD_USER,
+        death_date=config.JEFF_DEATH_DATE,
+        channels=config.JEFF_CHANNELS,
+        slack=slack)),
+    ('markov_bot', lambda m, slack: m.MarkovBot(
+        slack=slack, snapshot_path=slack.config.markov_snapshot or m.SNAPSHOT_PATH)),
+    ('money_bot', lambda m, slack: m.MoneyBot(config.MONEY_CHANNELS, config.MONEY_NAME, slack=slack)),
+    ('qanta_bot', lambda m, slack: m.QantaBot(slack=slack)),
+    # ('stock_bot', lambda m, slack: m.StockBot(
+    #     stock_users=config.STOCK_USERS,
+    #     currency_name=config.MONEY_NAME,
+    #     timezone=config.TIMEZONE,
+    #     index_name=config.INDEX_NAME,
+    #     slack=slack)),
+    ('twitch_bot', _twitch_bot),
+    ('haiku_bot', lambda m, slack: m.HaikuBot(slack=slack)),
+    ('face_replace_bot', lambda m, slack: m.FaceReplaceBot(slack=slack)),
+    ('casino_bot', lambda m, slack: m.CasinoBot(config.MONEY_NAME, slack=slack)),
+    ('poll_bot', lambda m, slack: m.PollBot(slack=slack)),
+    ('stats_bot', lambda m, slack: m.StatsBot(slack=slack)),
+    ('sentiment_bot', lambda m, slack: m.SentimentBot(slack=slack)),
+]
+
+# Bots which share in-memory state through a module level singleton, so must run in the same process
+SHARED_STATE_GROUPS = [
+    {'money_bot', 'casino_bot', 'jeff_bot', 'stock_bot'},
+]
+
+
+def add_bots(slackapp, lazy=False, specs=BOT_SPECS):
+    """
+    Instantiate bots, registering each one with slackapp, and log how long each one took to start.
+    Args:
+        slackapp: The Slack instance
+        lazy: If True, models, corpora and clients are loaded when first used instead of now
+        specs: Which bots to create, as (module name, factory) pairs
+    Returns:
+        The bots
+    """
+    created = []
+    timings = []
+    for module_name, make_bot in specs:
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        imported = time.perf_counter()
+        bot = make_bot(module, slackapp)
+        built = time.perf_counter()
+        resources = lazy_attributes(bot)
+        if not lazy:
+            for resource in resources:
+                resource.get()
+        loaded = time.perf_counter()
+
+        created.append(bot)
+        timings.append((type(bot).__name__, imported - start, built - imported, loaded - built,
+                        ', '.join(resource.name for resource in resources)))
+
+    logger.info('Bot startup times (seconds)%s:', ' with lazy loading' if lazy else '')
+    logger.info('%-18s %7s %7s %7s  %s', 'bot', 'import', 'init', 'load', 'deferred resources')
+    for name, import_time, init_time, load_time, resource_names in timings:
+        logger.info('%-18s %7.2f %7.2f %7.2f  %s', name, import_time, init_time, load_time, resource_names)
+    logger.info('Total: %.2f', sum(sum(timing[1:4]) for timing in timings))
+    return created
+
+
+def specs_named(module_names, specs=BOT_SPECS):
+    """The specs for the given bot module names, in their usual order"""
+    module_names = set(module_names)
+    return [spec for spec in specs if spec[0] in module_names]
+
+
+def shard_groups(n_shards, specs=BOT_SPECS):
+    """
+    Split bots into at most n_shards lists of module names to run in separate processes.
+    Bots in the same SHARED_STATE_GROUPS entry always end up together.
+    """
+    units = []
+    placed = set()
+    for module_name, _ in specs:
+        if module_name in placed:
+            continue
+        group = next((g for g in SHARED_STATE_GROUPS if module_name in g), {module_name})
+        unit = [name for name, _ in specs if name in group]
+        placed.update(unit)
+        units.append(unit)
+
+    # Largest units first, each onto the currently smallest shard
+    shards = [[] for _ in range(min(n_shards, len(units)))]
+    for unit in sorted(units, key=len, reverse=True):
+        min(shards, key=len).extend(unit)
+    return shards
@@ -1,3 +1,4 @@
+import asyncio
 from asyncio import Lock
 from collections import defaultdict
 
@@ -22,18 +23,45 @@ def _get_or_create_game(game):
         return obj
 
 
+def _load_standings():
+    games = defaultdict(lambda: defaultdict(float))
+    jackpot = defaultdict(float)
+    for score in ScoreboardDoc.objects():
+        games[score.game][score.user] = score.won + score.lost
+    for game in CasinoGameDoc.objects():
+        jackpot[game.game] = game.jackpot
+    return games, jackpot
+
+
 class _Casino:
     def __init__(self):
         self._lock = Lock()
+        self._loading = None
 
         self._games = defaultdict(lambda: defaultdict(float))
         self._jackpot = defaultdict(float)
-        for score in ScoreboardDoc.objects():
-            self._games[score.game][score.user] = score.won + score.lost
-        for game in CasinoGameDoc.objects():
-            self._jackpot[game.game] = game.jackpot
+
+    async def warm_up(self):
+        """
+        Load scores and jackpots in the background. Every other method waits for this to finish,
+        so it only needs to be called directly to start loading early.
+        """
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._load())
+            self._loading.add_done_callback(self._load_done)
+        await asyncio.shield(self._loading)
+
+    def _load_done(self, future):
+        # Forget a failed load so that the next call retries it
+        if future.cancelled() or future.exception() is not None:
+            self._loading = None
+
+    async def _load(self):
+        loop = asyncio.get_event_loop()
+        self._games, self._jackpot = await loop.run_in_executor(None, _load_standings)
 
     async def record(self, user, game, amount):
+        await self.warm_up()
         with await self._lock:
             obj = _get_or_create_scoreboard_user(user, game)
             if amount > 0:
@@ -43,16 +71,19 @@ class _Casino:
             self._games[game][user] += amount
 
     async def standing(self, user, game):
+        await self.warm_up()
         with await self._lock:
             return self._slots[game][user]
 
     async def update_jackpot(self, game, amount):
+        await self.warm_up()
         with await self._lock:
             obj = _get_or_create_game(game)
             obj.update(jackpot=obj.jackpot + amount)
             self._jackpot[game] += amount
 
     async def get_jackpot(self, game):
+        await self.warm_up()
         with await self._lock:
             return self._jackpot[game]
 
@@ -61,6 +92,7 @@ class _Casino:
         obj.save()
 
     async def get_stats(self, user, game):
+        await self.warm_up()
         with await self._lock:
             obj = _get_or_create_scoreboard_user(user, game)
             jackpots = BigWinsHistoryDoc.objects(game=game, user=user)
@@ -1,3 +1,4 @@
+import asyncio
 from slack.bot import register, SlackBot
 from pyparsing import CaselessLiteral, StringEnd
 from slack.parsing import symbols
@@ -28,6 +29,9 @@ class CasinoBot(SlackBot):
         self.stats_expr = CaselessLiteral('casino') + CaselessLiteral('stats') + StringEnd()
         self.stats_doc = ('Information on your filthy gambling habits.\n\tcasino stats')
 
+    async def warm_up(self, slack):
+        await asyncio.gather(economy.warm_up(), casino.warm_up())
+
     @register(name='slots_name', expr='slots_expr', doc='slots_doc')
     async def command_slots(self, user, in_channel, parsed):
         return await self.slots(user, in_channel, parsed)
@@ -0,0 +1,122 @@
+"""Shared process pool for CPU bound work which would otherwise stall the event loop"""
+import asyncio
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import time
+
+from slack.stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+def _timed_call(func, args):
+    """Runs in a worker process. Returns func's result along with when it started and finished."""
+    start = time.time()
+    result = func(*args)
+    return result, start, time.time()
+
+
+class CpuPool:
+
+    """
+    Runs jobs in worker processes. Jobs are plain functions and arguments, so both must be picklable,
+    which means functions must be defined at module level.
+    Queue wait and execution time are recorded for each job type.
+    """
+
+    def __init__(self, max_workers=None, latency_samples=1000):
+        """
+        Args:
+            max_workers: Number of worker processes. Defaults to the number of CPUs.
+            latency_samples: Number of recent timings kept per job type
+        """
+        self._max_workers = max_workers
+        self._latency_samples = latency_samples
+        self._executor = None
+        self._waits = defaultdict(lambda: LatencyHistogram(self._latency_samples))
+        self._runs = defaultdict(lambda: LatencyHistogram(self._latency_samples))
+        self._counts = defaultdict(Counter)
+        self._pending = 0
+
+    def configure(self, max_workers):
+        """Set the number of worker processes. Only takes effect if the pool hasn't started yet."""
+        if self._executor is not None:
+            logger.warning('Process pool already started with %s workers', self._max_workers)
+        self._max_workers = max_workers
+
+    @property
+    def depth(self):
+        """Number of jobs submitted but not finished"""
+        return self._pending
+
+    def submit(self, job_type, func, *args):
+        """
+        Queue a job and return an asyncio future for its result.
+        Cancelling the future drops the job if it hasn't started. A job which is already running is
+        left to finish and its result is discarded.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._max_workers)
+        submitted = time.time()
+        self._pending += 1
+        inner = self._executor.submit(_timed_call, func, args)
+        loop = asyncio.get_event_loop()
+        outer = loop.create_future()
+
+        def job_done(inner):
+            loop.call_soon_threadsafe(self._finish, job_type, submitted, inner, outer)
+
+        def outer_done(outer):
+            if outer.cancelled() and not inner.cancel():
+                logger.info('%s job cancelled while running, its result will be discarded', job_type)
+
+        inner.add_done_callback(job_done)
+        outer.add_done_callback(outer_done)
+        return outer
+
+    async def run(self, job_type, func, *args):
+        """Run a job and return its result"""
+        return await self.submit(job_type, func, *args)
+
+    def _finish(self, job_type, submitted, inner, outer):
+        self._pending -= 1
+        counts = self._counts[job_type]
+        if inner.cancelled():
+            counts['cancelled'] += 1
+            return
+        error = inner.exception()
+        if error is not None:
+            counts['failed'] += 1
+            if not outer.done():
+                outer.set_exception(error)
+            return
+        result, start, end = inner.result()
+        counts['done'] += 1
+        self._waits[job_type].add(start - submitted)
+        self._runs[job_type].add(end - start)
+        if not outer.done():
+            outer.set_result(result)
+
+    def report(self, qs=(50, 95, 99)):
+        """Lines of text with job counts, and queue wait and execution time percentiles (in ms) per job type"""
+        header = ' '.join('p{}'.format(q).rjust(8) for q in qs)
+        lines = ['{:<40} {:>6} {:>6} {:>6} {}'.format('job/time', 'done', 'failed', 'cancel', header)]
+        for job_type in sorted(self._counts):
+            counts = self._counts[job_type]
+            for label, histogram in (('wait', self._waits[job_type]), ('run', self._runs[job_type])):
+                values = ' '.join('{:8.1f}'.format(1000 * v) for v in histogram.percentiles(qs))
+                lines.append('{:<40} {:>6} {:>6} {:>6} {}'.format(
+                    '{}/{}'.format(job_type, label)[:40], counts['done'], counts['failed'], counts['cancelled'],
+                    values))
+        lines.append('Queued jobs: {}'.format(self.depth))
+        return lines
+
+    def shutdown(self):
+        """Stop the worker processes, dropping any queued jobs"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+cpu_pool = CpuPool()
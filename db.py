@@ -1,4 +1,5 @@
 import config
 from mongoengine import connect
 
-connect(config.DB_NAME)
+# Don't block on connecting until the first query
+connect(config.DB_NAME, connect=False)
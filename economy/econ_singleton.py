@@ -1,3 +1,4 @@
+import asyncio
 from asyncio import Lock
 from collections import defaultdict
 
@@ -14,17 +15,44 @@ def _get_or_create_user(user):
         return obj
 
 
+def _load_ledgers():
+    ledger = defaultdict(float)
+    secondary_ledger = defaultdict(float)
+    for account in AccountDoc.objects():
+        ledger[account.user] = account.currency
+        secondary_ledger[account.user] = account.secondary_currency
+    return ledger, secondary_ledger
+
+
 class _Economy:
     def __init__(self):
         self._lock = Lock()
+        self._loading = None
 
         self._ledger = defaultdict(float)
         self._secondary_ledger = defaultdict(float)
-        for account in AccountDoc.objects():
-            self._ledger[account.user] = account.currency
-            self._secondary_ledger[account.user] = account.secondary_currency
+
+    async def warm_up(self):
+        """
+        Load all accounts in the background. Every other method waits for this to finish,
+        so it only needs to be called directly to start loading early.
+        """
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._load())
+            self._loading.add_done_callback(self._load_done)
+        await asyncio.shield(self._loading)
+
+    def _load_done(self, future):
+        # Forget a failed load so that the next call retries it
+        if future.cancelled() or future.exception() is not None:
+            self._loading = None
+
+    async def _load(self):
+        loop = asyncio.get_event_loop()
+        self._ledger, self._secondary_ledger = await loop.run_in_executor(None, _load_ledgers)
 
     async def give(self, user, amount, secondary=False):
+        await self.warm_up()
         with await self._lock:
             obj = _get_or_create_user(user)
             currency_attr = 'secondary_currency' if secondary else 'currency'
@@ -32,21 +60,25 @@ class _Economy:
             (self._secondary_ledger if secondary else self._ledger)[user] += amount
 
     async def set(self, user, amount, secondary=False):
+        await self.warm_up()
         with await self._lock:
             obj = _get_or_create_user(user)
             obj.update(**{'secondary_currency' if secondary else 'currency': amount})
             (self._secondary_ledger if secondary else self._ledger)[user] = amount
 
     async def user_currency(self, user, secondary=False):
+        await self.warm_up()
         with await self._lock:
             return (self._secondary_ledger if secondary else self._ledger)[user]
 
     async def level(self, user):
+        await self.warm_up()
         with await self._lock:
             obj = _get_or_create_user(user)
             return obj.level
 
     async def level_up(self, user):
+        await self.warm_up()
         with await self._lock:
             obj = _get_or_create_user(user)
             obj.update(level=obj.level + 1)
@@ -1,10 +1,10 @@
+from cpu_pool import cpu_pool
 from pyparsing import CaselessLiteral, StringEnd, Optional, Word, alphanums
 from slack.bot import SlackBot, register
 from slack.command import MessageCommand, UploadCommand
 from slack.parsing import symbols
-from util import get_image
+from util import get_image, Lazy
 import tempfile
-from googleapiclient import discovery, errors
 import json
 import base64
 from PIL import Image
@@ -50,6 +50,8 @@ class FaceReplaceBot(SlackBot):
         self.FACE_DIR = 'faces/' #TODO: Put this in config
         self.DEFAULT_FACE = 'nick'
 
+        self.vision = Lazy(get_vision_service)
+
     @register(name='name', expr='expr', doc='doc')
     async def command_facereplace(self, user, in_channel, parsed):
         face_replacement = parsed.get('name')
@@ -67,20 +69,17 @@ class FaceReplaceBot(SlackBot):
         
         filename = next(tempfile._get_candidate_names()) + '.png'
 
+        from googleapiclient import errors
         with open(image_file, 'rb') as image:
             try:
-                faces = await detect_face(image, self.MAX_FACES)
+                faces = await detect_face(image, await self.vision.get_async(), self.MAX_FACES)
             except errors.HttpError as e:
                 print(e._get_reason)
                 return MessageCommand(channel=in_channel, user=user, text='Failed API call. Image may be too large.')
-            
-            # Reset the file pointer, so we can read the file again
-            image.seek(0)
 
-            if faces:
-                replace_faces(image, faces, filename, face_replacement)
-            else:
-                return MessageCommand(channel=in_channel, user=user, text='No faces found.')
+        if not faces:
+            return MessageCommand(channel=in_channel, user=user, text='No faces found.')
+        await cpu_pool.run('facereplace', replace_faces, image_file, faces, filename, face_replacement)
 
         os.remove(image_file)
         return UploadCommand(channel=in_channel, user=user, file_name=filename, delete=True)
@@ -105,9 +104,10 @@ class FaceReplaceBot(SlackBot):
                 os.remove(image_file)
                 return MessageCommand(channel=in_channel, user=user, text='Image not transparent png. Please provide a transparent image.'.format(img_url))
 
+        from googleapiclient import errors
         with open(image_file, 'rb') as image:
             try:
-                faces = await detect_face(image, self.MAX_FACES)
+                faces = await detect_face(image, await self.vision.get_async(), self.MAX_FACES)
             except errors.HttpError as e:
                 print(e._get_reason)
                 return MessageCommand(channel=in_channel, user=user, text='Failed API call. Image may be too large.')
@@ -143,14 +143,16 @@ class FaceReplaceBot(SlackBot):
         return MessageCommand(channel=in_channel, user=user, text='Faces available for use with facereplace:\n{}'.format('\n'.join(faces)))
 
 def get_vision_service():
+    from googleapiclient import discovery
     return discovery.build('vision', 'v1')
 
 
-async def detect_face(face_file, max_results=4):
+async def detect_face(face_file, service, max_results=4):
     """Uses the Vision API to detect faces in the given file.
 
     Args:
         face_file: A file-like object containing an image with faces.
+        service: Vision API client from get_vision_service.
 
     Returns:
         An array of dicts with information about the faces in the picture.
@@ -166,7 +168,6 @@ async def detect_face(face_file, max_results=4):
             }]
         }]
 
-    service = get_vision_service()
     request = service.images().annotate(body={
         'requests': batch_request,
         })
@@ -179,7 +180,7 @@ def replace_faces(image, faces, output_filename, face_replacement):
     """Replace the faces.
 
     Args:
-      image: a file containing the image with the faces.
+      image: a file or the path of a file containing the image with the faces.
       faces: a list of faces found in the file. This should be in the format
           returned by the Vision API.
       output_filename: the name of the image file to be created, where the
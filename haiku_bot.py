@@ -1,7 +1,16 @@
+from cpu_pool import cpu_pool
 from pyparsing import CaselessLiteral, StringEnd
 from haiku import Haiku
 from slack.bot import SlackBot, register
 from slack.command import MessageCommand
+from util import Lazy
+
+# Loaded separately in each worker process the first time it generates a haiku
+_haiku = Lazy(Haiku)
+
+
+def generate_haiku():
+    return _haiku.get().generate_haiku()
 
 
 class HaikuBot(SlackBot):
@@ -10,8 +19,7 @@ class HaikuBot(SlackBot):
         self.haiku_expr = CaselessLiteral('haiku') + StringEnd()
         self.haiku_doc = "Generate a random haiku."
 
-        self.haiku = Haiku()
-
     @register(name='haiku_name', expr='haiku_expr', doc='haiku_doc')
     async def command_haiku(self, user, in_channel, parsed):
-        return MessageCommand(text=self.haiku.generate_haiku(), channel=in_channel, user=user)
+        text = await cpu_pool.run('haiku', generate_haiku)
+        return MessageCommand(text=text, channel=in_channel, user=user)
@@ -0,0 +1,73 @@
+"""
+Check that the queries the bots make are served by an index.
+Runs in the background at startup, and can be run directly:
+    python3 index_check.py
+"""
+import asyncio
+import logging
+
+import db  # pylint: disable=unused-import
+from sentiment.history import SentimentDoc
+from slack.history import history_query, HistoryDoc, HistoryDocV2, HistoryKeyDoc
+
+logger = logging.getLogger(__name__)
+
+# (document, description, filter, sort) for each query shape the bots use.
+# Values are placeholders: which plan wins depends on the fields queried, not their values.
+QUERY_SHAPES = [
+    (HistoryDoc, 'history by user', history_query(uid='U0'), None),
+    (HistoryDoc, 'history by channel', history_query(channel='general'), None),
+    (HistoryDoc, 'history by user and channel', history_query(uid='U0', channel='general'), None),
+    (HistoryDoc, 'recent history by channel', history_query(channel='general', after='0'), [('time', -1)]),
+    (HistoryDoc, 'message by timestamp', {'time': '0'}, None),
+    (HistoryDocV2, 'v2 history by user', {'u': 0, '_id': {'$gte': 0}}, None),
+    (HistoryDocV2, 'v2 recent history by channel', {'c': 0, '_id': {'$gte': 0}}, [('_id', -1)]),
+    (HistoryDocV2, 'v2 history in a time window', {'_id': {'$gte': 0, '$lt': 1}}, None),
+    (HistoryKeyDoc, 'history key by value', {'kind': 'uid', 'value': 'U0'}, None),
+    (HistoryKeyDoc, 'history value by key', {'kind': 'uid', 'key': 0}, None),
+    (SentimentDoc, 'sentiment by user', {'user': 'U0'}, None),
+    (SentimentDoc, 'sentiment by user and channel', {'user': 'U0', 'channel': 'general'}, None),
+]
+
+
+def _stages(plan):
+    """Every stage name in a query plan"""
+    yield plan.get('stage')
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from _stages(plan[key])
+    for child in plan.get('inputStages', ()):
+        yield from _stages(child)
+
+
+def full_scans(shapes=QUERY_SHAPES):
+    """Descriptions of the query shapes whose winning plan scans a whole collection"""
+    scanned = []
+    for document, description, query, sort in shapes:
+        document.ensure_indexes()
+        cursor = document._get_collection().find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in _stages(plan):
+            scanned.append('{} ({}: {})'.format(description, document.__name__, query))
+    return scanned
+
+
+async def check_query_plans():
+    """Log a warning for each known query shape which would do a full collection scan"""
+    loop = asyncio.get_event_loop()
+    try:
+        scanned = await loop.run_in_executor(None, full_scans)
+    except Exception:
+        logger.exception('Could not check query plans')
+        return
+    for description in scanned:
+        logger.warning('Query does a full collection scan: %s', description)
+    if not scanned:
+        logger.info('All %d known query shapes use an index', len(QUERY_SHAPES))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.get_event_loop().run_until_complete(check_query_plans())
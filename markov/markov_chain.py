@@ -1,6 +1,10 @@
-from collections import defaultdict, Counter
+from array import array
+from bisect import bisect_left, bisect_right
 from enum import Enum
-from itertools import chain
+from itertools import accumulate, chain
+import random
+import sys
+import threading
 
 from nltk import word_tokenize
 from nltk.tokenize.moses import MosesDetokenizer
@@ -13,10 +17,143 @@ OPEN = {'(': Modes.PAREN, '``': Modes.QUOTE}
 MODE_TO_OPEN = {m: o for o, m in OPEN.items()}
 CLOSE = {Modes.PAREN: ')', Modes.QUOTE: "''", Modes.DEFAULT: None}
 
+# Building a detokenizer compiles its regexes, so share one
+_detokenizer = MosesDetokenizer()
+
+
+class Vocabulary:
+
+    """Tokens interned as small integer ids, shared by every chain in the process"""
+
+    # Start and end of a message, and the markers for entering a mode
+    FIXED = [None] + list(Modes)
+
+    def __init__(self):
+        self.tokens = []
+        self._ids = {}
+        self._lock = threading.Lock()
+        for token in self.FIXED:
+            self.id(token)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def id(self, token):
+        token_id = self._ids.get(token)
+        if token_id is None:
+            # Chains may be built in executor threads
+            with self._lock:
+                token_id = self._ids.get(token)
+                if token_id is None:
+                    token_id = len(self.tokens)
+                    self.tokens.append(token)
+                    self._ids[token] = token_id
+        return token_id
+
+    def adopt(self, tokens):
+        """
+        Intern a list of tokens, such as a snapshot's.
+        Returns None if each token's id is its position in the list, else an array mapping positions to ids.
+        """
+        with self._lock:
+            shared = min(len(self.tokens), len(tokens))
+            if self.tokens[:shared] == tokens[:shared]:
+                for token in tokens[shared:]:
+                    self._ids[token] = len(self.tokens)
+                    self.tokens.append(token)
+                return None
+        return np.array([self.id(token) for token in tokens], np.int32)
+
+    def nbytes(self):
+        return (sys.getsizeof(self.tokens) + sys.getsizeof(self._ids) +
+                sum(sys.getsizeof(t) for t in self.tokens if isinstance(t, str)))
+
+
+vocabulary = Vocabulary()
+
+
+class _Transitions:
+
+    """
+    The words following one state: sorted token ids, their counts, and cumulative counts once sampled.
+    ids and counts may be read only views of a snapshot until the first add.
+    """
+
+    __slots__ = ('ids', 'counts', 'cumulative')
+
+    def __init__(self, ids=None, counts=None):
+        self.ids = array('i') if ids is None else ids
+        self.counts = array('i') if counts is None else counts
+        self.cumulative = None
+
+    def add(self, token_id):
+        if not isinstance(self.ids, array):
+            self.ids, self.counts = array('i', self.ids.tolist()), array('i', self.counts.tolist())
+        i = bisect_left(self.ids, token_id)
+        if i < len(self.ids) and self.ids[i] == token_id:
+            self.counts[i] += 1
+        else:
+            self.ids.insert(i, token_id)
+            self.counts.insert(i, 1)
+        self.cumulative = None
+
+    def draw(self):
+        if self.cumulative is None:
+            self.cumulative = array('q', accumulate(self.counts))
+        return self.ids[bisect_right(self.cumulative, random.randrange(self.cumulative[-1]))]
+
+    def nbytes(self):
+        return (sys.getsizeof(self) + sys.getsizeof(self.ids) + sys.getsizeof(self.counts) +
+                (sys.getsizeof(self.cumulative) if self.cumulative is not None else 0))
+
+
 class MarkovChain:
     def __init__(self):
-        self.transitions = {mode: defaultdict(Counter) for mode in Modes}
-        self.transition_totals = {mode: Counter() for mode in Modes}
+        # Token id of the previous word -> _Transitions, for each mode
+        self.states = {mode: {} for mode in Modes}
+        # For each mode, None or (sorted state ids, offsets, token ids, counts) arrays from a snapshot.
+        # The transitions of state_ids[i] are ids and counts[offsets[i]:offsets[i + 1]].
+        # States are moved into self.states when first used.
+        self.base = {mode: None for mode in Modes}
+
+    def _transitions(self, mode, state_id):
+        transitions = self.states[mode].get(state_id)
+        if transitions is None and self.base[mode] is not None:
+            state_ids, offsets, ids, counts = self.base[mode]
+            i = np.searchsorted(state_ids, state_id)
+            if i < len(state_ids) and state_ids[i] == state_id:
+                start, end = offsets[i], offsets[i + 1]
+                transitions = self.states[mode][state_id] = _Transitions(ids[start:end], counts[start:end])
+        return transitions
+
+    def iter_states(self, mode):
+        """Yield (state id, token ids, counts) for every state of a mode in state id order, without moving them"""
+        base = self.base[mode]
+        if base is None:
+            base = (np.zeros(0, np.int32), np.zeros(1, np.int64), None, None)
+        state_ids, offsets, ids, counts = base
+        moved = self.states[mode]
+        i = 0
+        for state_id in sorted(moved):
+            while i < len(state_ids) and state_ids[i] < state_id:
+                yield int(state_ids[i]), ids[offsets[i]:offsets[i + 1]], counts[offsets[i]:offsets[i + 1]]
+                i += 1
+            if i < len(state_ids) and state_ids[i] == state_id:
+                i += 1
+            yield state_id, moved[state_id].ids, moved[state_id].counts
+        for i in range(i, len(state_ids)):
+            yield int(state_ids[i]), ids[offsets[i]:offsets[i + 1]], counts[offsets[i]:offsets[i + 1]]
+
+    def set_state(self, mode, state_id, ids, counts):
+        """Replace the transitions of a state. ids must be sorted."""
+        self.states[mode][state_id] = _Transitions(ids, counts)
+
+    def _add(self, mode, last_word, word):
+        last_id = vocabulary.id(last_word)
+        transitions = self._transitions(mode, last_id)
+        if transitions is None:
+            transitions = self.states[mode][last_id] = _Transitions()
+        transitions.add(vocabulary.id(word))
 
     def load_string(self, text):
         last_word = None
@@ -28,27 +165,47 @@ class MarkovChain:
         for word in chain(tokens, [None]):
             mode = stack[-1]
             if word in OPEN:
-                self.transitions[mode][last_word][OPEN[word]] += 1
-                self.transition_totals[mode][last_word] += 1
+                self._add(mode, last_word, OPEN[word])
                 last_word = None
                 stack.append(OPEN[word])
             elif word == CLOSE[mode]:
-                self.transitions[mode][last_word][CLOSE[mode]] += 1
-                self.transition_totals[mode][last_word] += 1
+                self._add(mode, last_word, CLOSE[mode])
                 stack.pop()
                 last_word = word
             elif word != None: # Ignore Nones while not in Modes.DEFAULT
-                self.transitions[mode][last_word][word] += 1
-                self.transition_totals[mode][last_word] += 1
+                self._add(mode, last_word, word)
                 last_word = word
 
         while stack:
             mode = stack.pop()
             close = CLOSE[mode]
-            self.transitions[mode][last_word][close] += 1
-            self.transition_totals[mode][last_word] += 1
+            self._add(mode, last_word, close)
             last_word = close
 
+    def _next_word(self, mode, last_word):
+        """Draw a word following last_word with a binary search of the state's cumulative counts"""
+        return vocabulary.tokens[self._transitions(mode, vocabulary.id(last_word)).draw()]
+
+    def memory_report(self):
+        """
+        Number of states, number of distinct transitions, bytes used and bytes mapped from a snapshot,
+        not counting the shared vocabulary
+        """
+        states = transitions = nbytes = mapped = 0
+        for mode, mode_states in self.states.items():
+            nbytes += sys.getsizeof(mode_states)
+            for t in mode_states.values():
+                states += 1
+                transitions += len(t.ids)
+                nbytes += t.nbytes()
+            if self.base[mode] is not None:
+                state_ids, offsets, ids, counts = self.base[mode]
+                unmoved = ~np.isin(state_ids, np.fromiter(mode_states, np.int64, len(mode_states)))
+                states += int(unmoved.sum())
+                transitions += int(np.diff(offsets)[unmoved].sum())
+                mapped += state_ids.nbytes + offsets.nbytes + ids[offsets[0]:offsets[-1]].nbytes * 2
+        return states, transitions, nbytes, mapped
+
     def sample(self):
         last_word = None
         mode_stack = [Modes.DEFAULT]
@@ -56,13 +213,7 @@ class MarkovChain:
 
         while mode_stack:
             mode = mode_stack[-1]
-            probs = []
-            candidates = []
-            total = self.transition_totals[mode][last_word]
-            for word, t_count in self.transitions[mode][last_word].items():
-                probs.append(t_count / total)
-                candidates.append(word)
-            last_word = np.random.choice(candidates, p=probs)
+            last_word = self._next_word(mode, last_word)
             if last_word == CLOSE[mode]:
                 result.append(last_word)
                 mode_stack.pop()
@@ -81,4 +232,4 @@ class MarkovChain:
                 result[i] = '(' + result[i + 1]
                 del result[i + 1]
             i += 1
-        return MosesDetokenizer().detokenize(result[:-1], return_str=True)
+        return _detokenizer.detokenize(result[:-1], return_str=True)
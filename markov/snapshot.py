@@ -0,0 +1,115 @@
+"""
+Binary snapshots of MarkovChains which are memory-mapped when loaded.
+
+Layout: an 8 byte magic string, a little endian uint32 JSON header length and the JSON header, then, each
+starting on an 8 byte boundary, four arrays shared by every chain and mode: sorted state ids, offsets into the
+last two arrays, token ids and counts. The header holds the vocabulary and, for each chain, its range of states
+in each mode, along with any metadata the caller saved.
+"""
+from array import array
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from .markov_chain import MarkovChain, Modes, vocabulary
+
+MAGIC = b'EMOTERMK'
+VERSION = 1
+_LENGTH = struct.Struct('<I')
+_DTYPES = ('<i4', '<i8', '<i4', '<i4')
+
+
+def _padding(position):
+    return -position % 8
+
+
+def write_snapshot(path, chains, last_time=None, meta=None):
+    """
+    Write chains to a snapshot, replacing any existing file only once it is complete.
+    Args:
+        chains: Name -> MarkovChain
+        last_time: Timestamp of the newest message included
+        meta: Name -> JSON serializable data to store with each chain
+    """
+    state_ids, ids, counts = array('i'), array('i'), array('i')
+    offsets = array('q', [0])
+    entries = []
+    for name, chain in chains.items():
+        ranges = {}
+        for mode in Modes:
+            first = len(state_ids)
+            for state_id, state_tokens, state_counts in chain.iter_states(mode):
+                state_ids.append(state_id)
+                ids.extend(state_tokens)
+                counts.extend(state_counts)
+                offsets.append(len(ids))
+            ranges[mode.name] = [first, len(state_ids)]
+        entries.append({'name': name, 'modes': ranges, 'meta': (meta or {}).get(name)})
+
+    header = json.dumps({
+        'version': VERSION,
+        'last_time': last_time,
+        # Every id written is below this, as the vocabulary only grows
+        'tokens': vocabulary.tokens[len(vocabulary.FIXED):len(vocabulary)],
+        'chains': entries,
+    }).encode('utf-8')
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC + _LENGTH.pack(len(header)) + header)
+        for column, dtype in zip((state_ids, offsets, ids, counts), _DTYPES):
+            f.write(b'\0' * _padding(f.tell()))
+            f.write(np.asarray(column, dtype).tobytes())
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path):
+    """
+    Map a snapshot. Chains use its arrays directly unless the process vocabulary has diverged from the snapshot's,
+    in which case they are copied with their token ids translated.
+    Returns:
+        (name -> MarkovChain, last_time, name -> meta)
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('{} is not a Markov snapshot'.format(path))
+    header_length, = _LENGTH.unpack_from(data, len(MAGIC))
+    position = len(MAGIC) + _LENGTH.size
+    header = json.loads(data[position:position + header_length].decode('utf-8'))
+    if header['version'] != VERSION:
+        raise ValueError('Unsupported Markov snapshot version {}'.format(header['version']))
+    position += header_length
+
+    n_states = max([end for entry in header['chains'] for _, end in entry['modes'].values()] + [0])
+    arrays = []
+    for dtype, length in zip(_DTYPES, (n_states, n_states + 1, None, None)):
+        position += _padding(position)
+        if length is None:
+            length = int(arrays[1][-1])
+        column = np.frombuffer(data, dtype, length, position)
+        arrays.append(column)
+        position += column.nbytes
+    state_ids, offsets, ids, counts = arrays
+
+    remap = vocabulary.adopt(vocabulary.FIXED + header['tokens'])
+    chains = {}
+    for entry in header['chains']:
+        chain = chains[entry['name']] = MarkovChain()
+        for mode in Modes:
+            first, end = entry['modes'][mode.name]
+            if remap is None:
+                chain.base[mode] = (state_ids[first:end], offsets[first:end + 1], ids, counts)
+            else:
+                _copy_states(chain, mode, remap, state_ids[first:end], offsets[first:end + 1], ids, counts)
+    return chains, header['last_time'], {entry['name']: entry['meta'] for entry in header['chains']}
+
+
+def _copy_states(chain, mode, remap, state_ids, offsets, ids, counts):
+    for i, state_id in enumerate(state_ids):
+        state_tokens = remap[ids[offsets[i]:offsets[i + 1]]]
+        order = np.argsort(state_tokens)
+        chain.set_state(mode, int(remap[state_id]), array('i', state_tokens[order].tolist()),
+                        array('i', counts[offsets[i]:offsets[i + 1]][order].tolist()))
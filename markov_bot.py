@@ -1,25 +1,33 @@
+import asyncio
 from collections import Counter, defaultdict
 from itertools import chain
 import logging
 from pathlib import Path
 
-from markov.markov_chain import MarkovChain
+from cpu_pool import cpu_pool
+from markov.markov_chain import MarkovChain, vocabulary
+from markov.snapshot import read_snapshot, write_snapshot
 from nltk import word_tokenize
 from numpy.random import choice
 from pyparsing import CaselessLiteral, Optional, Word, alphanums, StringEnd
 from reddit.monitor import get_user_comments, get_user_posts
 from slack.bot import SlackBot, register
 from slack.command import HistoryCommand, MessageCommand
+from slack.history import micros_to_time, time_to_micros
 from slack.parsing import symbols
 from util import mention_to_uid
 
 
 logger = logging.getLogger(__name__)
 
+# Slack and reddit chains, rewritten after each start
+SNAPSHOT_PATH = 'markov/chains.snapshot'
+
 
 class MarkovBot(SlackBot):
-    def __init__(self, slack=None):
+    def __init__(self, slack=None, snapshot_path=SNAPSHOT_PATH):
         super().__init__(slack=slack)
+        self.snapshot_path = snapshot_path
         self.markov_name = 'Markov Message Generation'
         self.markov_expr = (CaselessLiteral('simulate') +
                             (symbols.flag_with_arg('reddit', symbols.user_name) |
@@ -33,31 +41,22 @@ class MarkovBot(SlackBot):
         self.custom_doc = ('Run assorted other markov chains:\n'
                            '\tmarkov <chain name>')
 
+        self.memory_name = 'Markov memory'
+        self.memory_expr = CaselessLiteral('markov_memory') + StringEnd()
+        self.memory_doc = ('Show the memory used by the largest user chains, and mapped from snapshots:\n'
+                           '\tmarkov_memory')
+
         self.slack_chains = defaultdict(MarkovChain)
-        slack.preload_commands((HistoryCommand(callback=self._hist_callback),))
+        # Messages seen while the history is loading, or None once it has loaded
+        self._pending = []
+        # Timestamp of the newest message in slack_chains
+        self._last_time = None
 
         self.reddit_chains = defaultdict(MarkovChain)
         self.reddit_transition_totals = defaultdict(Counter)
         self.reddit_most_recent_comments = defaultdict(int)
         self.reddit_most_recent_posts = defaultdict(int)
 
-        # Load chains from data directory
-        self.chains = {}
-
-    def _get_chain(self, name):
-        name = name.lower()
-        if name in self.chains:
-            return self.chains[name]
-        f_path = Path('markov/data/{}.txt'.format(name.lower()))
-        if f_path.exists():
-            new_chain = MarkovChain()
-            with f_path.open() as f:
-                for line in f:
-                    new_chain.load_string(line)
-            self.chains[f_path.stem] = new_chain
-            return new_chain
-        return None
-
     def _load_message(self, user, text, reddit=False):
         (self.reddit_chains if reddit else self.slack_chains)[user].load_string(text)
 
@@ -85,9 +84,50 @@ class MarkovBot(SlackBot):
         text = (self.reddit_chains if reddit else self.slack_chains)[user].sample()
         return text
 
+    async def warm_up(self, slack):
+        loop = asyncio.get_event_loop()
+        after = None
+        if Path(self.snapshot_path).exists():
+            try:
+                chains, self._last_time, meta = await loop.run_in_executor(None, read_snapshot, self.snapshot_path)
+            except (OSError, ValueError):
+                logger.exception('Could not read Markov snapshot %s, rebuilding from the history', self.snapshot_path)
+            else:
+                self._restore(chains, meta)
+                # Only fold in messages newer than the snapshot
+                after = micros_to_time(time_to_micros(self._last_time) + 1) if self._last_time else None
+                logger.info('Loaded %d Markov chains from %s', len(chains), self.snapshot_path)
+        try:
+            await HistoryCommand(callback=self._hist_callback, fields=('uid', 'text', 'time'),
+                                 after=after).execute(slack)
+        finally:
+            # Even if the history couldn't be read, stop queueing messages and use whatever has loaded
+            pending, self._pending = self._pending, None
+            for user, text in pending:
+                self.slack_chains[user].load_string(text)
+
+    def _restore(self, chains, meta):
+        for name, chain in chains.items():
+            kind, _, user = name.partition('/')
+            if kind == 'slack':
+                self.slack_chains[user] = chain
+            elif kind == 'reddit':
+                self.reddit_chains[user] = chain
+                self.reddit_most_recent_posts[user], self.reddit_most_recent_comments[user] = meta[name]
+
     async def _hist_callback(self, hist_list):
-        for message in hist_list:
-            self._load_message(message.uid, message.text)
+        loop = asyncio.get_event_loop()
+        self._last_time = await loop.run_in_executor(None, _fold_history, self.slack_chains, hist_list,
+                                                     self._last_time)
+        # Nothing else changes the slack chains until warm_up applies the pending messages
+        chains = {'slack/' + user: chain for user, chain in self.slack_chains.items()}
+        chains.update(('reddit/' + user, chain) for user, chain in self.reddit_chains.items())
+        meta = {'reddit/' + user: [self.reddit_most_recent_posts[user], self.reddit_most_recent_comments[user]]
+                for user in self.reddit_chains}
+        try:
+            await loop.run_in_executor(None, write_snapshot, self.snapshot_path, chains, self._last_time, meta)
+        except Exception:
+            logger.exception('Could not write Markov snapshot %s', self.snapshot_path)
 
     @register(name='markov_name', expr='markov_expr', doc='markov_doc')
     async def command_generate(self, user, in_channel, parsed):
@@ -104,7 +144,10 @@ class MarkovBot(SlackBot):
         else:
             target_user = parsed['user']
             target_uid = mention_to_uid(target_user)
-            if target_uid in self.slack_chains:
+            if self._pending is not None:
+                out_channel = None
+                out_message = 'Still reading the message history, try again in a minute.'
+            elif target_uid in self.slack_chains:
                 out_channel = in_channel
                 out_message = await self._generate_message(target_uid)
             else:
@@ -115,14 +158,79 @@ class MarkovBot(SlackBot):
     @register(name='custom_name', expr='custom_expr', doc='custom_doc')
     async def command_custom_markov(self, user, in_channel, parsed):
         chain_name = parsed['chain_name']
-        chain = self._get_chain(chain_name)
-        if chain:
-            message = chain.sample()
-        else:
+        message = await cpu_pool.run('markov', sample_custom_chain, chain_name)
+        if message is None:
             message = 'Chain {} does not exist'.format(chain_name)
         return MessageCommand(user=user, channel=in_channel, text=message)
 
+    @register(name='memory_name', expr='memory_expr', doc='memory_doc', admin=True)
+    async def command_memory(self, user, in_channel, parsed):
+        if self._pending is not None:
+            # The warm up adds chains from an executor thread until then
+            return MessageCommand(user=user, text='Still reading the message history, try again in a minute.')
+        reports = [(name, chain.memory_report())
+                   for chains in (self.slack_chains, self.reddit_chains) for name, chain in chains.items()]
+        reports.sort(key=lambda report: report[1][2], reverse=True)
+        lines = ['{:<20} {:>9} {:>12} {:>10} {:>10}'.format('chain', 'states', 'transitions', 'KB', 'mapped KB')]
+        for name, (states, transitions, nbytes, mapped) in reports[:10]:
+            lines.append('{:<20} {:>9} {:>12} {:>10.1f} {:>10.1f}'.format(
+                name, states, transitions, nbytes / 1024, mapped / 1024))
+        lines.append('{:<20} {:>9} {:>12} {:>10.1f} {:>10.1f}'.format(
+            'all {} chains'.format(len(reports)), sum(r[0] for _, r in reports), sum(r[1] for _, r in reports),
+            sum(r[2] for _, r in reports) / 1024, sum(r[3] for _, r in reports) / 1024))
+        lines.append('{:<20} {:>9} {:>12} {:>10.1f}'.format(
+            'shared vocabulary', len(vocabulary), '', vocabulary.nbytes() / 1024))
+        return MessageCommand(user=user, text='```\n{}\n```'.format('\n'.join(lines)))
+
     @register()
     async def markov_monitor(self, user, in_channel, message):
-        self._load_message(user, message)
+        if self._pending is None:
+            self._load_message(user, message)
+        else:
+            self._pending.append((user, message))
+
+
+# Chains from the data directory, loaded separately in each worker process
+_custom_chains = {}
+
+
+def _get_chain(name):
+    name = name.lower()
+    if name in _custom_chains:
+        return _custom_chains[name]
+    f_path = Path('markov/data/{}.txt'.format(name))
+    if f_path.exists():
+        snapshot_path = f_path.with_suffix('.snapshot')
+        if snapshot_path.exists() and snapshot_path.stat().st_mtime >= f_path.stat().st_mtime:
+            chains, _, _ = read_snapshot(str(snapshot_path))
+            new_chain = chains[name]
+        else:
+            new_chain = MarkovChain()
+            with f_path.open() as f:
+                for line in f:
+                    new_chain.load_string(line)
+            try:
+                write_snapshot(str(snapshot_path), {name: new_chain})
+            except OSError:
+                logger.exception('Could not write Markov snapshot %s', snapshot_path)
+        _custom_chains[f_path.stem] = new_chain
+        return new_chain
+    return None
+
+
+def sample_custom_chain(name):
+    """Sample from a chain in the data directory, or return None if it doesn't exist"""
+    chain = _get_chain(name)
+    return chain.sample() if chain else None
+
+
+def _fold_history(chains, hist_list, last_time):
+    """Load messages into chains, returning the newest timestamp seen"""
+    newest = time_to_micros(last_time) if last_time else None
+    for message in hist_list:
+        chains[message.uid].load_string(message.text)
+        micros = time_to_micros(message.time)
+        if newest is None or micros > newest:
+            newest = micros
+    return micros_to_time(newest) if newest is not None else None
 
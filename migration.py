@@ -0,0 +1,130 @@
+"""
+Running changes over every document in a collection: documents are streamed from a cursor in _id order,
+changes are applied with batched bulk writes, and progress is checkpointed so that an interrupted run resumes
+where it stopped.
+"""
+import datetime
+import time
+
+from mongoengine import DateTimeField, Document, DynamicField, IntField, StringField
+from pymongo import DeleteMany
+
+
+class MigrationDoc(Document):
+    """Progress of a migration"""
+    name = StringField(required=True, unique=True)
+    last_id = DynamicField()
+    processed = IntField(default=0)
+    changed = IntField(default=0)
+    finished = DateTimeField()
+
+
+class Migration:
+
+    """
+    Subclass this and implement change. Set collection to a pymongo collection, and optionally query and
+    projection to limit the documents and fields read.
+    """
+
+    name = None
+    collection = None
+    query = {}
+    projection = None
+
+    def change(self, doc):
+        """Return a pymongo write operation for a document, or None to leave it alone"""
+        raise NotImplementedError
+
+    def apply(self, ops):
+        """Write a batch of the values returned by change"""
+        self.collection.bulk_write(ops, ordered=False)
+
+
+def run_migration(migration, batch_size=1000, restart=False, report_seconds=5):
+    """
+    Apply a migration, resuming from its checkpoint unless restart is set.
+    Returns the number of documents changed in this run.
+    """
+    checkpoint = MigrationDoc.objects(name=migration.name).first()
+    if checkpoint is None or restart:
+        MigrationDoc.objects(name=migration.name).delete()
+        checkpoint = MigrationDoc(name=migration.name)
+    elif checkpoint.finished:
+        print('{} already finished at {}. Pass --restart to run it again'.format(migration.name, checkpoint.finished))
+        return 0
+    elif checkpoint.last_id is not None:
+        print('Resuming {} after {} documents'.format(migration.name, checkpoint.processed))
+
+    query = dict(migration.query)
+    if checkpoint.last_id is not None:
+        query = {'$and': [query, {'_id': {'$gt': checkpoint.last_id}}]}
+    cursor = migration.collection.find(query, migration.projection, batch_size=batch_size).sort('_id', 1)
+
+    start = last_report = time.time()
+    processed = changed = 0
+    batch_docs = 0
+    ops = []
+    for doc in cursor:
+        op = migration.change(doc)
+        if op is not None:
+            ops.append(op)
+        processed += 1
+        batch_docs += 1
+        checkpoint.last_id = doc['_id']
+        if batch_docs == batch_size:
+            changed += _apply(migration, ops, checkpoint, batch_docs)
+            ops, batch_docs = [], 0
+            if time.time() - last_report >= report_seconds:
+                last_report = time.time()
+                _report(migration.name, processed, changed, last_report - start)
+    changed += _apply(migration, ops, checkpoint, batch_docs)
+    checkpoint.finished = datetime.datetime.utcnow()
+    checkpoint.save()
+    _report(migration.name, processed, changed, time.time() - start)
+    return changed
+
+
+def _apply(migration, ops, checkpoint, batch_docs):
+    """Write a batch of changes, then record that the documents before checkpoint.last_id are done"""
+    if ops:
+        migration.apply(ops)
+    checkpoint.processed += batch_docs
+    checkpoint.changed += len(ops)
+    checkpoint.save()
+    return len(ops)
+
+
+def find_duplicates(collection, key):
+    """
+    Find documents which share a value of key with an earlier document, using a server side aggregation.
+    Yields lists of the _ids to remove, keeping the document with the lowest _id in each group.
+    """
+    pipeline = [
+        {'$sort': {'_id': 1}},
+        {'$group': {'_id': '$' + key, 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ]
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        yield group['ids'][1:]
+
+
+def delete_ids(collection, ids, batch_size=1000):
+    """Delete documents by _id with batched bulk writes. Returns the number deleted."""
+    deleted = 0
+    for i in range(0, len(ids), batch_size):
+        result = collection.bulk_write([DeleteMany({'_id': {'$in': ids[i:i + batch_size]}})], ordered=False)
+        deleted += result.deleted_count
+    return deleted
+
+
+def add_arguments(parser):
+    """Add the options every migration script accepts"""
+    parser.add_argument('--batch_size', type=int, default=1000,
+                        help='Documents per bulk write and checkpoint')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore any saved checkpoint and process every document again')
+
+
+def _report(name, processed, changed, seconds):
+    print('{}: {} documents read, {} changed in {:.1f} s ({:.0f} documents/s)'.format(
+        name, processed, changed, seconds, processed / seconds if seconds else 0))
@@ -42,6 +42,9 @@ class MoneyBot(SlackBot):
         self.give_expr = CaselessLiteral('give') + symbols.mention.setResultsName('user') + symbols.int_num.setResultsName('amount') + StringEnd()
         self.give_doc = 'Create {} in a user\'s account'.format(currency_name)
 
+    async def warm_up(self, slack):
+        await economy.warm_up()
+
     @register(name='check_name', expr='check_expr', doc='check_doc')
     async def command_check(self, user, in_channel, parsed):
         secondary = self.check_commands[parsed['command'].lower()]
@@ -1,3 +1,4 @@
+import asyncio
 from collections import defaultdict
 from itertools import chain
 import re
@@ -42,10 +43,12 @@ class ReactBot(SlackBot):
                          '\tlist_react [<channel>]')
 
         self.reacts = defaultdict(lambda: defaultdict(set))
-        for r in ReactDoc.objects():
-            self.reacts[r.channel][r.user].add((re.compile(r.regex), r.emoji))
 
-    @register(name='create_name', expr='create_expr', doc='create_doc')
+    async def warm_up(self, slack):
+        loop = asyncio.get_event_loop()
+        self.reacts = await loop.run_in_executor(None, _load_reacts)
+
+    @register(name='create_name', expr='create_expr', doc='create_doc', requires_ready=True)
     async def command_create(self, user, in_channel, parsed):
         target_channel = parsed['channel']
         reg_text = parsed['target_pattern']
@@ -117,3 +120,10 @@ class ReactBot(SlackBot):
             if reg.search(message):
                 result.append(ReactCommand(emoji))
         return result
+
+
+def _load_reacts():
+    reacts = defaultdict(lambda: defaultdict(set))
+    for r in ReactDoc.objects():
+        reacts[r.channel][r.user].add((re.compile(r.regex), r.emoji))
+    return reacts
@@ -0,0 +1,69 @@
+"""
+Compare command parse latency of the keyword index against the single MatchFirst.
+Run from the repository root: python -m scripts.bench_parser
+"""
+import argparse
+import time
+
+from pyparsing import CaselessLiteral, ParseException, StringEnd
+
+import poll_bot
+import qanta_bot
+import quote_bot
+from slack.parsing import symbols
+from slack.slack_api import Slack, SlackConfig
+
+MESSAGES = [
+    '!quote',
+    '!quote --channel general <@U12345678>',
+    '!poll pizza, tacos, sushi',
+    '!qanta This physicist proposed the uncertainty principle',
+    '!command7 some arguments here',
+    '!not_a_command at all',
+]
+
+
+def build_slack(extra_commands):
+    config = SlackConfig(token='', admin_token='', alert='!', name='bench',
+                         load_history=False, clear_commands=False, admins=[])
+    slack = Slack(config)
+    quote_bot.QuoteBot(slack=slack)
+    poll_bot.PollBot(slack=slack)
+    qanta_bot.QantaBot(slack=slack)
+    # Stand-ins for the rest of the bot set
+    for i in range(extra_commands):
+        expr = CaselessLiteral('command{}'.format(i)) + symbols.tail('args') + StringEnd()
+        slack._parser.add_command(expr, 'command{}'.format(i))
+    return slack
+
+
+def time_parser(parse, messages, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for message in messages:
+            try:
+                parse(message)
+            except ParseException:
+                pass
+    return (time.perf_counter() - start) / (repeats * len(messages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--extra_commands', type=int, default=40)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    slack = build_slack(args.extra_commands)
+    print('Registration: {:.1f} ms'.format(1000 * (time.perf_counter() - start)))
+
+    slack_parser = slack._parser
+    for name, parse in (('keyword index', slack_parser.parse), ('MatchFirst', slack_parser.parse_legacy)):
+        parse(MESSAGES[0])  # Build any cached expressions
+        latency = time_parser(parse, MESSAGES, args.repeats)
+        print('{}: {:.1f} us per message'.format(name, 1e6 * latency))
+
+
+if __name__ == '__main__':
+    main()
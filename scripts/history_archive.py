@@ -0,0 +1,70 @@
+"""
+Export the stored history to an archive file, or import one into the database.
+Run from the repository root:
+    python -m scripts.history_archive export history.arc
+    python -m scripts.history_archive import history.arc [--history_schema 2]
+    python -m scripts.history_archive read history.arc
+"""
+import argparse
+from itertools import islice
+import time
+
+import db  # pylint: disable=unused-import
+from slack.archive import HistoryArchive, write_archive
+from slack import history
+from slack.history import find_records, HistoryDoc, insert_history
+
+
+def export_history(path, batch_size):
+    start = time.time()
+    # Reads both schemas, so messages are exported wherever a migration has left them
+    history.set_schema(2)
+    count = write_archive(path, find_records({}, order=1, batch_size=batch_size))
+    print('Exported {} messages in {:.1f} s'.format(count, time.time() - start))
+
+
+def import_history(path, batch_size):
+    start = time.time()
+    inserted = 0
+    with HistoryArchive(path) as archive:
+        records = archive.records()
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            inserted += insert_history([HistoryDoc(uid=r.uid, channel=r.channel, text=r.text, time=r.time)
+                                        for r in batch])
+        print('Inserted {} of {} messages in {:.1f} s'.format(inserted, len(archive), time.time() - start))
+
+
+def read_history(path):
+    """Time reading every message, as a Markov or sentiment rebuild would"""
+    start = time.time()
+    with HistoryArchive(path) as archive:
+        characters = sum(len(r.text) for r in archive.records(fields=('text',)))
+        print('Read {} messages ({} characters, {} users, {} channels) in {:.1f} s'.format(
+            len(archive), characters, len(archive.uids), len(archive.channels), time.time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move message history between the database and archive files')
+    parser.add_argument('action', choices=['export', 'import', 'read'])
+    parser.add_argument('path')
+    parser.add_argument('--batch_size', type=int, default=10000,
+                        help='Documents per database round trip')
+    parser.add_argument('--history_schema', type=int, choices=[1, 2], default=1,
+                        help='Schema to import messages in, as for the bot')
+    parser.add_argument('--compress_history_bytes', type=int,
+                        help='With --history_schema 2, compress message texts of at least this many bytes')
+    args = parser.parse_args()
+    if args.action == 'export':
+        export_history(args.path, args.batch_size)
+    elif args.action == 'import':
+        history.set_schema(args.history_schema, args.compress_history_bytes)
+        import_history(args.path, args.batch_size)
+    else:
+        read_history(args.path)
+
+
+if __name__ == '__main__':
+    main()
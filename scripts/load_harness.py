@@ -0,0 +1,289 @@
+"""
+Load test the full bot set against a local stand-in for the Slack RTM and Web APIs.
+
+Record a log from a live run with:  python3 . --record_events events.jsonl.gz
+Then replay it from the repository root:
+    python -m scripts.load_harness --replay events.jsonl.gz --speed 10
+or generate a synthetic stream:
+    python -m scripts.load_harness --synthetic 2000 --rate 100
+
+The bots write to the database named by --db_name rather than config.DB_NAME.
+"""
+import argparse
+import asyncio
+from collections import defaultdict, deque
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import tempfile
+import time
+
+from aiohttp import web
+import websockets
+
+import config
+
+logger = logging.getLogger(__name__)
+
+SYNTHETIC_TEXTS = [
+    'hello everyone',
+    'has anyone seen the new episode yet',
+    'lol',
+    'that is the worst idea I have heard all week',
+    '!quote',
+    '!haiku',
+    '!poll pizza, tacos, sushi',
+    '!feels',
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(samples, qs=(50, 95, 99)):
+    ordered = sorted(samples)
+    if not ordered:
+        return [0 for _ in qs]
+    return [ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))] for q in qs]
+
+
+def synthetic_start_body(n_channels=5, n_users=20):
+    """An rtm.start body with made up channels and users, which include the bot and the configured admins"""
+    names = ['user{}'.format(i) for i in range(n_users)] + [config.NAME] + list(config.ADMINS)
+    users = [{'id': 'U{:08d}'.format(i), 'name': name, 'profile': {'display_name_normalized': name}}
+             for i, name in enumerate(names)]
+    channel_names = set(config.REACTION_CHANNELS) | set(config.SENTIMENT_MONITOR_CHANNELS)
+    channel_names |= {'channel{}'.format(i) for i in range(max(0, n_channels - len(channel_names)))}
+    channels = [{'id': 'C{:08d}'.format(i), 'name': name} for i, name in enumerate(sorted(channel_names))]
+    return {'ok': True, 'channels': channels, 'groups': [], 'users': users, 'ims': []}
+
+
+def synthetic_events(start_body, n_events):
+    """Random messages from the made up users in the made up channels"""
+    humans = [u['id'] for u in start_body['users'] if u['name'] != config.NAME]
+    channels = [c['id'] for c in start_body['channels']]
+    for _ in range(n_events):
+        yield {'type': 'message',
+               'channel': random.choice(channels),
+               'user': random.choice(humans),
+               'text': random.choice(SYNTHETIC_TEXTS)}
+
+
+def read_recording(path):
+    """Load the first rtm.start body and all events from an event log"""
+    from slack.event_log import read_log
+    start_body = None
+    events = []
+    for offset, kind, data in read_log(path):
+        if kind == 'rtm.start' and start_body is None:
+            start_body = data
+        elif kind == 'event':
+            event = json.loads(data)
+            # Acknowledgements of the bot's own messages are generated fresh by FakeSlack
+            if 'reply_to' not in event:
+                events.append((offset, event))
+    return start_body, events
+
+
+class FakeSlack:
+
+    """
+    Serves rtm.start, im.open, reactions.add, chat.delete, files.upload and the history methods over HTTP,
+    and a websocket which sends events and acknowledges the messages the bot sends back.
+    Records how long it takes for the bot to respond to each event.
+    """
+
+    def __init__(self, start_body, host='127.0.0.1'):
+        self.start_body = start_body
+        self.host = host
+        self.api_port = free_port()
+        self.ws_port = free_port()
+        self.connected = asyncio.Event()
+        self.calls = defaultdict(int)
+        self.response_latencies = []
+        self._socket = None
+        self._message_ts = 0
+        self._sent_at = {}
+        self._pending_commands = defaultdict(deque)
+        self._ws_server = None
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}/api/'.format(self.host, self.api_port)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route('*', '/api/{method}', self._api)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.api_port).start()
+        self._ws_server = await websockets.serve(self._rtm, self.host, self.ws_port)
+
+    async def stop(self):
+        self._ws_server.close()
+        await self._ws_server.wait_closed()
+        await self._runner.cleanup()
+
+    async def send_event(self, event):
+        """Send an event to the bot, stamping it with a fresh timestamp"""
+        self._message_ts += 1
+        event = dict(event, ts='{}.{:06d}'.format(int(time.time()), self._message_ts))
+        now = time.perf_counter()
+        self._sent_at[event['ts']] = now
+        if event.get('type') == 'message' and event.get('text', '').startswith(config.ALERT):
+            self._pending_commands[event['channel']].append(now)
+        await self._socket.send(json.dumps(event))
+
+    def _responded(self, channel=None, timestamp=None):
+        """Match an action by the bot with the event which caused it"""
+        now = time.perf_counter()
+        if timestamp in self._sent_at:
+            self.response_latencies.append(now - self._sent_at[timestamp])
+        elif self._pending_commands[channel]:
+            self.response_latencies.append(now - self._pending_commands[channel].popleft())
+
+    async def _rtm(self, ws, path=None):
+        self._socket = ws
+        self.connected.set()
+        try:
+            async for raw in ws:
+                message = json.loads(raw)
+                self.calls['rtm message'] += 1
+                self._responded(channel=message.get('channel'))
+                self._message_ts += 1
+                await ws.send(json.dumps({'ok': True,
+                                          'reply_to': message['id'],
+                                          'ts': '{}.{:06d}'.format(int(time.time()), self._message_ts),
+                                          'text': message.get('text')}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def _api(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = dict(request.query)
+        if request.method == 'POST':
+            form = await request.post()
+            params.update((k, v) for k, v in form.items() if isinstance(v, str))
+
+        if method == 'rtm.start':
+            body = dict(self.start_body, ok=True, url='ws://{}:{}/'.format(self.host, self.ws_port))
+        elif method == 'im.open':
+            body = {'ok': True, 'channel': {'id': 'D' + params['user'][1:]}}
+        elif method.endswith('.history'):
+            body = {'ok': True, 'messages': [], 'has_more': False}
+        else:
+            if method in ('reactions.add', 'chat.delete'):
+                self._responded(channel=params.get('channel'), timestamp=params.get('timestamp', params.get('ts')))
+            elif method == 'files.upload':
+                self._responded(channel=params.get('channels'))
+            body = {'ok': True}
+        return web.json_response(body)
+
+
+async def play(fake, slackapp, timed_events, rate, speed):
+    """Send events at a fixed rate, or with their recorded spacing divided by speed"""
+    await fake.connected.wait()
+    start = time.perf_counter()
+    for i, (offset, event) in enumerate(timed_events):
+        due = start + (i / rate if rate else (offset - timed_events[0][0]) / speed)
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await fake.send_event(event)
+    sent_time = time.perf_counter() - start
+
+    # Wait for the bot to finish handling and sending everything
+    idle_checks = 0
+    while idle_checks < 3:
+        await asyncio.sleep(0.05)
+        idle = not (slackapp._dispatcher.depth or slackapp.outbox.depth)
+        idle_checks = idle_checks + 1 if idle else 0
+    return sent_time, time.perf_counter() - start
+
+
+def report(fake, slackapp, n_events, sent_time, total_time):
+    print('Events: {}  sent in {:.2f}s  handled in {:.2f}s  throughput {:.1f} events/s'.format(
+        n_events, sent_time, total_time, n_events / total_time if total_time else 0))
+    p50, p95, p99 = percentiles(fake.response_latencies)
+    print('Response latency over {} responses (ms): p50 {:.1f}  p95 {:.1f}  p99 {:.1f}'.format(
+        len(fake.response_latencies), 1000 * p50, 1000 * p95, 1000 * p99))
+    print('API calls: {}'.format(dict(fake.calls)))
+    print()
+    print('\n'.join(slackapp.stats_report()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--replay', metavar='PATH', help='Event log recorded with --record_events')
+    source.add_argument('--synthetic', type=int, metavar='N', help='Number of synthetic messages to send')
+    parser.add_argument('--rate', type=float, help='Events per second. Defaults to the recorded rate for --replay')
+    parser.add_argument('--speed', type=float, default=1, help='Replay speed multiplier when --rate is not given')
+    parser.add_argument('--db_name', default='emoter_load_test')
+    parser.add_argument('--event_workers', type=int, default=8)
+    parser.add_argument('--messages_per_second', type=float, default=1)
+    args = parser.parse_args()
+    if args.synthetic and not args.rate:
+        parser.error('--synthetic requires --rate')
+
+    # Must happen before anything imports db
+    config.DB_NAME = args.db_name
+    import bots
+    from cpu_pool import cpu_pool
+    from slack.slack_api import Slack, SlackConfig
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.replay:
+        start_body, timed_events = read_recording(args.replay)
+        start_body = start_body or synthetic_start_body()
+    else:
+        start_body = synthetic_start_body()
+        timed_events = [(0, event) for event in synthetic_events(start_body, args.synthetic)]
+
+    loop = asyncio.get_event_loop()
+    fake = FakeSlack(start_body)
+    loop.run_until_complete(fake.start())
+
+    # Keeps the id cache and Markov snapshot out of the working directory, and away from a live bot's
+    scratch = tempfile.mkdtemp(prefix='emoter-load-')
+    slack_config = SlackConfig(
+        token='xoxb-load-test',
+        admin_token='xoxp-load-test',
+        alert=config.ALERT,
+        name=config.NAME,
+        load_history=False,
+        clear_commands=False,
+        admins=config.ADMINS,
+        event_workers=args.event_workers,
+        messages_per_second=args.messages_per_second,
+        id_cache=os.path.join(scratch, 'ids.json'),
+        markov_snapshot=os.path.join(scratch, 'chains.snapshot'),
+        base_url=fake.base_url)
+    slackapp = Slack(slack_config)
+
+    bots.add_bots(slackapp)
+    app_task = loop.create_task(slackapp.run())
+    sent_time, total_time = loop.run_until_complete(
+        play(fake, slackapp, timed_events, args.rate, args.speed))
+    app_task.cancel()
+    loop.run_until_complete(asyncio.gather(app_task, return_exceptions=True))
+    loop.run_until_complete(slackapp.shutdown())
+    loop.run_until_complete(fake.stop())
+    cpu_pool.shutdown()
+    shutil.rmtree(scratch, ignore_errors=True)
+
+    report(fake, slackapp, len(timed_events), sent_time, total_time)
+    print()
+    print('\n'.join(cpu_pool.report()))
+
+
+if __name__ == '__main__':
+    main()
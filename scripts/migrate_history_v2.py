@@ -0,0 +1,45 @@
+"""
+Move every HistoryDoc to the compact HistoryDocV2 schema. Run it while the bot runs with --history_schema 2,
+which reads both collections until this finishes:
+    python -m scripts.migrate_history_v2 [--compress_history_bytes 200]
+"""
+import argparse
+
+import db  # pylint: disable=unused-import
+from migration import add_arguments, Migration, run_migration
+from slack import history
+from slack.history import HistoryDoc, HistoryDocV2, insert_ignoring_duplicates, to_v2
+
+
+class MigrateHistoryV2(Migration):
+
+    """Copies each batch of HistoryDocs to HistoryDocV2, then deletes them"""
+
+    name = 'history_v2'
+
+    def __init__(self):
+        self.collection = HistoryDoc._get_collection()
+
+    def change(self, doc):
+        return doc['_id'], to_v2(doc)
+
+    def apply(self, ops):
+        insert_ignoring_duplicates(HistoryDocV2._get_collection(), [v2 for _, v2 in ops])
+        self.collection.delete_many({'_id': {'$in': [_id for _id, _ in ops]}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--compress_history_bytes', type=int,
+                        help='Compress message texts of at least this many bytes')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    history.set_schema(2, args.compress_history_bytes)
+    HistoryDocV2.ensure_indexes()
+    before = HistoryDoc._get_collection().estimated_document_count()
+    run_migration(MigrateHistoryV2(), args.batch_size, args.restart)
+    print('HistoryDocs left: {} of {}'.format(HistoryDoc._get_collection().estimated_document_count(), before))
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,23 @@
-from config import DB_NAME
-import mongoengine
+import argparse
+
+import db  # pylint: disable=unused-import
+from migration import delete_ids, find_duplicates
 from slack.history import HistoryDoc
 
+
 def main():
-    mongoengine.connect(DB_NAME)
-    seen_timestamps = set()
-    docs = HistoryDoc.objects()
+    parser = argparse.ArgumentParser(description='Delete messages stored more than once, keeping the first copy')
+    parser.add_argument('--batch_size', type=int, default=1000,
+                        help='Documents per bulk delete')
+    args = parser.parse_args()
 
-    to_delete = []
-    for d in docs:
-        if d.time in seen_timestamps:
-            to_delete.append(d)
-        seen_timestamps.add(d.time)
+    collection = HistoryDoc._get_collection()
+    to_delete = [_id for ids in find_duplicates(collection, 'time') for _id in ids]
     print('Found {} duplicate timestamps'.format(len(to_delete)))
     if not to_delete or input('Delete duplicates? (y/n): ').lower() != 'y':
         exit()
 
-    for d in to_delete:
-        d.delete()
+    print('Deleted {} documents'.format(delete_ids(collection, to_delete, args.batch_size)))
 
 if __name__ == '__main__':
     main()
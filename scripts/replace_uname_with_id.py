@@ -1,19 +1,40 @@
+import argparse
+
 import config
-import db
+import db  # pylint: disable=unused-import
+from migration import add_arguments, Migration, run_migration
+from pymongo import UpdateOne
 import requests
 from slack.history import HistoryDoc
 
 
+class ReplaceUnameWithId(Migration):
+
+    """Move the user name in each HistoryDoc's old user field to the uid field as an ID"""
+
+    name = 'replace_uname_with_id'
+    query = {'user': {'$exists': True}}
+    projection = ['user']
+
+    def __init__(self, uname_to_id):
+        self.collection = HistoryDoc._get_collection()
+        self.uname_to_id = uname_to_id
+
+    def change(self, doc):
+        update = {'$unset': {'user': 1}}
+        if doc['user']:
+            update['$set'] = {'uid': self.uname_to_id[doc['user']]}
+        return UpdateOne({'_id': doc['_id']}, update)
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+
     users = requests.get('https://slack.com/api/users.list', params={'token': config.TOKEN}).json()['members']
     uname_to_id = {u['name']: u['id'] for u in users}
-    docs = HistoryDoc.objects()
-    for d in docs:
-        user = d.user
-        if user:
-            d.update(user=None, uid=uname_to_id[user])
-    HistoryDoc.objects.update(unset__user=1)
-    print(len(docs))
+    run_migration(ReplaceUnameWithId(uname_to_id), args.batch_size, args.restart)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,53 @@
+"""Full text search over the stored message history"""
+import time
+
+from pyparsing import CaselessLiteral, Literal, OneOrMore, Optional, printables, StringEnd, Word
+from slack.bot import register, SlackBot
+from slack.command import MessageCommand
+from slack.parsing import symbols
+from util import mention_to_uid, uid_to_mention
+
+MAX_RESULTS = 5
+
+
+def date_to_timestamp(date):
+    """A YYYY-MM-DD date as a Slack timestamp for the start of that day in local time"""
+    return '{:.6f}'.format(time.mktime(time.strptime(date, '%Y-%m-%d')))
+
+
+class SearchBot(SlackBot):
+    def __init__(self, slack):
+        self.slack = slack
+        self.name = 'Search history'
+        self.expr = (CaselessLiteral('search') +
+                     OneOrMore(~Literal('--') + Word(printables)).setResultsName('words') +
+                     (Optional(symbols.flag_with_arg('user', symbols.mention)) &
+                      Optional(symbols.flag_with_arg('channel', symbols.channel_name)) &
+                      Optional(symbols.flag_with_arg('after', symbols.date)) &
+                      Optional(symbols.flag_with_arg('before', symbols.date))
+                      ) + StringEnd())
+        self.doc = ('Find messages containing all of the given words, newest first. Dates are YYYY-MM-DD:\n'
+                    '\tsearch <words> [--user <user>] [--channel <channel>] [--after <date>] [--before <date>]')
+
+    @register(name='name', expr='expr', doc='doc')
+    async def command_search(self, user, in_channel, parsed):
+        text = ' '.join(parsed['words'])
+        result = await self.slack.search(
+            text,
+            uid=mention_to_uid(parsed['user']) if 'user' in parsed else None,
+            channel=parsed['channel'] if 'channel' in parsed else None,
+            after=date_to_timestamp(parsed['after']) if 'after' in parsed else None,
+            before=date_to_timestamp(parsed['before']) if 'before' in parsed else None,
+            limit=MAX_RESULTS)
+        if result is None:
+            return MessageCommand(channel=in_channel, user=user,
+                                  text='Still indexing the message history, try again soon.')
+        count, quotes = result
+        if not quotes:
+            return MessageCommand(channel=in_channel, user=user, text='No messages found for "{}".'.format(text))
+        shown = ', showing the newest {}'.format(len(quotes)) if count > len(quotes) else ''
+        lines = ['{} message{} found for "{}"{}:'.format(count, '' if count == 1 else 's', text, shown)]
+        for quote in quotes:
+            day = time.strftime('%Y-%m-%d', time.localtime(float(quote.time)))
+            lines.append('> {}\n-{} in #{}, {}'.format(quote.text, uid_to_mention(quote.uid), quote.channel, day))
+        return MessageCommand(channel=in_channel, user=user, text='\n'.join(lines))
@@ -13,5 +13,7 @@ class SentimentDoc(Document):
         'indexes': [{
             'fields': ['time'],
             'unique': True
+        }, {
+            'fields': ['user', 'channel']
         }]
     }
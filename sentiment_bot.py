@@ -1,3 +1,4 @@
+import asyncio
 from collections import Counter, defaultdict
 from functools import partial
 import random
@@ -7,18 +8,30 @@ import config
 from mongoengine.errors import NotUniqueError
 import numpy as np
 from pyparsing import CaselessLiteral, nums, Optional, StringEnd, Word
-from sentiment import model
 from sentiment.history import SentimentDoc
 from slack.bot import register, SlackBot
 from slack.command import HistoryCommand, MessageCommand
 from slack.parsing import symbols
-from util import mention_to_uid, uid_to_mention
+from util import Lazy, mention_to_uid, uid_to_mention
 
 COOLDOWN = 50
 
 
+def load_predictor():
+    """Load the sentiment model into its own graph and session, and return a function of text to softmax"""
+    # Tensorflow takes seconds to import, so this is deferred along with the model
+    import tensorflow as tf
+    from sentiment import model
+
+    graph = tf.Graph()
+    with graph.as_default():
+        session = tf.Session(graph=graph)
+        saved_model, word_map = model.load_model(session)
+    return partial(model.predict, saved_model, session, word_map)
+
+
 class SentimentBot(SlackBot):
-    def __init__(self, session, slack):
+    def __init__(self, slack):
         self.name = 'Sentiment Stats'
         self.expr = (CaselessLiteral('feels') +
                      Optional(symbols.mention.setResultsName('user')) +
@@ -44,8 +57,10 @@ class SentimentBot(SlackBot):
         self.cooldowns = defaultdict(int)
         self.monitor_channels = config.SENTIMENT_MONITOR_CHANNELS
 
-        saved_model, word_map = model.load_model(session)
-        self.predict = partial(model.predict, saved_model, session, word_map)
+        self.predictor = Lazy(load_predictor)
+
+    def predict(self, text):
+        return self.predictor.get()(text)
 
     @register(name='name', expr='expr', doc='doc')
     async def command_stats(self, user, in_channel, parsed):
@@ -64,7 +79,9 @@ class SentimentBot(SlackBot):
     async def _stats_callback(self, out_channel, user, hist_list, target_user=None):
         if not hist_list:
             return
-        softmaxes = [(obj.neg_sent, obj.neut_sent, obj.pos_sent) for obj in self._complete_cache(hist_list, user=target_user)]
+        loop = asyncio.get_event_loop()
+        sent_hist = await loop.run_in_executor(None, lambda: list(self._complete_cache(hist_list, user=target_user)))
+        softmaxes = [(obj.neg_sent, obj.neut_sent, obj.pos_sent) for obj in sent_hist]
         counts = [0, 0]
         for s in softmaxes:
             # Exclude neutral val
@@ -91,14 +108,18 @@ class SentimentBot(SlackBot):
     async def _extrema_callback(self, field, out_channel, user, hist_list, target_user=None):
         if not hist_list:
             return
-        q_time = max(self._complete_cache(hist_list, user=target_user), key=lambda obj: getattr(obj, field)).time
+        # Scoring uncached messages loads the model and runs it, so keep it off the event loop
+        loop = asyncio.get_event_loop()
+        sent_hist = await loop.run_in_executor(None, lambda: list(self._complete_cache(hist_list, user=target_user)))
+        q_time = max(sent_hist, key=lambda obj: getattr(obj, field)).time
         quote = next(r for r in hist_list if r.time == q_time)
         year = time.strftime('%Y', time.localtime(float(quote.time)))
         return MessageCommand(channel=out_channel, user=user, text='> {}\n-{} {}'.format(quote.text, uid_to_mention(quote.uid), year))
 
     @register(name='judge_name', expr='judge_expr', doc='judge_doc')
     async def command_judge(self, user, in_channel, parsed):
-        sent = self.predict(parsed['text'])
+        loop = asyncio.get_event_loop()
+        sent = await loop.run_in_executor(None, self.predict, parsed['text'])
         sent *= 100
         decimals = parsed['decimals'] if 'decimals' in parsed else '0'
         format_str = 'Positive: {:.' + decimals + 'f}% Negative: {:.' + decimals + 'f}%'
@@ -108,7 +129,9 @@ class SentimentBot(SlackBot):
     async def sentiment_monitor(self, user, in_channel, message, timestamp):
         if not in_channel:
             return
-        neg, neut, pos = self.predict(message)
+        # Run the model off the event loop so other handlers aren't held up
+        loop = asyncio.get_event_loop()
+        neg, neut, pos = await loop.run_in_executor(None, self.predict, message)
         SentimentDoc(time=timestamp, user=user, channel=in_channel, pos_sent=pos, neut_sent=neut, neg_sent=neg).save()
         channel_sentiment = self.sentiments[in_channel]
         channel_sentiment.append(pos + 0.2 > neg)
@@ -0,0 +1,194 @@
+"""
+Compact, memory-mappable files of message history, for loading history without Slack or the database.
+
+Layout: an 8 byte magic string, a little endian uint32 JSON header length and the JSON header, then, each
+starting on an 8 byte boundary, the arrays named in the header. User and channel are dictionary encoded,
+times are integer microseconds, and text is zlib compressed in blocks of consecutive messages.
+"""
+from array import array
+import json
+import mmap
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+from .history import micros_to_time, Record, time_to_micros
+from .history_cache import Codes
+
+MAGIC = b'EMOTERHA'
+VERSION = 1
+_LENGTH = struct.Struct('<I')
+
+# name, dtype of each array section in file order
+_SECTIONS = [
+    ('uid', '<i4'),
+    ('channel', '<i4'),
+    ('time', '<i8'),
+    ('text_length', '<i4'),
+    ('block_offset', '<i8'),
+]
+
+
+def _padding(position):
+    return -position % 8
+
+
+def write_archive(path, records, block_size=4096, level=6):
+    """
+    Write Records to an archive, streaming the compressed text through a temporary file.
+    Args:
+        block_size: Messages per compressed text block. Larger blocks compress better but are slower to seek into.
+        level: zlib compression level
+    Returns:
+        The number of messages written
+    """
+    uids, channels = Codes(), Codes()
+    uid, channel, times, lengths = array('i'), array('i'), array('q'), array('i')
+    block_offsets = array('q', [0])
+    block = []
+    with tempfile.TemporaryFile() as texts:
+        def flush_block():
+            texts.write(zlib.compress(b''.join(block), level))
+            block_offsets.append(texts.tell())
+            block.clear()
+
+        for r in records:
+            encoded = (r.text or '').encode('utf-8')
+            uid.append(uids.encode(r.uid))
+            channel.append(channels.encode(r.channel))
+            times.append(time_to_micros(r.time))
+            lengths.append(len(encoded))
+            block.append(encoded)
+            if len(block) == block_size:
+                flush_block()
+        if block:
+            flush_block()
+
+        header = json.dumps({
+            'version': VERSION,
+            'count': len(times),
+            'block_size': block_size,
+            'uids': uids.values,
+            'channels': channels.values,
+        }).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(MAGIC + _LENGTH.pack(len(header)) + header)
+            for column, (name, dtype) in zip((uid, channel, times, lengths, block_offsets), _SECTIONS):
+                f.write(b'\0' * _padding(f.tell()))
+                f.write(np.asarray(column, dtype).tobytes())
+            f.write(b'\0' * _padding(f.tell()))
+            texts.seek(0)
+            while True:
+                chunk = texts.read(1 << 20)
+                if not chunk:
+                    break
+                f.write(chunk)
+    return len(times)
+
+
+class HistoryArchive:
+
+    """
+    A read only view of an archive. The arrays are numpy views of the mapped file, so opening doesn't read
+    them and pages are only read from disk when used. Text blocks are decompressed as they are read.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('{} is not a history archive'.format(path))
+        header_length, = _LENGTH.unpack_from(self._map, len(MAGIC))
+        position = len(MAGIC) + _LENGTH.size
+        header = json.loads(self._map[position:position + header_length].decode('utf-8'))
+        if header['version'] != VERSION:
+            self.close()
+            raise ValueError('Unsupported history archive version {}'.format(header['version']))
+        position += header_length
+
+        self.uids = header['uids']
+        self.channels = header['channels']
+        self.block_size = header['block_size']
+        count = header['count']
+        n_blocks = -(-count // self.block_size)
+        for name, dtype in _SECTIONS:
+            position += _padding(position)
+            length = n_blocks + 1 if name == 'block_offset' else count
+            column = np.frombuffer(self._map, dtype, length, position)
+            setattr(self, name, column)
+            position += column.nbytes
+        self._text_start = position + _padding(position)
+        # Offset of each message in its decompressed block
+        self._offsets = np.zeros(count, np.int64)
+        if count:
+            starts = np.cumsum(self.text_length, dtype=np.int64) - self.text_length
+            block_starts = starts[::self.block_size]
+            self._offsets = starts - np.repeat(block_starts, self.block_size)[:count]
+
+    def __len__(self):
+        return len(self.time)
+
+    def block(self, i):
+        """The decompressed text of block i"""
+        start = self._text_start + int(self.block_offset[i])
+        end = self._text_start + int(self.block_offset[i + 1])
+        return zlib.decompress(self._map[start:end])
+
+    def text(self, row):
+        """The text of one message"""
+        data = self.block(row // self.block_size)
+        offset = self._offsets[row]
+        return data[offset:offset + self.text_length[row]].decode('utf-8')
+
+    def select(self, uid=None, channel=None, after=None, before=None):
+        """Row numbers of the messages matching the filters, as for HistoryCommand"""
+        mask = np.ones(len(self), bool)
+        if uid:
+            mask &= self.uid == (self.uids.index(uid) if uid in self.uids else -1)
+        if channel:
+            mask &= self.channel == (self.channels.index(channel) if channel in self.channels else -1)
+        if after:
+            mask &= self.time >= time_to_micros(after)
+        if before:
+            mask &= self.time < time_to_micros(before)
+        return np.flatnonzero(mask)
+
+    def records(self, rows=None, fields=Record._fields):
+        """
+        Iterate over Records, with only the given fields filled in.
+        Args:
+            rows: Increasing row numbers, for example from select. Defaults to every message.
+        """
+        rows = range(len(self)) if rows is None else rows
+        want_text = 'text' in fields
+        current_block, data = None, None
+        for row in rows:
+            text = None
+            if want_text:
+                block = row // self.block_size
+                if block != current_block:
+                    current_block, data = block, self.block(block)
+                offset = self._offsets[row]
+                text = data[offset:offset + self.text_length[row]].decode('utf-8')
+            yield Record(
+                self.channels[self.channel[row]] if 'channel' in fields else None,
+                self.uids[self.uid[row]] if 'uid' in fields else None,
+                text,
+                micros_to_time(int(self.time[row])) if 'time' in fields else None)
+
+    def close(self):
+        # The numpy views must be released before the map can close
+        for name, _ in _SECTIONS:
+            self.__dict__.pop(name, None)
+        self.__dict__.pop('_offsets', None)
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
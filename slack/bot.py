@@ -3,7 +3,8 @@ from collections import namedtuple
 from functools import partial, wraps
 from .slack_api import Slack
 
-HandlerData = namedtuple('HandlerData', ['name', 'expr', 'channels', 'doc', 'priority', 'admin', 'include_timestamp'])
+HandlerData = namedtuple('HandlerData', ['name', 'expr', 'channels', 'doc', 'priority', 'admin', 'include_timestamp',
+                                         'requires_ready'])
 
 
 class SlackHandler:
@@ -29,14 +30,17 @@ class SlackHandler:
         return self._func
 
 
-def register(name=None, expr=None, channels=None, doc=None, priority=0, admin=False, include_timestamp=False):
+def register(name=None, expr=None, channels=None, doc=None, priority=0, admin=False, include_timestamp=False,
+             requires_ready=False):
     """
     Decorator for registering a function to be a slack handler.
     Must be used on a method in a class which inherits from SlackBot.
+    Handlers with requires_ready set are not called until the bot's warm_up has finished.
     """
     def wrap(f):
         """Create SlackHandler with f. Uses wraps to preseve metadata."""
-        return wraps(f)(SlackHandler(f, HandlerData(name, expr, channels, doc, priority, admin, include_timestamp)))
+        data = HandlerData(name, expr, channels, doc, priority, admin, include_timestamp, requires_ready)
+        return wraps(f)(SlackHandler(f, data))
     return wrap
 
 
@@ -60,7 +64,8 @@ class SlackBotMeta(type):
                 func = partial(handler.func, self)
                 data = handler.data
 
-                name = getattr(self, data.name) if data.name else ''
+                # Handlers without a display name are identified by their method
+                name = getattr(self, data.name) if data.name else '{}.{}'.format(type(self).__name__, name)
                 expr = getattr(self, data.expr) if data.expr else None
                 channels = getattr(self, data.channels) if data.channels else None
                 doc = getattr(self, data.doc) if data.doc else ''
@@ -71,13 +76,19 @@ class SlackBotMeta(type):
                     doc=doc,
                     priority=data.priority,
                     admin=data.admin,
-                    include_timestamp=data.include_timestamp)
+                    include_timestamp=data.include_timestamp,
+                    requires_ready=data.requires_ready)
 
-                slack.register_handler(func, mapped_data)
+                slack.register_handler(func, mapped_data, bot=self)
+            slack.register_bot(self)
         setattr(cls, '__init__', new_init)
 
 
 class SlackBot(metaclass=SlackBotMeta):
-    """Class to inherit from when making Slack bots"""
+    """
+    Class to inherit from when making Slack bots.
+    Bots which need to load state before some of their commands work should define a coroutine method
+    warm_up(self, slack). Slack runs it in the background once connected and tracks whether the bot is ready.
+    """
     def __init__(self, *args, **kwargs):
         pass
@@ -0,0 +1,95 @@
+"""Message passing between the ingest process and bot worker processes over a local socket"""
+import asyncio
+import logging
+import pickle
+import struct
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('!I')
+
+
+class BusConnection:
+
+    """
+    One end of a connection carrying pickled dicts, each with an 'op' key.
+    Messages sent with request() get an 'id' and the other end's handler result is sent back as the reply.
+    Messages sent with notify() get no reply.
+    Only connect processes which trust each other: anything can be unpickled.
+    """
+
+    def __init__(self, reader, writer, handler):
+        """
+        Args:
+            reader, writer: asyncio streams for the socket
+            handler: Coroutine function called with each incoming message which isn't a reply
+        """
+        self._reader = reader
+        self._writer = writer
+        self._handler = handler
+        self._next_id = 0
+        self._replies = {}
+        self._tasks = set()
+
+    def notify(self, message):
+        """Send a message without waiting for a reply"""
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        self._writer.write(_HEADER.pack(len(data)) + data)
+
+    async def request(self, message):
+        """Send a message and return the other end's reply"""
+        self._next_id += 1
+        reply = asyncio.get_event_loop().create_future()
+        self._replies[self._next_id] = reply
+        self.notify(dict(message, id=self._next_id))
+        await self._writer.drain()
+        return await reply
+
+    async def serve(self):
+        """Read messages until the connection closes"""
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                message = await self._read()
+                if 'reply_to' in message:
+                    reply = self._replies.pop(message['reply_to'], None)
+                    if reply is None or reply.done():
+                        continue
+                    if 'error' in message:
+                        reply.set_exception(RuntimeError(message['error']))
+                    else:
+                        reply.set_result(message['result'])
+                else:
+                    task = loop.create_task(self._handle(message))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info('Bus connection closed')
+        finally:
+            for reply in self._replies.values():
+                if not reply.done():
+                    reply.set_exception(ConnectionError('Bus connection closed'))
+            self._replies = {}
+            for task in self._tasks:
+                task.cancel()
+
+    def close(self):
+        self._writer.close()
+
+    async def _read(self):
+        header = await self._reader.readexactly(_HEADER.size)
+        length, = _HEADER.unpack(header)
+        return pickle.loads(await self._reader.readexactly(length))
+
+    async def _handle(self, message):
+        try:
+            result = await self._handler(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception('Exception handling bus message %s', message.get('op'))
+            if 'id' in message:
+                self.notify({'reply_to': message['id'], 'error': repr(e)})
+        else:
+            if 'id' in message:
+                self.notify({'reply_to': message['id'], 'result': result})
@@ -1,9 +1,9 @@
 """Module for Commands which bots use to act in Slack"""
 import abc
-from collections import namedtuple
+import asyncio
 import os
 
-from .history import HistoryDoc
+from .history import history_query, HistoryStream, Record
 
 
 class Command(metaclass=abc.ABCMeta):
@@ -34,7 +34,7 @@ class MessageCommand(Command):
         unless it is falsy, in which case sends it to the specified user."""
         channel = (slack.ids.cid(self.channel)
                    if self.channel else
-                   slack.ids.dmid(uid=self.user))
+                   await slack.dm_channel(self.user))
 
         max_index = (len(self.text) - 1) // 4000
         for index in range(max_index + 1):
@@ -55,34 +55,60 @@ class DeleteCommand(Command):
         await slack.delete_message(event['channel'], event['user'], event['ts'])
 
 
-Record = namedtuple('Record', ['channel', 'uid', 'text', 'time'])
-
-
 class HistoryCommand(Command):
 
     """
     Pass a callback to slack with signature:
         f(hist_list) where hist is a list of (channel, user, text, time) namedtuples.
+    With stream=True, hist_list is instead a HistoryStream, an async iterator of the same namedtuples,
+    so that the whole history never has to be in memory at once.
+    Once slack's history cache has loaded, it answers instead of the database.
     """
 
-    def __init__(self, callback, channel=None, user=None):
+    def __init__(self, callback, channel=None, user=None, after=None, before=None, limit=None,
+                 fields=Record._fields, stream=False, batch_size=1000):
+        """
+        Args:
+            callback: Coroutine function called with the history
+            channel: Only include messages from this channel name
+            user: Only include messages from this user ID
+            after, before: Only include messages with timestamps in [after, before)
+            limit: Maximum number of messages, taking the newest ones
+            fields: Record fields the callback uses. The others are left as None.
+            stream: Whether to pass a HistoryStream rather than a list
+            batch_size: Number of messages fetched from the database at a time
+        """
         self.callback = callback
         self.channel = channel
         self.user = user
+        self.after = after
+        self.before = before
+        self.limit = limit
+        self.fields = fields
+        self.stream = stream
+        self.batch_size = batch_size
 
     async def execute(self, slack, event=None):
-        kwargs = {}
-        if self.channel:
-            kwargs['channel'] = self.channel
-
-        if self.user:
-            kwargs['uid'] = self.user
-
-        hist_objects = HistoryDoc.objects(**kwargs)
-        hist_list = [Record(r.channel, r.uid, r.text, r.time)
-                     for r in hist_objects]
-
-        return await self.callback(hist_list)
+        cache = getattr(slack, 'history_cache', None)
+        if cache is not None and cache.loaded:
+            history = cache.stream(uid=self.user, channel=self.channel, after=self.after, before=self.before,
+                                   limit=self.limit, fields=self.fields, batch_size=self.batch_size)
+        else:
+            await slack.flush_history()
+            query = history_query(channel=self.channel, uid=self.user, after=self.after, before=self.before)
+            history = HistoryStream(query, fields=self.fields, limit=self.limit, batch_size=self.batch_size)
+        if self.stream:
+            try:
+                return await self.callback(history)
+            finally:
+                history.close()
+
+        if isinstance(history, HistoryStream):
+            # Reading a large history takes a while, so keep it off the event loop
+            loop = asyncio.get_event_loop()
+            return await self.callback(await loop.run_in_executor(None, history.read_all))
+        # The cache can't be read from another thread, but its stream yields between batches
+        return await self.callback([record async for record in history])
 
 
 class ReactCommand(Command):
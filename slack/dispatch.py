@@ -0,0 +1,79 @@
+"""Concurrent event dispatch which preserves ordering within a channel"""
+import asyncio
+from collections import defaultdict, deque
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EventDispatcher:
+
+    """
+    Runs event handlers concurrently on a fixed number of workers.
+    Events which share a key (normally the channel ID) are handled one at a time, in the order they were queued.
+    """
+
+    def __init__(self, handler, workers=8, max_queued=1000):
+        """
+        Args:
+            handler: Coroutine function called with each event
+            workers: Maximum number of events handled at once
+            max_queued: Maximum number of events waiting or in progress before put() blocks
+        """
+        self._handler = handler
+        self._n_workers = workers
+        self._slots = asyncio.Semaphore(max_queued)
+        self._ready = asyncio.Queue()
+        self._waiting = defaultdict(deque)
+        self._active_keys = set()
+        self._workers = []
+
+    @property
+    def depth(self):
+        """Number of events which have been queued but not finished"""
+        return self._ready.qsize() + sum(len(q) for q in self._waiting.values()) + len(self._active_keys)
+
+    def start(self):
+        """Launch the worker tasks. Does nothing if they are already running."""
+        if self._workers:
+            return
+        loop = asyncio.get_event_loop()
+        self._workers = [loop.create_task(self._work()) for _ in range(self._n_workers)]
+
+    async def stop(self):
+        """Cancel the worker tasks"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def put(self, key, event):
+        """Queue an event. Blocks while the dispatcher is full."""
+        await self._slots.acquire()
+        if key in self._active_keys:
+            self._waiting[key].append(event)
+        else:
+            self._active_keys.add(key)
+            self._ready.put_nowait((key, event))
+
+    async def _work(self):
+        while True:
+            key, event = await self._ready.get()
+            try:
+                await self._handler(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Exception while handling event %s', event)
+            finally:
+                self._slots.release()
+                self._advance(key)
+
+    def _advance(self, key):
+        """Hand the next event for a key to the workers, or release the key if there are none."""
+        waiting = self._waiting.get(key)
+        if waiting:
+            self._ready.put_nowait((key, waiting.popleft()))
+        else:
+            self._waiting.pop(key, None)
+            self._active_keys.discard(key)
@@ -0,0 +1,36 @@
+"""Compressed logs of raw websocket events, for replaying against a test server"""
+import gzip
+import json
+import time
+
+
+class EventRecorder:
+
+    """Appends the rtm.start response and raw websocket events to a gzipped JSON lines file"""
+
+    def __init__(self, path):
+        self._file = gzip.open(path, 'at')
+        self._start = time.time()
+
+    def _write(self, kind, data):
+        self._file.write(json.dumps({'t': time.time() - self._start, 'kind': kind, 'data': data}) + '\n')
+
+    def record_start(self, body):
+        """Record the body of an rtm.start response"""
+        self._write('rtm.start', body)
+        self._file.flush()
+
+    def record_event(self, raw):
+        """Record the raw text of a websocket event"""
+        self._write('event', raw)
+
+    def close(self):
+        self._file.close()
+
+
+def read_log(path):
+    """Yield (seconds since recording started, kind, data) for each entry in an event log"""
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            entry = json.loads(line)
+            yield entry['t'], entry['kind'], entry['data']
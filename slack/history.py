@@ -1,5 +1,56 @@
-"""Mongoengine definition for storing history"""
-from mongoengine import Document, StringField
+"""
+Mongoengine definitions for storing history.
+
+Messages are stored in one of two schemas. HistoryDoc keeps each field as a string. HistoryDocV2 is compact:
+the timestamp is an integer _id, channel and user are short integer keys, and long texts may be compressed.
+After set_schema(2), new messages are written as HistoryDocV2 while reads merge both collections, until
+scripts/migrate_history_v2.py has moved every HistoryDoc across.
+"""
+import asyncio
+from collections import deque, namedtuple
+import heapq
+from itertools import chain, islice
+import logging
+import random
+import threading
+import zlib
+
+from bson import Binary
+from mongoengine import BinaryField, Document, IntField, LongField, StringField
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+DUPLICATE_KEY = 11000
+
+logger = logging.getLogger(__name__)
+
+Record = namedtuple('Record', ['channel', 'uid', 'text', 'time'])
+
+# The schema new messages are written in, and the shortest text which is compressed in schema 2
+_schema = 1
+_compress_text_bytes = None
+
+
+def set_schema(version, compress_text_bytes=None):
+    """
+    Choose the schema new messages are written in. With version 2, messages stored as HistoryDocs are still read
+    until they have been migrated.
+    Args:
+        compress_text_bytes: With version 2, compress texts of at least this many UTF-8 bytes. None disables it.
+    """
+    global _schema, _compress_text_bytes
+    _schema = version
+    _compress_text_bytes = compress_text_bytes
+
+
+def time_to_micros(timestamp):
+    """Slack timestamps ('1500000000.000100') as integer microseconds, which are exact unlike floats"""
+    seconds, _, fraction = timestamp.partition('.')
+    return int(seconds) * 1000000 + int(fraction[:6].ljust(6, '0'))
+
+
+def micros_to_time(micros):
+    return '{}.{:06d}'.format(micros // 1000000, micros % 1000000)
 
 
 class HistoryDoc(Document):
@@ -8,3 +59,420 @@ class HistoryDoc(Document):
     channel = StringField()
     text = StringField()
     time = StringField(unique=True)
+    meta = {
+        'indexes': [
+            # History filtered by user or channel, optionally over a time range
+            {'fields': ['uid', 'time']},
+            {'fields': ['channel', 'time']},
+        ]
+    }
+
+
+class HistorySyncDoc(Document):
+    """Timestamp of the newest message loaded from a channel's history"""
+    channel = StringField(required=True, unique=True)
+    latest = StringField()
+
+
+class HistoryDocV2(Document):
+    """A Slack message in the compact schema"""
+    # Timestamp in microseconds. As the _id, time ranges use the _id index.
+    time = LongField(primary_key=True)
+    # HistoryKeyDoc keys
+    channel = IntField(db_field='c')
+    uid = IntField(db_field='u')
+    text = StringField(db_field='x')
+    # zlib compressed UTF-8 text, instead of text
+    ztext = BinaryField(db_field='z')
+    meta = {
+        'collection': 'history_v2',
+        'indexes': [
+            {'fields': ['uid', 'time']},
+            {'fields': ['channel', 'time']},
+        ]
+    }
+
+
+class HistoryKeyDoc(Document):
+    """The integer key of a channel name or user ID in HistoryDocV2. Documents of kind 'next' count keys per kind."""
+    kind = StringField(required=True)
+    value = StringField()
+    key = IntField(required=True)
+    meta = {
+        'collection': 'history_keys',
+        'indexes': [
+            {'fields': ['kind', 'value'], 'unique': True},
+            {'fields': ['kind', 'key']},
+        ]
+    }
+
+
+class _Keys:
+
+    """Cache of HistoryKeyDoc keys in both directions. Safe to use from executor threads."""
+
+    def __init__(self):
+        self._keys = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def key(self, kind, value, create=True):
+        """The key for a value, or None if it has none and create is False"""
+        key = self._keys.get((kind, value))
+        if key is None:
+            with self._lock:
+                key = self._load_key(kind, value, create)
+        return key
+
+    def value(self, kind, key):
+        if (kind, key) not in self._values:
+            doc = HistoryKeyDoc._get_collection().find_one({'kind': kind, 'key': key})
+            self._remember(kind, doc['value'] if doc else None, key)
+        return self._values[kind, key]
+
+    def _load_key(self, kind, value, create):
+        collection = HistoryKeyDoc._get_collection()
+        doc = collection.find_one({'kind': kind, 'value': value})
+        if doc is None:
+            if not create:
+                return None
+            counter = collection.find_one_and_update(
+                {'kind': 'next', 'value': kind}, {'$inc': {'key': 1}}, upsert=True,
+                return_document=ReturnDocument.AFTER)
+            doc = {'kind': kind, 'value': value, 'key': counter['key']}
+            try:
+                collection.insert_one(doc)
+            except DuplicateKeyError:
+                # Another process added it first
+                doc = collection.find_one({'kind': kind, 'value': value})
+        self._remember(kind, value, doc['key'])
+        return doc['key']
+
+    def _remember(self, kind, value, key):
+        self._values[kind, key] = value
+        if value is not None:
+            self._keys[kind, value] = key
+
+
+_keys = _Keys()
+
+
+def to_v2(doc):
+    """A HistoryDocV2 document for a HistoryDoc document, as dicts"""
+    v2 = {'_id': time_to_micros(doc['time'])}
+    if doc.get('channel') is not None:
+        v2['c'] = _keys.key('channel', doc['channel'])
+    if doc.get('uid') is not None:
+        v2['u'] = _keys.key('uid', doc['uid'])
+    text = doc.get('text')
+    if text is not None:
+        encoded = text.encode('utf-8')
+        if _compress_text_bytes is not None and len(encoded) >= _compress_text_bytes:
+            v2['z'] = Binary(zlib.compress(encoded))
+        else:
+            v2['x'] = text
+    return v2
+
+
+def _from_v1(doc):
+    return Record(doc.get('channel'), doc.get('uid'), doc.get('text'), doc.get('time'))
+
+
+def _from_v2(doc):
+    text = doc.get('x')
+    if 'z' in doc:
+        text = zlib.decompress(doc['z']).decode('utf-8')
+    return Record(_keys.value('channel', doc['c']) if 'c' in doc else None,
+                  _keys.value('uid', doc['u']) if 'u' in doc else None,
+                  text,
+                  micros_to_time(doc['_id']))
+
+
+def _v2_query(query):
+    """Translate a HistoryDoc filter from history_query, or on time alone, to HistoryDocV2. None if it can't match."""
+    v2 = {}
+    for field, db_field in (('channel', 'c'), ('uid', 'u')):
+        if field in query:
+            key = _keys.key(field, query[field], create=False)
+            if key is None:
+                return None
+            v2[db_field] = key
+    if 'time' in query:
+        time = query['time']
+        if isinstance(time, dict):
+            v2['_id'] = {op: [time_to_micros(t) for t in value] if op == '$in' else time_to_micros(value)
+                         for op, value in time.items()}
+        else:
+            v2['_id'] = time_to_micros(time)
+    return v2
+
+
+def _v2_projection(fields):
+    projection = {'_id': True}
+    for field, db_fields in (('channel', ('c',)), ('uid', ('u',)), ('text', ('x', 'z'))):
+        if field in fields:
+            projection.update(dict.fromkeys(db_fields, True))
+    return projection
+
+
+def _read_v1():
+    """Whether reads need to include HistoryDocs"""
+    return _schema == 1 or HistoryDoc._get_collection().estimated_document_count() > 0
+
+
+def _find(query, fields=Record._fields, order=None, limit=None, batch_size=1000):
+    """
+    Generate the Records of stored messages matching a HistoryDoc filter, from whichever schemas are in use.
+    When both are read, they are merged in time order so that messages present in both mid migration are read once.
+    Args:
+        order: 1 or -1 to sort by time
+        limit: Maximum number of Records
+    """
+    cursors = []
+    sources = []
+    read_v1 = _read_v1()
+    v2_query = _v2_query(query) if _schema == 2 else None
+    if read_v1 and v2_query is not None and not order:
+        order = 1
+    try:
+        if read_v1:
+            projection = dict.fromkeys(set(fields) | {'time'}, True)
+            projection['_id'] = False
+            cursor = HistoryDoc._get_collection().find(query, projection, batch_size=batch_size)
+            if order:
+                cursor = cursor.sort('time', order)
+            cursors.append(cursor.limit(limit) if limit else cursor)
+            sources.append(map(_from_v1, cursor))
+        if v2_query is not None:
+            cursor = HistoryDocV2._get_collection().find(v2_query, _v2_projection(fields), batch_size=batch_size)
+            if order:
+                cursor = cursor.sort('_id', order)
+            cursors.append(cursor.limit(limit) if limit else cursor)
+            sources.append(map(_from_v2, cursor))
+
+        if len(sources) > 1:
+            records = _unique_times(heapq.merge(*sources, key=lambda r: time_to_micros(r.time), reverse=order < 0))
+        else:
+            records = chain.from_iterable(sources)
+        for r in islice(records, limit):
+            yield r if 'time' in fields else r._replace(time=None)
+    finally:
+        for cursor in cursors:
+            cursor.close()
+
+
+def find_records(query, fields=Record._fields, order=None, batch_size=1000):
+    """Generate the Records matching a HistoryDoc filter from every schema in use. Blocks, unlike HistoryStream."""
+    return _find(query, fields, order=order, batch_size=batch_size)
+
+
+def _unique_times(records):
+    last = None
+    for r in records:
+        if r.time != last:
+            yield r
+        last = r.time
+
+
+def insert_history(docs):
+    """
+    Insert many HistoryDocs with a single bulk write, in the current schema.
+    Documents whose timestamp is already stored are skipped.
+    Returns the number of documents inserted.
+    """
+    if not docs:
+        return 0
+    if _schema == 2:
+        collection = HistoryDocV2._get_collection()
+        documents = [to_v2(doc.to_mongo()) for doc in docs]
+    else:
+        collection = HistoryDoc._get_collection()
+        documents = [doc.to_mongo() for doc in docs]
+    return insert_ignoring_duplicates(collection, documents)
+
+
+def insert_ignoring_duplicates(collection, documents):
+    """Insert documents with a single bulk write, skipping any whose unique keys are already stored"""
+    try:
+        return len(collection.insert_many(documents, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+            raise
+        return e.details['nInserted']
+
+
+def clear_history():
+    """Delete every stored message in both schemas"""
+    HistoryDoc.objects().delete()
+    HistoryDocV2.objects().delete()
+
+
+def read_messages(timestamps):
+    """Records for the stored messages with the given timestamps, in the same order, skipping any not found"""
+    by_time = {r.time: r for r in _find({'time': {'$in': list(timestamps)}})}
+    return [by_time[t] for t in timestamps if t in by_time]
+
+
+def sample_message(query):
+    """
+    A random stored message matching a HistoryDoc filter, or None.
+    Only constant time without a filter: $sample has to read every matching document. Prefer HistoryCache.sample.
+    """
+    samples = []
+    if _read_v1():
+        samples.append((HistoryDoc, query, _from_v1))
+    v2_query = _v2_query(query) if _schema == 2 else None
+    if v2_query is not None:
+        samples.append((HistoryDocV2, v2_query, _from_v2))
+    if len(samples) > 1:
+        # Mid migration, try a schema in proportion to its size. Filters are ignored to avoid counting.
+        sizes = [document._get_collection().estimated_document_count() for document, _, _ in samples]
+        if random.random() * sum(sizes) >= sizes[0]:
+            samples.reverse()
+    for document, match, convert in samples:
+        docs = list(document._get_collection().aggregate([{'$match': match}, {'$sample': {'size': 1}}]))
+        if docs:
+            return convert(docs[0])
+    return None
+
+
+def history_query(channel=None, uid=None, after=None, before=None):
+    """
+    Build a Mongo filter for HistoryDocs. It is translated for HistoryDocV2 when reading.
+    Args:
+        channel: Channel name
+        uid: User ID
+        after: Only include messages with a timestamp at or after this one
+        before: Only include messages with a timestamp before this one
+    """
+    query = {}
+    if channel:
+        query['channel'] = channel
+    if uid:
+        query['uid'] = uid
+    if after or before:
+        query['time'] = {}
+        if after:
+            query['time']['$gte'] = after
+        if before:
+            query['time']['$lt'] = before
+    return query
+
+
+class HistoryStream:
+
+    """
+    Async iterator over the Records matching a query, read from server side cursors in batches.
+    Only the requested fields are fetched, the rest of each Record is None.
+    Batches are fetched in an executor, so iterating never blocks the event loop on the database.
+    """
+
+    def __init__(self, query, fields=Record._fields, limit=None, batch_size=1000):
+        """
+        Args:
+            query: HistoryDoc filter, usually from history_query
+            fields: Record fields to fetch
+            limit: Maximum number of Records. If given, the newest messages come first.
+            batch_size: Number of documents fetched from the database at a time
+        """
+        self._query = query
+        self._fields = fields
+        self._limit = limit
+        self._batch_size = batch_size
+        self._source = None
+        self._records = deque()
+        self._exhausted = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._records and not self._exhausted:
+            loop = asyncio.get_event_loop()
+            self._records.extend(await loop.run_in_executor(None, self._fetch))
+        if not self._records:
+            raise StopAsyncIteration
+        return self._records.popleft()
+
+    def _fetch(self):
+        if self._source is None:
+            self._source = _find(self._query, self._fields, order=-1 if self._limit else None,
+                                 limit=self._limit, batch_size=self._batch_size)
+        batch = list(islice(self._source, self._batch_size))
+        if len(batch) < self._batch_size:
+            self._exhausted = True
+        return batch
+
+    def read_all(self):
+        """Fetch every remaining Record at once. Blocks, so call it from an executor."""
+        records = list(self._records)
+        self._records.clear()
+        while not self._exhausted:
+            records.extend(self._fetch())
+        return records
+
+    def close(self):
+        """Release the server side cursors early"""
+        self._exhausted = True
+        self._records.clear()
+        if self._source is not None:
+            self._source.close()
+
+
+class HistoryBuffer:
+
+    """
+    Write-behind buffer for HistoryDocs.
+    Documents are bulk inserted once max_size of them are waiting, or max_age seconds after the first one was added.
+    """
+
+    def __init__(self, max_size=100, max_age=5):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._docs = []
+        self._timer = None
+        self._write_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    async def add(self, doc):
+        """Queue a document to be written"""
+        self._docs.append(doc)
+        if len(self._docs) >= self.max_size:
+            await self.flush()
+        else:
+            self._schedule()
+
+    def _schedule(self):
+        if self._timer is None:
+            loop = asyncio.get_event_loop()
+            self._timer = loop.call_later(self.max_age, lambda: loop.create_task(self._timed_flush()))
+
+    async def flush(self):
+        """
+        Write all waiting documents. Returns the number inserted.
+        If the write fails the documents are put back, to be retried by the next flush.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        docs, self._docs = self._docs, []
+        if not docs:
+            return 0
+        loop = asyncio.get_event_loop()
+        async with self._write_lock:
+            try:
+                return await loop.run_in_executor(None, insert_history, docs)
+            except Exception:
+                # Retrying is safe, as documents which were already written are skipped
+                self._docs[:0] = docs
+                self._schedule()
+                raise
+
+    async def _timed_flush(self):
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception('Failed to write buffered history')
@@ -0,0 +1,326 @@
+"""Columnar in-memory copy of the message history"""
+from array import array
+import asyncio
+import logging
+import random
+
+import numpy as np
+
+from .history import HistoryStream, micros_to_time, read_messages, Record, time_to_micros
+
+logger = logging.getLogger(__name__)
+
+
+class Codes:
+
+    """Dictionary encoding of strings as small integers"""
+
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def encode(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def get(self, value):
+        """The code for a value, or -1 if it has never been encoded"""
+        return self._codes.get(value, -1)
+
+
+class _Columns:
+
+    """
+    Growable arrays with one row per message.
+    Text is UTF-8 in one buffer. text_start is each row's offset into the stream of all text ever added,
+    and text_base is the offset of the first byte still in the buffer. Rows which start before text_base
+    have had their text evicted.
+    rows holds the row numbers for each (uid, -1), (-1, channel) and (uid, channel) code pair, in order.
+    """
+
+    def __init__(self, capacity=1024):
+        self.n = 0
+        self.uid = np.empty(capacity, np.int32)
+        self.channel = np.empty(capacity, np.int32)
+        self.time = np.empty(capacity, np.int64)
+        self.text_start = np.empty(capacity, np.int64)
+        self.text_length = np.empty(capacity, np.int32)
+        self.text = bytearray()
+        self.text_base = 0
+        self.rows = {}
+
+    def append(self, uid, channel, micros, text):
+        if self.n == len(self.time):
+            self._grow()
+        i = self.n
+        self.uid[i] = uid
+        self.channel[i] = channel
+        self.time[i] = micros
+        self.text_start[i] = self.text_base + len(self.text)
+        self.text_length[i] = len(text)
+        self.text += text
+        for key in ((uid, -1), (-1, channel), (uid, channel)):
+            rows = self.rows.get(key)
+            if rows is None:
+                rows = self.rows[key] = array('i')
+            rows.append(i)
+        self.n += 1
+
+    def _grow(self):
+        capacity = 2 * len(self.time)
+        for name in ('uid', 'channel', 'time', 'text_start', 'text_length'):
+            column = getattr(self, name)
+            grown = np.empty(capacity, column.dtype)
+            grown[:self.n] = column[:self.n]
+            setattr(self, name, grown)
+
+    def text_at(self, i):
+        """The text of row i, or None if it has been evicted"""
+        start = self.text_start[i] - self.text_base
+        if start < 0:
+            return None
+        return self.text[start:start + self.text_length[i]].decode('utf-8')
+
+    def evict(self, max_bytes):
+        """Drop the text of the oldest rows until at most max_bytes remain"""
+        if len(self.text) <= max_bytes:
+            return 0
+        cut = self.text_base + len(self.text) - max_bytes
+        first_kept = np.searchsorted(self.text_start[:self.n], cut)
+        new_base = self.text_start[first_kept] if first_kept < self.n else self.text_base + len(self.text)
+        del self.text[:new_base - self.text_base]
+        evicted = int(first_kept - np.searchsorted(self.text_start[:self.n], self.text_base))
+        self.text_base = new_base
+        return evicted
+
+    @property
+    def nbytes(self):
+        return (len(self.text) + self.uid.nbytes + self.channel.nbytes + self.time.nbytes +
+                self.text_start.nbytes + self.text_length.nbytes +
+                sum(len(rows) * rows.itemsize for rows in self.rows.values()))
+
+
+class HistoryCache:
+
+    """
+    Every stored message, held as dictionary encoded user and channel codes, integer timestamps and a text buffer.
+    Filters are answered with vectorized masks. To cap memory, the text of the oldest messages is dropped
+    and read back from the database when needed.
+    """
+
+    def __init__(self, max_text_bytes=64 * 2 ** 20):
+        """
+        Args:
+            max_text_bytes: How much message text to keep in memory
+        """
+        self.max_text_bytes = max_text_bytes
+        self.loaded = False
+        self._uids = Codes()
+        self._channels = Codes()
+        self._columns = _Columns()
+        self._evicted = 0
+        # Messages added while load() runs, or None when it isn't running
+        self._pending = None
+
+    @property
+    def loading(self):
+        """Whether load() is running"""
+        return self._pending is not None
+
+    def __len__(self):
+        return self._columns.n
+
+    def add(self, uid, channel, text, timestamp):
+        """Add a newly stored message"""
+        if self._pending is not None:
+            self._pending.append(Record(channel, uid, text, timestamp))
+            return
+        self._append(uid, channel, text, time_to_micros(timestamp))
+        self._evicted += self._columns.evict(self.max_text_bytes)
+
+    def add_records(self, records):
+        """Add Records which may already be cached, like those from a history sync"""
+        if self._pending is not None:
+            self._pending.extend(records)
+            return
+        records = list(records)
+        micros = np.array([time_to_micros(r.time) for r in records], np.int64)
+        known = np.isin(micros, self._columns.time[:self._columns.n])
+        for record, m, is_known in zip(records, micros, known):
+            if not is_known:
+                self._append(record.uid, record.channel, record.text, int(m))
+        self._evicted += self._columns.evict(self.max_text_bytes)
+
+    def _append(self, uid, channel, text, micros):
+        self._columns.append(self._uids.encode(uid), self._channels.encode(channel), micros,
+                             (text or '').encode('utf-8'))
+
+    async def load(self, batch_size=10000):
+        """Fill the cache from the database. Messages added meanwhile are kept and merged in afterwards."""
+        self._pending = []
+        uids, channels, columns = Codes(), Codes(), _Columns()
+        stream = HistoryStream({}, batch_size=batch_size)
+        try:
+            async for r in stream:
+                columns.append(uids.encode(r.uid), channels.encode(r.channel), time_to_micros(r.time),
+                               (r.text or '').encode('utf-8'))
+                if columns.n % batch_size == 0:
+                    self._evicted += columns.evict(self.max_text_bytes)
+            self._evicted += columns.evict(self.max_text_bytes)
+        except Exception:
+            self._pending = None
+            raise
+        finally:
+            stream.close()
+
+        self._uids, self._channels, self._columns = uids, channels, columns
+        pending, self._pending = self._pending, None
+        self.add_records(pending)
+        self.loaded = True
+        logger.info('History cache loaded %d messages using %.1f MB', len(self), self._columns.nbytes / 2 ** 20)
+
+    def select(self, uid=None, channel=None, after=None, before=None, limit=None):
+        """Row numbers of the messages matching the filters. With a limit, the newest come first."""
+        columns = self._columns
+        mask = np.ones(columns.n, bool)
+        if uid:
+            mask &= columns.uid[:columns.n] == self._uids.get(uid)
+        if channel:
+            mask &= columns.channel[:columns.n] == self._channels.get(channel)
+        if after:
+            mask &= columns.time[:columns.n] >= time_to_micros(after)
+        if before:
+            mask &= columns.time[:columns.n] < time_to_micros(before)
+        rows = np.flatnonzero(mask)
+        if limit:
+            rows = rows[np.argsort(columns.time[rows])[::-1][:limit]]
+        return rows
+
+    def sample(self, uid=None, channel=None):
+        """
+        A random Record among the messages from a user ID and channel name, or None if there are none.
+        Takes constant time. Its text is None if it has been evicted.
+        """
+        columns = self._columns
+        if uid or channel:
+            key = (self._uids.get(uid) if uid else -1, self._channels.get(channel) if channel else -1)
+            if (uid and key[0] == -1) or (channel and key[1] == -1):
+                return None
+            rows = columns.rows.get(key, ())
+        else:
+            rows = range(columns.n)
+        if not rows:
+            return None
+        records, _ = self._read([rows[random.randrange(len(rows))]], Record._fields)
+        return records[0]
+
+    def frozen(self):
+        """
+        A copy of the cached messages which another thread may read while this cache keeps changing.
+        It is only for reading records: it can't be sampled.
+        """
+        copy = HistoryCache(self.max_text_bytes)
+        copy._uids.values = list(self._uids.values)
+        copy._channels.values = list(self._channels.values)
+        columns, copy_columns = self._columns, copy._columns
+        for name in ('uid', 'channel', 'time', 'text_start', 'text_length'):
+            setattr(copy_columns, name, getattr(columns, name)[:columns.n].copy())
+        copy_columns.text = bytes(columns.text)
+        copy_columns.text_base = columns.text_base
+        copy_columns.n = columns.n
+        copy.loaded = self.loaded
+        return copy
+
+    def records(self, batch_size=10000):
+        """Iterate over every cached message as a Record, reading evicted text from the database. Blocks."""
+        for start in range(0, len(self), batch_size):
+            records, missing = self._read(range(start, min(start + batch_size, len(self))), Record._fields)
+            if missing:
+                texts = _read_texts([records[i].time for i in missing])
+                for i in missing:
+                    records[i] = records[i]._replace(text=texts.get(records[i].time))
+            yield from records
+
+    def stream(self, uid=None, channel=None, after=None, before=None, limit=None, fields=Record._fields,
+               batch_size=1000):
+        """A CachedHistoryStream over the matching messages"""
+        return CachedHistoryStream(self, self.select(uid, channel, after, before, limit), fields, batch_size)
+
+    def _read(self, rows, fields):
+        """
+        Records for some rows, with the given fields and the time filled in.
+        Returns the Records and the positions of those whose text must be read from the database.
+        """
+        columns = self._columns
+        want_text = 'text' in fields
+        records = []
+        missing = []
+        for i in rows:
+            text = columns.text_at(i) if want_text else None
+            if want_text and text is None:
+                missing.append(len(records))
+            records.append(Record(
+                self._channels.values[columns.channel[i]] if 'channel' in fields else None,
+                self._uids.values[columns.uid[i]] if 'uid' in fields else None,
+                text,
+                micros_to_time(int(columns.time[i]))))
+        return records, missing
+
+    def stats(self):
+        """Number of messages, bytes used and number of messages whose text has been evicted"""
+        return len(self), self._columns.nbytes, self._evicted
+
+
+def _read_texts(timestamps):
+    return {r.time: r.text for r in read_messages(timestamps)}
+
+
+class CachedHistoryStream:
+
+    """Async iterator over Records from a HistoryCache, with the same interface as HistoryStream"""
+
+    def __init__(self, cache, rows, fields, batch_size):
+        self._cache = cache
+        self._rows = rows
+        self._fields = fields
+        self._batch_size = batch_size
+        self._position = 0
+        self._records = []
+        self._next = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._next == len(self._records):
+            if self._position >= len(self._rows):
+                raise StopAsyncIteration
+            await self._fill()
+        record = self._records[self._next]
+        self._next += 1
+        return record
+
+    async def _fill(self):
+        rows = self._rows[self._position:self._position + self._batch_size]
+        self._position += len(rows)
+        records, missing = self._cache._read(rows, self._fields)
+        if missing:
+            loop = asyncio.get_event_loop()
+            texts = await loop.run_in_executor(None, _read_texts, [records[i].time for i in missing])
+            for i in missing:
+                records[i] = records[i]._replace(text=texts.get(records[i].time))
+        else:
+            # Let other tasks run between batches
+            await asyncio.sleep(0)
+        if 'time' not in self._fields:
+            records = [r._replace(time=None) for r in records]
+        self._records = records
+        self._next = 0
+
+    def close(self):
+        self._position = len(self._rows)
+        self._records = []
+        self._next = 0
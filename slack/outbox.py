@@ -0,0 +1,124 @@
+"""Rate limited queue for outgoing messages"""
+import asyncio
+from collections import defaultdict, deque, namedtuple
+import logging
+import time
+
+from .rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+OutgoingMessage = namedtuple('OutgoingMessage', ['text', 'callback', 'queued'])
+
+
+class Outbox:
+
+    """
+    Queues outgoing messages per channel and sends them no faster than Slack allows.
+    Consecutive messages waiting for the same channel are merged into one,
+    unless they have a success callback or the result would be too long.
+    Messages which fail to send, for example while the websocket reconnects, are retried with backoff.
+    """
+
+    def __init__(self, send, rate=1, burst=1, max_length=4000, latency_samples=1000, retry_seconds=1,
+                 max_attempts=8):
+        """
+        Args:
+            send: Coroutine function (text, channel, callback) which actually sends a message
+            rate: Messages per second allowed in each channel
+            burst: Number of messages a channel may send at once after being idle
+            max_length: Longest message which merging may produce
+            latency_samples: Number of recent send latencies to keep
+            retry_seconds: Wait before the first retry of a failed send, doubled for each further retry up to 30
+            max_attempts: Number of times to try sending a message before giving up on it
+        """
+        self._send = send
+        self._rate = rate
+        self._burst = burst
+        self._max_length = max_length
+        self._queues = defaultdict(deque)
+        self._buckets = {}
+        self._senders = {}
+        self._latencies = deque(maxlen=latency_samples)
+        self._retry_seconds = retry_seconds
+        self._max_attempts = max_attempts
+        self.sent = 0
+        self.merged = 0
+
+    @property
+    def depth(self):
+        """Number of messages waiting to be sent"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def channel_depths(self):
+        """Number of messages waiting to be sent in each channel"""
+        return {channel: len(queue) for channel, queue in self._queues.items() if queue}
+
+    @property
+    def latencies(self):
+        """Recent times in seconds between a message being queued and being sent"""
+        return list(self._latencies)
+
+    def stats(self):
+        """Summary of queue depth and send latency"""
+        latencies = self.latencies
+        return {'depth': self.depth,
+                'sent': self.sent,
+                'merged': self.merged,
+                'mean_latency': sum(latencies) / len(latencies) if latencies else 0,
+                'max_latency': max(latencies) if latencies else 0}
+
+    def put(self, text, channel, callback=None):
+        """Queue a message to be sent to a channel"""
+        self._queues[channel].append(OutgoingMessage(text, callback, time.monotonic()))
+        if channel not in self._senders:
+            loop = asyncio.get_event_loop()
+            self._senders[channel] = loop.create_task(self._drain(channel))
+
+    async def _drain(self, channel):
+        if channel not in self._buckets:
+            self._buckets[channel] = TokenBucket(self._rate, capacity=self._burst)
+        bucket = self._buckets[channel]
+        queue = self._queues[channel]
+        attempts = 0
+        try:
+            while queue:
+                await bucket.acquire()
+                batch = self._take_batch(queue)
+                text = '\n'.join(message.text for message in batch)
+                try:
+                    await self._send(text, channel, batch[-1].callback)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    attempts += 1
+                    if attempts >= self._max_attempts:
+                        logger.exception('Giving up on a message to %s after %d attempts', channel, attempts)
+                        attempts = 0
+                        continue
+                    delay = min(self._retry_seconds * 2 ** (attempts - 1), 30)
+                    logger.warning('Failed to send message to %s, retrying in %s s', channel, delay, exc_info=True)
+                    queue.extendleft(reversed(batch))
+                    await asyncio.sleep(delay)
+                    continue
+                attempts = 0
+                now = time.monotonic()
+                self._latencies.extend(now - message.queued for message in batch)
+                self.sent += 1
+                self.merged += len(batch) - 1
+        finally:
+            del self._senders[channel]
+            if not queue:
+                del self._queues[channel]
+
+    def _take_batch(self, queue):
+        """Pop the next message, along with any following messages it can be merged with."""
+        batch = [queue.popleft()]
+        length = len(batch[0].text)
+        while batch[0].callback is None and queue:
+            following = queue[0]
+            length += 1 + len(following.text)
+            if following.callback is not None or length > self._max_length:
+                break
+            batch.append(queue.popleft())
+        return batch
@@ -1,29 +1,114 @@
 from functools import reduce
-from pyparsing import CaselessLiteral, Group, NoMatch, Optional
+from pyparsing import (And, CaselessLiteral, Each, FollowedBy, Forward, Group, Literal, MatchFirst, NoMatch, NotAny,
+                       OneOrMore, Optional, Or, ParseElementEnhance, ParserElement, SkipTo, ZeroOrMore)
+
+# Command grammars are re-tried against the same text whenever an earlier alternative fails part way through,
+# so memoizing sub-expression results pays off. This applies to every pyparsing grammar in the process.
+ParserElement.enablePackrat()
+
+
+def leading_keywords(expr):
+    """
+    Find the literal words which any match of expr must begin with.
+    Returns a set of lower case keywords, or None if expr can start some other way.
+    """
+    if isinstance(expr, Literal):  # Includes CaselessLiteral
+        keyword = getattr(expr, 'returnString', expr.match)
+        return {keyword.lower()} if keyword else None
+    elif isinstance(expr, And):
+        return leading_keywords(expr.exprs[0]) if expr.exprs else None
+    elif isinstance(expr, (MatchFirst, Or)):
+        keywords = set()
+        for alternative in expr.exprs:
+            alternative_keywords = leading_keywords(alternative)
+            if alternative_keywords is None:
+                return None
+            keywords |= alternative_keywords
+        return keywords or None
+    elif isinstance(expr, (Optional, ZeroOrMore, Forward, Each)):
+        # These may match nothing, match in any order, or change after registration
+        return None
+    elif isinstance(expr, (NotAny, FollowedBy, SkipTo)):
+        # Lookaheads consume nothing, NotAny rejects its keywords, and SkipTo starts anywhere
+        return None
+    elif isinstance(expr, (Group, OneOrMore, ParseElementEnhance)):
+        return leading_keywords(expr.expr) if expr.expr is not None else None
+    return None
 
 
 class SlackParser():
     def __init__(self, alert='!'):
+        self.alert = alert
         self.dm_expr_head = Optional(CaselessLiteral(alert))
         self.expr_head = CaselessLiteral('!')
         self.commands = []
-        self.reinit_exprs()
+        self._sequence = 0
+        # Keyword -> commands starting with it, and commands with no leading keyword
+        self._keyword_index = {}
+        self._unindexed = []
+        self._max_keyword_length = 0
+        self._candidate_exprs = {}
+        self._legacy_exprs = None
 
     def reinit_exprs(self):
         command = reduce(lambda acc, e: acc | e[1], self.commands, NoMatch())
         self.dm_expr = self.dm_expr_head + command
         self.expr = self.expr_head + command
+        self._legacy_exprs = (self.expr, self.dm_expr)
 
     def parse(self, s, dm=False):
-        return (self.dm_expr if dm else self.expr).parseString(s)
+        """Parse a command, only trying the grammars which could match its first word"""
+        candidates = self._candidates(self.command_text(s, dm))
+        key = tuple(sequence for _, sequence, _ in candidates)
+        if key not in self._candidate_exprs:
+            command = MatchFirst([expr for _, _, expr in candidates]) if candidates else NoMatch()
+            self._candidate_exprs[key] = (self.expr_head + command, self.dm_expr_head + command)
+        expr, dm_expr = self._candidate_exprs[key]
+        return (dm_expr if dm else expr).parseString(s)
+
+    def parse_legacy(self, s, dm=False):
+        """Parse a command by trying every registered grammar in turn"""
+        if self._legacy_exprs is None:
+            self.reinit_exprs()
+        expr, dm_expr = self._legacy_exprs
+        return (dm_expr if dm else expr).parseString(s)
 
     def add_command(self, expr, name, priority=0):
-        # TODO: Make this not bad
         add_expr = Group(expr).setResultsName(name)
+        # Commands are tried by descending priority, and newer commands go first among equals
+        self._sequence += 1
+        entry = (-priority, -self._sequence, add_expr)
         for i, (p, e) in enumerate(self.commands):
             if priority >= p:
                 self.commands.insert(i, (priority, add_expr))
                 break
         else:
             self.commands.append((priority, add_expr))
-        self.reinit_exprs()
+
+        keywords = leading_keywords(expr)
+        if keywords is None:
+            self._unindexed.append(entry)
+        else:
+            for keyword in keywords:
+                self._keyword_index.setdefault(keyword, []).append(entry)
+                self._max_keyword_length = max(self._max_keyword_length, len(keyword))
+        self._candidate_exprs = {}
+        self._legacy_exprs = None
+
+    def command_text(self, s, dm):
+        """Strip the alert character and whitespace the way the head expression would, or None if the head fails"""
+        s = s.lstrip()
+        head = self.alert if dm else '!'
+        if s.startswith(head):
+            return s[len(head):].lstrip()
+        return s if dm else None
+
+    def _candidates(self, text):
+        """Commands whose keyword is a prefix of text, plus unindexed commands, in priority order"""
+        if text is None:
+            return ()
+        prefix = text[:self._max_keyword_length].lower()
+        found = {entry[1]: entry for entry in self._unindexed}
+        for end in range(1, len(prefix) + 1):
+            found.update((entry[1], entry) for entry in self._keyword_index.get(prefix[:end], ()))
+        return tuple(sorted(found.values(), key=lambda entry: entry[:2]))
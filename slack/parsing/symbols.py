@@ -33,3 +33,6 @@ def flag(name):
 def flag_with_arg(name, argtype):
     dashes = '--' if len(name) > 1 else '-'
     return CaselessLiteral(dashes + name) + argtype.setResultsName(name)
+
+
+date = Regex(r'\d{4}-\d{2}-\d{2}')
@@ -0,0 +1,37 @@
+"""Token bucket rate limiting for Slack API calls"""
+import asyncio
+import time
+
+
+class TokenBucket:
+
+    """
+    Allows bursts of up to capacity calls, refilling at rate calls per second.
+    acquire() waits until a token is available.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self):
+        """Seconds until a token will be available"""
+        self._refill()
+        return max(0, (1 - self._tokens) / self.rate)
+
+    async def acquire(self):
+        """Wait for and consume one token"""
+        async with self._lock:
+            delay = self.wait_time()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.wait_time()
+            self._tokens -= 1
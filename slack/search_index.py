@@ -0,0 +1,154 @@
+"""Inverted index from words to the stored messages containing them"""
+from array import array
+import asyncio
+import logging
+import re
+
+import numpy as np
+
+from .history import HistoryStream, micros_to_time, Record, time_to_micros
+from .history_cache import Codes
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"\w+(?:'\w+)*")
+# Mentions, links and emoji, which would otherwise be split into noise words
+_MARKUP = re.compile(r'<[^>]*>|:[^\s:]*:')
+
+
+def tokenize(text):
+    """Lower case words in text, ignoring Slack markup"""
+    return _WORD.findall(_MARKUP.sub(' ', text or '').lower())
+
+
+class SearchIndex:
+
+    """
+    Each message gets a document number in the order it was added. Every word maps to an array of the document
+    numbers containing it, so the arrays stay sorted as messages are added and can be intersected with numpy.
+    User, channel and timestamp are kept per document for filtering. Text isn't kept: read matches from the database.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._uids = Codes()
+        self._channels = Codes()
+        self._uid = array('i')
+        self._channel = array('i')
+        self._time = array('q')
+        self._known = set()
+        self._postings = {}
+        # Messages added while load() runs, or None when it isn't running
+        self._pending = None
+
+    @property
+    def loading(self):
+        """Whether load() is running"""
+        return self._pending is not None
+
+    def __len__(self):
+        return len(self._time)
+
+    def add(self, uid, channel, text, timestamp):
+        """Index a message, unless one with the same timestamp already has been"""
+        if self._pending is not None:
+            self._pending.append(Record(channel, uid, text, timestamp))
+            return
+        micros = time_to_micros(timestamp)
+        if micros in self._known:
+            return
+        self._known.add(micros)
+        document = len(self._time)
+        self._uid.append(self._uids.encode(uid))
+        self._channel.append(self._channels.encode(channel))
+        self._time.append(micros)
+        for word in set(tokenize(text)):
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = array('I')
+            postings.append(document)
+
+    def add_records(self, records):
+        for r in records:
+            self.add(r.uid, r.channel, r.text, r.time)
+
+    async def load(self, cache=None, batch_size=1000):
+        """
+        Index the stored history, in an executor. Messages added meanwhile are indexed afterwards.
+        Args:
+            cache: A loaded HistoryCache to read the history from instead of the database
+        """
+        self._pending = []
+        loop = asyncio.get_event_loop()
+        try:
+            if cache is not None and cache.loaded:
+                index = await loop.run_in_executor(None, _build_index, cache.frozen().records())
+            else:
+                index = SearchIndex()
+                stream = HistoryStream({}, batch_size=batch_size)
+                try:
+                    batch = []
+                    async for r in stream:
+                        batch.append(r)
+                        if len(batch) == batch_size:
+                            await loop.run_in_executor(None, index.add_records, batch)
+                            batch = []
+                    await loop.run_in_executor(None, index.add_records, batch)
+                finally:
+                    stream.close()
+        except Exception:
+            self._pending = None
+            raise
+
+        self._uids, self._channels = index._uids, index._channels
+        self._uid, self._channel, self._time = index._uid, index._channel, index._time
+        self._known, self._postings = index._known, index._postings
+        pending, self._pending = self._pending, None
+        self.add_records(pending)
+        self.loaded = True
+        logger.info('Search index loaded %d messages with %d distinct words', len(self), len(self._postings))
+
+    def search(self, text, uid=None, channel=None, after=None, before=None, limit=10):
+        """
+        Find the messages containing every word in text.
+        Args:
+            uid, channel: Only include messages from this user ID and channel name
+            after, before: Only include messages with timestamps in [after, before)
+            limit: Maximum number of timestamps to return
+        Returns:
+            The number of matching messages, and the timestamps of the newest ones, newest first
+        """
+        postings = [self._postings.get(word) for word in set(tokenize(text))]
+        if not postings or not all(postings):
+            return 0, []
+        postings.sort(key=len)
+        # Views of the arrays must not outlive this call, or the arrays can't grow
+        documents = np.frombuffer(postings[0], np.uint32)
+        for p in postings[1:]:
+            documents = np.intersect1d(documents, np.frombuffer(p, np.uint32), assume_unique=True)
+            if not len(documents):
+                return 0, []
+
+        times = np.frombuffer(self._time, np.int64)[documents]
+        mask = np.ones(len(documents), bool)
+        if uid:
+            mask &= np.frombuffer(self._uid, np.int32)[documents] == self._uids.get(uid)
+        if channel:
+            mask &= np.frombuffer(self._channel, np.int32)[documents] == self._channels.get(channel)
+        if after:
+            mask &= times >= time_to_micros(after)
+        if before:
+            mask &= times < time_to_micros(before)
+        times = times[mask]
+        newest = np.sort(times)[::-1][:limit]
+        return len(times), [micros_to_time(int(m)) for m in newest]
+
+    def stats(self):
+        """Number of messages, distinct words and word occurrences"""
+        return len(self), len(self._postings), sum(len(p) for p in self._postings.values())
+
+
+def _build_index(records):
+    index = SearchIndex()
+    index.add_records(records)
+    return index
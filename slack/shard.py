@@ -0,0 +1,365 @@
+"""
+Running bots in worker processes behind a single Slack connection.
+
+The ingest process (ShardedSlack) owns the websocket. It forwards each message only to the workers which
+registered a command keyword matching it, or an unfiltered handler watching its channel.
+Each worker process (WorkerSlack) runs a group of bots, handles forwarded events with the usual
+parsing and handler logic, and sends the Commands they return back to the ingest process to execute.
+"""
+import asyncio
+from functools import partial
+import logging
+import os
+import sys
+import tempfile
+
+from .bus import BusConnection
+from .command import Command, DeleteCommand, MessageCommand, ReactCommand, UploadCommand
+from .parsing.slack_parser import leading_keywords
+from .slack_api import Handler, Slack
+
+logger = logging.getLogger(__name__)
+
+
+def _portable(command):
+    """Whether a command can be executed by the ingest process instead of the worker which returned it"""
+    if isinstance(command, MessageCommand):
+        return command.callback is None
+    return isinstance(command, (DeleteCommand, ReactCommand, UploadCommand))
+
+
+class WorkerSlack(Slack):
+
+    """
+    Slack for a worker process. Receives events from the ingest process instead of a websocket.
+    Commands which only act on Slack are sent back to the ingest process, others (like HistoryCommand)
+    run here.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        # Messages are stored by the ingest process, so a cache or index here would go stale
+        self.history_cache = None
+        self.search_index = None
+        self.bus = None
+        # What the ingest process needs to route events here and to list these handlers in help messages
+        self._filtered_summary = []
+        self._unfiltered_summary = []
+        self._callbacks = {}
+        self._next_callback = 0
+
+    def register_handler(self, func, data, bot=None):
+        super().register_handler(func, data, bot)
+        if data.expr is None:
+            self._unfiltered_summary.append((data.name, data.channels))
+        else:
+            keywords = leading_keywords(data.expr)
+            self._filtered_summary.append(
+                (data.name, sorted(keywords) if keywords else None, data.channels, data.admin, data.doc))
+
+    async def run_worker(self, socket_path):
+        """Connect to the ingest process and handle events until it disconnects"""
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        self.bus = BusConnection(reader, writer, self._on_bus_message)
+        self.bus.notify({'op': 'hello',
+                         'pid': os.getpid(),
+                         'bots': sorted(type(bot).__name__ for bot in self._bot_states),
+                         'filtered': self._filtered_summary,
+                         'unfiltered': self._unfiltered_summary})
+        loop = asyncio.get_event_loop()
+        lag_probe = loop.create_task(self.stats.probe_loop_lag())
+        try:
+            await self.bus.serve()
+        finally:
+            lag_probe.cancel()
+
+    async def _on_bus_message(self, message):
+        op = message['op']
+        if op == 'ids':
+            self.ids = message['ids']
+            self.admins = message['admins']
+            self._build_routes()
+            self._start_warm_ups()
+        elif op == 'event':
+            return await self._handle_forwarded(message['event'], message['phase'])
+        elif op == 'callback':
+            collector = {'_commands': []}
+            callback = self._callbacks.pop(message['callback'])
+            await self._exhaust_command(callback(), collector)
+            return collector['_commands']
+        else:
+            logger.warning('Unknown bus message %s', op)
+
+    async def _handle_forwarded(self, event, phase):
+        """Handle an event as a command or with the unfiltered handlers, and return the commands to execute"""
+        event['_commands'] = []
+        user = event['user']
+        channel = event['channel']
+        is_dm = channel[0] == 'D'
+        channel_name = None if is_dm else self.ids.cname(channel)
+        matched = False
+        with self.stats.timer('event', phase):
+            if phase == 'command':
+                matched = await self._handle_command(event, user, channel_name, is_dm)
+            else:
+                await self._handle_unfiltered(event, user, channel, channel_name)
+        return {'matched': matched, 'commands': event.pop('_commands')}
+
+    async def _exhaust_command(self, command, event, source=None):
+        while command:
+            if isinstance(command, Command) and _portable(command):
+                if event is not None and '_commands' in event:
+                    event['_commands'].append(command)
+                else:
+                    # Not part of handling a forwarded event, e.g. a warm up or a late callback
+                    self.bus.notify({'op': 'commands', 'commands': [command], 'event': event})
+                command = None
+            elif isinstance(command, Command):
+                with self.stats.timer('command', source or type(command).__name__):
+                    command = await command.execute(self, event)
+            else:
+                for com in command:
+                    await self._exhaust_command(com, event, source)
+                command = None
+
+    def _help_command(self, user):
+        # The ingest process sends help once no worker has matched the message
+        return None
+
+    async def send(self, message, channel, success_callback=None):
+        callback_id = None
+        if success_callback:
+            self._next_callback += 1
+            callback_id = self._next_callback
+            self._callbacks[callback_id] = success_callback
+        self.bus.notify({'op': 'send', 'text': message, 'channel': channel, 'callback': callback_id})
+
+    async def store_message(self, user, channel, text, timestamp):
+        # The ingest process stores every message
+        pass
+
+    async def flush_history(self):
+        await self.bus.request({'op': 'flush'})
+
+    async def dm_channel(self, user):
+        # The ingest process opens the room, so that only it writes the id cache, and shares the new ids
+        if self.ids.has_dm(user):
+            return self.ids.dmid(user)
+        return await self.bus.request({'op': 'dm', 'user': user})
+
+    async def random_message(self, uid=None, channel=None):
+        return await self.bus.request({'op': 'sample', 'uid': uid, 'channel': channel})
+
+    async def search(self, text, uid=None, channel=None, after=None, before=None, limit=10):
+        return await self.bus.request({'op': 'search', 'text': text, 'uid': uid, 'channel': channel,
+                                       'after': after, 'before': before, 'limit': limit})
+
+
+class _RemoteWorker:
+
+    """The ingest process's view of a worker: its connection, and the handlers it registered"""
+
+    def __init__(self):
+        self.conn = None
+        self.pid = None
+        self.bots = []
+        self._keywords = ()
+        self._unindexed = False
+        self._unfiltered_channels = []
+
+    def register(self, hello):
+        self.pid = hello['pid']
+        self.bots = hello['bots']
+        keywords = set()
+        for name, handler_keywords, channels, admin, doc in hello['filtered']:
+            if handler_keywords is None:
+                self._unindexed = True
+            else:
+                keywords.update(handler_keywords)
+        self._keywords = tuple(keywords)
+        self._unfiltered_channels = [channels for name, channels in hello['unfiltered']]
+
+    def may_handle(self, text):
+        """Whether text, with the alert character stripped and lower cased, could be one of this worker's commands"""
+        return text is not None and (self._unindexed or text.startswith(self._keywords))
+
+    def watches(self, channel_name):
+        """Whether any of this worker's unfiltered handlers watch a channel"""
+        return any(channels is None or channel_name in channels for channels in self._unfiltered_channels)
+
+
+class _RemoteCallbackCommand(Command):
+
+    """Runs a worker's message success callback there and returns the commands it produced"""
+
+    def __init__(self, worker, callback_id):
+        self._worker = worker
+        self._callback_id = callback_id
+
+    async def execute(self, slack, event=None):
+        return await self._worker.conn.request({'op': 'callback', 'callback': self._callback_id})
+
+
+class ShardedSlack(Slack):
+
+    """Slack for the ingest process. Owns the websocket and forwards events to worker processes."""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._workers = []
+        self._registered = asyncio.Queue()
+        self._server = None
+        self._processes = []
+
+    async def start_workers(self, groups, worker_argv, timeout=300):
+        """
+        Launch a worker process for each group of bot module names and wait for them all to register.
+        Raises RuntimeError if a worker exits before registering, or they haven't all registered within timeout.
+        Args:
+            groups: Lists of bot module names
+            worker_argv: Arguments to the Python interpreter which start a worker, before the socket and bots
+            timeout: Seconds to wait for every worker to register
+        """
+        # Only this user can reach the socket
+        path = os.path.join(tempfile.mkdtemp(prefix='emoter-'), 'bus.sock')
+        self._server = await asyncio.start_unix_server(self._accept, path=path)
+        for group in groups:
+            self._processes.append(await asyncio.create_subprocess_exec(
+                sys.executable, *worker_argv, '--worker_socket', path, '--worker_bots', ','.join(group)))
+        try:
+            await self._wait_for_workers(timeout)
+        except RuntimeError:
+            for process in self._processes:
+                if process.returncode is None:
+                    process.kill()
+            raise
+
+    async def _wait_for_workers(self, timeout):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        # Exit of each process which hasn't registered yet
+        exits = {process.pid: loop.create_task(process.wait()) for process in self._processes}
+        try:
+            while exits:
+                registered = loop.create_task(self._registered.get())
+                done, _ = await asyncio.wait([registered] + list(exits.values()),
+                                             timeout=max(deadline - loop.time(), 0),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if registered in done:
+                    worker = registered.result()
+                    exited = exits.pop(worker.pid, None)
+                    if exited is not None:
+                        exited.cancel()
+                    logger.info('Worker registered with %s', ', '.join(worker.bots))
+                    continue
+                registered.cancel()
+                for pid, exited in exits.items():
+                    if exited in done:
+                        raise RuntimeError('Worker process {} exited with code {} before registering'.format(
+                            pid, exited.result()))
+                raise RuntimeError('{} workers did not register within {} s'.format(len(exits), timeout))
+        finally:
+            for exited in exits.values():
+                exited.cancel()
+
+    async def _accept(self, reader, writer):
+        worker = _RemoteWorker()
+        worker.conn = BusConnection(reader, writer, partial(self._on_worker_message, worker))
+        await worker.conn.serve()
+        if worker in self._workers:
+            self._workers.remove(worker)
+            logger.error('Lost worker running %s', ', '.join(worker.bots))
+
+    async def _on_worker_message(self, worker, message):
+        op = message['op']
+        if op == 'hello':
+            worker.register(message)
+            for name, keywords, channels, admin, doc in message['filtered']:
+                # Only used for help messages
+                self._handlers.filtered[name] = Handler(
+                    name=name, func=None, doc=doc, channels=channels, admin=admin, include_timestamp=False,
+                    bot=None, requires_ready=False)
+            self._workers.append(worker)
+            if self.ids is not None:
+                self._share_ids(worker)
+            self._registered.put_nowait(worker)
+        elif op == 'commands':
+            await self._exhaust_command(message['commands'], message['event'])
+        elif op == 'send':
+            callback = (partial(_RemoteCallbackCommand, worker, message['callback'])
+                        if message['callback'] is not None else None)
+            await self.send(message['text'], message['channel'], callback)
+        elif op == 'flush':
+            await self.flush_history()
+        elif op == 'search':
+            return await self.search(message['text'], message['uid'], message['channel'],
+                                     message['after'], message['before'], message['limit'])
+        elif op == 'sample':
+            return await self.random_message(message['uid'], message['channel'])
+        elif op == 'dm':
+            return await self.dm_channel(message['user'])
+        else:
+            logger.warning('Unknown bus message %s', op)
+
+    async def connect(self):
+        url = await super().connect()
+        for worker in self._workers:
+            self._share_ids(worker)
+        return url
+
+    def _on_ids_changed(self):
+        super()._on_ids_changed()
+        for worker in self._workers:
+            self._share_ids(worker)
+
+    def _share_ids(self, worker):
+        worker.conn.notify({'op': 'ids', 'ids': self.ids, 'admins': self.admins})
+
+    async def _handle_message(self, event):
+        user = event['user']
+        channel = event['channel']
+        is_dm = channel[0] == 'D'
+        channel_name = None if is_dm else self.ids.cname(channel)
+
+        matched = False
+        if is_dm or event['text'][0] == self._config.alert:
+            text = self._parser.command_text(event['text'], is_dm)
+            text = text.lower() if text is not None else None
+            results = await asyncio.gather(*(self._forward(worker, event, 'command')
+                                             for worker in self._workers if worker.may_handle(text)))
+            matched = any(results)
+            if is_dm and not matched:
+                await self._exhaust_command(self._help_command(user), event)
+
+        if not is_dm and not matched:
+            await asyncio.gather(*(self._forward(worker, event, 'unfiltered')
+                                   for worker in self._workers if worker.watches(channel_name)))
+            await self.store_message(
+                user=user,
+                channel=channel,
+                text=event['text'],
+                timestamp=event['ts'])
+
+    async def _forward(self, worker, event, phase):
+        """Have a worker handle an event, execute the commands it returns and return whether it matched"""
+        try:
+            result = await worker.conn.request({'op': 'event', 'phase': phase, 'event': event})
+        except (ConnectionError, RuntimeError) as e:
+            logger.warning('Worker running %s failed to handle an event: %s', ', '.join(worker.bots), e)
+            return False
+        await self._exhaust_command(result['commands'], event)
+        return result['matched']
+
+    async def shutdown(self):
+        await super().shutdown()
+        if self._server is not None:
+            self._server.close()
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.conn.close()
+        # Workers exit once their connection closes
+        for process in self._processes:
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except asyncio.TimeoutError:
+                process.kill()
@@ -4,31 +4,56 @@ from collections import ChainMap, defaultdict, namedtuple
 from itertools import chain
 import json
 import logging
+import os
+import time
 
 from pyparsing import ParseException
-import requests
 from slack.command import Command
 from slack.parsing import SlackParser
-from util import handle_async_exception, make_request
+from util import handle_async_exception
 import websockets
 
 from .command import MessageCommand
-from .history import HistoryDoc
+from .dispatch import EventDispatcher
+from .event_log import EventRecorder
+from .history import (clear_history, HistoryBuffer, HistoryDoc, history_query, HistorySyncDoc, insert_history,
+                      read_messages, Record, sample_message)
+from .history_cache import HistoryCache
+from .outbox import Outbox
+from .rate_limit import TokenBucket
+from .search_index import SearchIndex
+from .stats import LatencyHistogram, Stats
+from .web_client import WebClient
 
 logger = logging.getLogger(__name__)
 
-Handler = namedtuple('Handler', ['name', 'func', 'doc', 'channels', 'admin', 'include_timestamp'])
+Handler = namedtuple('Handler', ['name', 'func', 'doc', 'channels', 'admin', 'include_timestamp', 'bot',
+                                 'requires_ready'])
 
 
 UnfilteredHandler = namedtuple(
-    'UnfilteredHandler', ['name', 'func', 'doc', 'channels', 'include_timestamp'])
+    'UnfilteredHandler', ['name', 'func', 'doc', 'channels', 'include_timestamp', 'bot', 'requires_ready'])
 
 
 Handlers = namedtuple('Handlers', ['filtered', 'unfiltered'])
 
 
 SlackConfig = namedtuple('SlackConfig',
-                         ['token', 'admin_token', 'alert', 'name', 'load_history', 'clear_commands', 'admins'])
+                         ['token', 'admin_token', 'alert', 'name', 'load_history', 'clear_commands', 'admins',
+                          'event_workers', 'max_queued_events', 'id_cache', 'sync_history',
+                          'history_concurrency', 'history_batch_size', 'history_flush_seconds',
+                          'messages_per_second', 'handler_timeout', 'record_events', 'base_url',
+                          'history_cache_bytes', 'markov_snapshot'])
+SlackConfig.__new__.__defaults__ = (8, 1000, 'slack_ids.json', False, 4, 100, 5, 1, 30, None, None, 64 * 2 ** 20,
+                                    None)
+
+# Slack's history methods are rate limit tier 3: around 50 requests per minute
+HISTORY_REQUESTS_PER_SECOND = 50 / 60
+
+# Bot readiness states
+WARMING_UP = 'warming up'
+READY = 'ready'
+FAILED = 'failed'
 
 
 def is_message(event, no_channel=False):
@@ -60,41 +85,103 @@ class SlackIds:
 
     """Helper class for holding user, channel and room IDs."""
 
-    def __init__(self, token, channels, users, groups):
+    def __init__(self, channels=(), users=(), groups=(), ims=()):
         """
         Args:
-            token: Slack token. Used to get DM room IDs
             channels: 'channels' from body of response to rtm.start API call
             users: 'users' from body of response to rtm.start API call
             groups: 'groups' from body of response to rtm.start API call
+            ims: 'ims' from body of response to rtm.start API call
         """
-        self._c_name_to_id = {c['name']: c['id']
-                              for c in chain(channels, groups)}
-        self._c_id_to_name = {c['id']: c['name']
-                              for c in chain(channels, groups)}
-        self._u_name_to_id = {u['name']: u['id'] for u in users}
-        self._u_id_to_name = {u['id']: u['name'] for u in users}
-        self._disp_name_to_u_id = {u['profile']['display_name_normalized']: u['id'] for u in users}
-        self._u_id_to_disp_name = {v: k for k, v in self._disp_name_to_u_id.items()}
-        print(self._u_name_to_id)
-
+        self._c_name_to_id = {}
+        self._c_id_to_name = {}
+        self._u_name_to_id = {}
+        self._u_id_to_name = {}
+        self._disp_name_to_u_id = {}
+        self._u_id_to_disp_name = {}
         self._u_id_to_dm = {}
         self._dm_to_uid = {}
-
-        for u_id in self._u_name_to_id.values():
-            response = requests.get(
-                Slack.base_url + 'im.open',
-                params={'token': token, 'user': u_id})
-            body = response.json()
-            if body['ok'] is False and body['error'] in {'cannot_dm_bot', 'user_disabled'}:
-                pass
-            elif body['ok']:
-                cid = body['channel']['id']
-                self._u_id_to_dm[u_id] = cid
-                self._dm_to_uid[cid] = u_id
-            else:
-                print(body)
-                raise ValueError
+        # Users whose DM room can't be opened, so im.open isn't requested for them again
+        self._no_dm = set()
+        self.update(channels, users, groups, ims)
+
+    def update(self, channels, users, groups, ims=()):
+        """Merge the contents of an rtm.start response into the registry"""
+        for c in chain(channels, groups):
+            self.add_channel(cname=c['name'], cid=c['id'])
+        for u in users:
+            self.add_user(uname=u['name'], uid=u['id'])
+            disp_name = u['profile']['display_name_normalized']
+            self._disp_name_to_u_id[disp_name] = u['id']
+            self._u_id_to_disp_name[u['id']] = disp_name
+        for im in ims:
+            if im.get('user'):
+                self.add_dm(uid=im['user'], dmid=im['id'])
+
+    @classmethod
+    def load(cls, path):
+        """Load a registry saved by save(). Returns an empty registry if the file is missing, unreadable or stale."""
+        ids = cls()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            ids._c_name_to_id = dict(data['channels'])
+            ids._u_name_to_id = dict(data['users'])
+            ids._disp_name_to_u_id = dict(data['display_names'])
+            ids._u_id_to_dm = dict(data['dms'])
+            ids._no_dm = set(data.get('no_dms', ()))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # Missing, corrupt or from an older layout
+            return cls()
+        ids._c_id_to_name = {v: k for k, v in ids._c_name_to_id.items()}
+        ids._u_id_to_name = {v: k for k, v in ids._u_name_to_id.items()}
+        ids._u_id_to_disp_name = {v: k for k, v in ids._disp_name_to_u_id.items()}
+        ids._dm_to_uid = {v: k for k, v in ids._u_id_to_dm.items()}
+        return ids
+
+    def save(self, path):
+        """Write the registry to a JSON file"""
+        data = {'channels': self._c_name_to_id,
+                'users': self._u_name_to_id,
+                'display_names': self._disp_name_to_u_id,
+                'dms': self._u_id_to_dm,
+                'no_dms': sorted(self._no_dm)}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    async def open_dms(self, client, concurrency=10):
+        """
+        Look up the DM room ID for every user who doesn't have one yet.
+        Args:
+            client: WebClient used to call im.open
+            concurrency: Maximum number of im.open requests in flight
+        """
+        limit = asyncio.Semaphore(concurrency)
+
+        async def open_one(u_id):
+            async with limit:
+                await self.open_dm(client, u_id)
+
+        missing = [u_id for u_id in self._u_id_to_name if u_id not in self._u_id_to_dm and u_id not in self._no_dm]
+        if missing:
+            logger.info('Opening DMs for %d users', len(missing))
+            await asyncio.gather(*(open_one(u_id) for u_id in missing))
+
+    async def open_dm(self, client, u_id):
+        """Look up the DM room ID for a single user. Returns None if the user can't be messaged."""
+        body = await client.get('im.open', {'user': u_id})
+        if body['ok'] is False and body['error'] in {'cannot_dm_bot', 'user_disabled'}:
+            self._no_dm.add(u_id)
+            return None
+        elif body['ok']:
+            cid = body['channel']['id']
+            self.add_dm(uid=u_id, dmid=cid)
+            return cid
+        else:
+            print(body)
+            raise ValueError
 
     @property
     def channel_ids(self):
@@ -104,7 +191,7 @@ class SlackIds:
     @property
     def dm_ids(self):
         """Use for iterating over all DM conversations"""
-        return self._dm_to_ddisp_nameisp_name.disp_namekeys()
+        return self._dm_to_uid.keys()
 
     def add_channel(self, cname, cid):
         """Add a channel to ID registry"""
@@ -112,10 +199,19 @@ class SlackIds:
         self._c_id_to_name[cid] = cname
 
     def add_user(self, uname, uid):
-        """Add a channel to ID registry"""
+        """Add a user to ID registry"""
         self._u_name_to_id[uname] = uid
         self._u_id_to_name[uid] = uname
 
+    def add_dm(self, uid, dmid):
+        """Add a DM room to ID registry"""
+        self._u_id_to_dm[uid] = dmid
+        self._dm_to_uid[dmid] = uid
+
+    def has_dm(self, uid):
+        """Check whether the DM room for a user is known"""
+        return uid in self._u_id_to_dm
+
     def uid(self, uid):
         """Translate username to user ID"""
         return self._u_name_to_id[uid]
@@ -150,35 +246,125 @@ class Slack:
         self._config = config
 
         self._handlers = Handlers(filtered={}, unfiltered=[])
+        # Channel ID -> unfiltered handlers which watch that channel
+        self._routes = {}
         self._parser = SlackParser(self._config.alert)
         self._loaded_commands = []
+        # Bot -> readiness state
+        self._bot_states = {}
+        self._warm_ups_started = False
+        self._sync_task = None
         self._message_id = 0
         self._response_callbacks = {}
-
+        self._dispatcher = EventDispatcher(
+            self._handle_event,
+            workers=self._config.event_workers,
+            max_queued=self._config.max_queued_events)
+
+        self.web = WebClient(self._config.base_url or Slack.base_url, self._config.token)
+        self._recorder = EventRecorder(self._config.record_events) if self._config.record_events else None
+        self._history_limiter = TokenBucket(HISTORY_REQUESTS_PER_SECOND, capacity=5)
+        self.stats = Stats()
+        self.outbox = Outbox(self._send_now, rate=self._config.messages_per_second)
+        self._history_buffer = HistoryBuffer(
+            max_size=self._config.history_batch_size,
+            max_age=self._config.history_flush_seconds)
+        # Serves HistoryCommands once loaded. Disabled when history_cache_bytes is 0.
+        self.history_cache = (HistoryCache(self._config.history_cache_bytes)
+                              if self._config.history_cache_bytes else None)
+        self.search_index = SearchIndex()
         self.ids = None
         self.admins = set()
         self.socket = None
 
+    @property
+    def config(self):
+        """The SlackConfig, for bots which take settings from it"""
+        return self._config
+
     def preload_commands(self, commands):
         """
-        Use this to register commands which will run once Slack connects,
-        before the connection exists.
+        Use this to register commands which will run in the background once Slack first connects.
         """
         self._loaded_commands.extend(commands)
 
+    def register_bot(self, bot):
+        """Track a bot's readiness. Bots with a warm_up method are warming up until it has finished."""
+        if bot not in self._bot_states:
+            self._bot_states[bot] = WARMING_UP if hasattr(bot, 'warm_up') else READY
+
+    def bot_state(self, bot):
+        """One of WARMING_UP, READY or FAILED"""
+        return self._bot_states.get(bot, READY)
+
+    def is_ready(self, bot):
+        return self.bot_state(bot) == READY
+
+    def _start_warm_ups(self):
+        """Launch every bot's warm up, and any preloaded commands, without waiting for them"""
+        if self._warm_ups_started:
+            return
+        self._warm_ups_started = True
+        loop = asyncio.get_event_loop()
+        commands, self._loaded_commands = self._loaded_commands, []
+        loop.create_task(handle_async_exception(self._run_warm_ups, commands))
+
+    async def _run_warm_ups(self, commands):
+        """
+        Load the history cache first, so that the search index and the bots' warm ups read the history from it
+        instead of each reading the whole collection.
+        """
+        loop = asyncio.get_event_loop()
+        if self.history_cache is not None:
+            try:
+                await self.history_cache.load()
+            except Exception:
+                logger.exception('Failed to load the history cache')
+        if self.search_index is not None:
+            loop.create_task(handle_async_exception(self.search_index.load, self.history_cache))
+        for bot, state in self._bot_states.items():
+            if state == WARMING_UP:
+                loop.create_task(self._warm_up(bot))
+        if commands:
+            logger.info('Running %d preloaded commands', len(commands))
+            await self._exhaust_command(commands, None)
+
+    async def _warm_up(self, bot):
+        name = type(bot).__name__
+        try:
+            with self.stats.timer('warm up', name):
+                await bot.warm_up(self)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('%s failed to warm up', name)
+            self._bot_states[bot] = FAILED
+        else:
+            logger.info('%s is ready', name)
+            self._bot_states[bot] = READY
+
     async def connect(self):
         """Connects to Slack, loads IDs, and returns the websocket URL."""
-        response = requests.get(
-            Slack.base_url + 'rtm.start', params={'token': self._config.token})
-        body = response.json()
-        self.ids = SlackIds(
-            self._config.token, body['channels'], body['users'], body['groups'])
+        body = await self.web.get('rtm.start')
+        if self._recorder:
+            self._recorder.record_start(body)
+        if self.ids is None:
+            self.ids = SlackIds.load(self._config.id_cache)
+        self.ids.update(body['channels'], body['users'], body['groups'], body.get('ims', []))
+        await self.ids.open_dms(self.web)
+        self.ids.save(self._config.id_cache)
+        self._build_routes()
         for admin_name in self._config.admins:
             self.admins.add(self.ids.uid(admin_name))
         if self._config.load_history:
             await self._load_history()
             self._config = SlackConfig(
                 **ChainMap({'load_history': False}, self._config._asdict()))
+        elif self._config.sync_history and (self._sync_task is None or self._sync_task.done()):
+            # Runs after every (re)connect so that messages missed while disconnected are picked up.
+            # Only one sync runs at a time, so checkpoints can't be written out of order.
+            loop = asyncio.get_event_loop()
+            self._sync_task = loop.create_task(handle_async_exception(self._sync_history))
         if self._config.clear_commands:
             loop = asyncio.get_event_loop()
             loop.create_task(handle_async_exception(self._clear_commands))
@@ -189,90 +375,162 @@ class Slack:
 
     async def run(self):
         """Main loop"""
+        self._dispatcher.start()
+        loop = asyncio.get_event_loop()
+        lag_probe = loop.create_task(self.stats.probe_loop_lag())
+        try:
+            await self._run_connections()
+        finally:
+            lag_probe.cancel()
+
+    async def _run_connections(self):
         while True:
             logger.info('Connecting to websocket')
             websocket_url = await self.connect()
+            # After the first connect, so warm ups see any history it loaded
+            self._start_warm_ups()
             try:
                 async with websockets.connect(websocket_url) as self.socket:
-                    logger.info('Running %d preloaded commands', len(self._loaded_commands))
-
-                    for command in self._loaded_commands:
-                        await self._exhaust_command(command, None)
-                    self._loaded_commands = []
-
                     while True:
                         command = None
                         event = await self.get_event()
                         if 'subtype' not in event or event['subtype'] != 'message_deleted':
                             print('Got event', event)
                         if is_message(event):
-                            await self._handle_message(event)
+                            event['_received'] = time.perf_counter()
+                            await self._dispatcher.put(event['channel'], event)
                         elif is_response(event):
-                            await self._handle_response(event)
+                            await self._dispatcher.put(self._response_channel(event), event)
                         elif is_group_join(event):
                             cname = event['channel']['name']
                             cid = event['channel']['id']
                             self.ids.add_channel(cname=cname, cid=cid)
+                            self._route_channel(cid)
+                            self._on_ids_changed()
                         elif is_team_join(event):
                             uname = event['user']['name']
                             uid = event['user']['id']
                             self.ids.add_user(uname=uname, uid=uid)
+                            self._on_ids_changed()
             except websockets.exceptions.ConnectionClosed:
                 print('Websocket closed')
 
+    def _on_ids_changed(self):
+        """Called after a channel, user or DM room is added to self.ids while connected"""
+        self.ids.save(self._config.id_cache)
+
+    async def _handle_event(self, event):
+        """Called by the dispatcher for each queued event"""
+        start = time.perf_counter()
+        if is_response(event):
+            await self._handle_response(event)
+            kind, description = 'response', 'response to {}'.format(event['reply_to'])
+        else:
+            await self._handle_message(event)
+            kind, description = 'message', '[{}] {}'.format(event['channel'], event['text'][:50])
+        end = time.perf_counter()
+        self.stats.record('event', kind, end - start)
+        self.stats.record_event(description, end - start)
+        if '_received' in event:
+            # Includes time spent waiting in the dispatcher queue
+            self.stats.record('event', 'received to handled', end - event['_received'])
+
+    def _response_channel(self, event):
+        """Channel which a response event belongs to, used to order it with that channel's messages"""
+        if event['reply_to'] in self._response_callbacks:
+            return self._response_callbacks[event['reply_to']][1]
+        return None
+
     async def _handle_message(self, event):
         user = event['user']
         channel = event['channel']
         is_dm = channel[0] == 'D'
         channel_name = None if is_dm else self.ids.cname(channel)
 
+        matched = False
         if is_dm or event['text'][0] == self._config.alert:
-            try:
-                parsed = self._parser.parse(event['text'], dm=is_dm)
-                name, = parsed.keys()
-                handler = self._handlers.filtered[name]
-            except ParseException:
-                parsed = None
-            # Only print help message for DMs
-            if is_dm and not (parsed and name in self._handlers.filtered):
-                command = (MessageCommand(channel=None,
-                                          user=user,
-                                          text=self._help_message(user))
-                           if is_dm else None)
-            elif (parsed and
-                  (is_dm or handler.channels is None or channel_name in handler.channels)):
-                kwargs = {'timestamp': event['ts']} if handler.include_timestamp else {}
-                if not handler.admin or user in self.admins:
-                    command = await handler.func(user=user,
-                                                 in_channel=channel_name,
-                                                 parsed=parsed[name], **kwargs)
-                else:
-                    command = MessageCommand(
-                        channel=channel_name, user=user, text='That command is admin only.')
-            else:
-                command = None
-            await self._exhaust_command(command, event)
-        else:
-            parsed = None
-
-        if not is_dm and parsed is None:
-            for handler in self._handlers.unfiltered:
-                if (handler.channels is None
-                        or channel_name in handler.channels):
-                    kwargs = {'timestamp': event['ts']} if handler.include_timestamp else {}
-                    command = await handler.func(
-                        user=user,
-                        in_channel=channel_name,
-                        message=event['text'],
-                        **kwargs)
-                    await self._exhaust_command(command, event)
+            matched = await self._handle_command(event, user, channel_name, is_dm)
 
+        if not is_dm and not matched:
+            await self._handle_unfiltered(event, user, channel, channel_name)
             await self.store_message(
                 user=user,
                 channel=channel,
                 text=event['text'],
                 timestamp=event['ts'])
 
+    async def _handle_command(self, event, user, channel_name, is_dm):
+        """Parse a message as a command and run its handler. Returns whether it parsed."""
+        start = time.perf_counter()
+        try:
+            parsed = self._parser.parse(event['text'], dm=is_dm)
+            name, = parsed.keys()
+            handler = self._handlers.filtered[name]
+        except ParseException:
+            parsed = None
+        self.stats.record('parse', name if parsed else 'no match', time.perf_counter() - start)
+        source = None
+        # Only print help message for DMs
+        if is_dm and not (parsed and name in self._handlers.filtered):
+            command = self._help_command(user)
+        elif (parsed and
+              (is_dm or handler.channels is None or channel_name in handler.channels)):
+            kwargs = {'timestamp': event['ts']} if handler.include_timestamp else {}
+            if handler.requires_ready and not self.is_ready(handler.bot):
+                command = MessageCommand(channel=channel_name, user=user, text=self._not_ready_message(handler))
+            elif not handler.admin or user in self.admins:
+                source = handler.name
+                with self.stats.timer('handler', handler.name):
+                    command = await handler.func(user=user,
+                                                 in_channel=channel_name,
+                                                 parsed=parsed[name], **kwargs)
+            else:
+                command = MessageCommand(
+                    channel=channel_name, user=user, text='That command is admin only.')
+        else:
+            command = None
+        await self._exhaust_command(command, event, source)
+        return parsed is not None
+
+    def _help_command(self, user):
+        return MessageCommand(channel=None, user=user, text=self._help_message(user))
+
+    async def _handle_unfiltered(self, event, user, channel, channel_name):
+        """Pass a message which isn't a command to every unfiltered handler watching its channel"""
+        handlers = self._routes[channel] if channel in self._routes else self._route_channel(channel)
+        await asyncio.gather(*(self._run_unfiltered(handler, user, channel_name, event)
+                               for handler in handlers))
+
+    async def _run_unfiltered(self, handler, user, channel_name, event):
+        """Run one unfiltered handler on a message and execute its result"""
+        if handler.requires_ready and not self.is_ready(handler.bot):
+            return
+        kwargs = {'timestamp': event['ts']} if handler.include_timestamp else {}
+        try:
+            with self.stats.timer('handler', handler.name):
+                command = await asyncio.wait_for(
+                    handler.func(user=user, in_channel=channel_name, message=event['text'], **kwargs),
+                    self._config.handler_timeout)
+            await self._exhaust_command(command, event, handler.name)
+        except asyncio.TimeoutError:
+            logger.warning('Handler %s timed out', handler.name)
+        except Exception:
+            logger.exception('Exception in handler %s', handler.name)
+
+    def _build_routes(self):
+        """Work out which unfiltered handlers watch each known channel"""
+        self._routes = {}
+        if self.ids is not None:
+            for cid in self.ids.channel_ids:
+                self._route_channel(cid)
+
+    def _route_channel(self, cid):
+        """Add or refresh the routing table entry for one channel, and return it"""
+        cname = self.ids.cname(cid)
+        self._routes[cid] = [handler for handler in self._handlers.unfiltered
+                             if handler.channels is None or cname in handler.channels]
+        return self._routes[cid]
+
     async def _handle_response(self, event):
         rt = event["reply_to"]
         if rt in self._response_callbacks:
@@ -281,14 +539,18 @@ class Slack:
             await self._exhaust_command(cb(), event)
             del self._response_callbacks[rt]
 
-    async def _exhaust_command(self, command, event):
-        """Run a command, any command that generates and so on until None is returned."""
+    async def _exhaust_command(self, command, event, source=None):
+        """
+        Run a command, any command that generates and so on until None is returned.
+        Execution time is recorded under source, the name of the handler which returned the command.
+        """
         while command:
             if isinstance(command, Command):
-                command = await command.execute(self, event)
+                with self.stats.timer('command', source or type(command).__name__):
+                    command = await command.execute(self, event)
             else:
                 for com in command:
-                    await self._exhaust_command(com, event)
+                    await self._exhaust_command(com, event, source)
                 command = None
 
     async def react(self, emoji, event):
@@ -296,80 +558,127 @@ class Slack:
         channel = event['channel']
         timestamp = event['ts']
         params = {
-            'token': self._config.token,
             'name': emoji,
             'channel': channel,
             'timestamp': timestamp}
-        await make_request(Slack.base_url + 'reactions.add', params)
+        await self.web.post('reactions.add', params)
 
     async def send(self, message, channel, success_callback=None):
-        """Send a message to a channel"""
+        """Queue a message to be sent to a channel"""
+        self.outbox.put(message, channel, success_callback)
+
+    async def _send_now(self, message, channel, success_callback):
         print('[{}] Sending message: {}'.format(channel, message))
-        await self.socket.send(self._make_message(message, channel, success_callback))
+        m_id = self._message_id
+        data = self._make_message(message, channel, success_callback)
+        try:
+            await self.socket.send(data)
+        except Exception:
+            # The outbox retries with a new message id, so this one will never be acknowledged
+            self._response_callbacks.pop(m_id, None)
+            raise
 
     async def get_event(self):
         """Get a JSON event from and convert it to a dict"""
         event = await self.socket.recv()
+        if self._recorder:
+            self._recorder.record_event(event)
         return json.loads(event)
 
+    def _history_channel_name(self, channel):
+        if channel[0] in ('C', 'G'):
+            return self.ids.cname(channel)
+        return 'DM with {}'.format(self.ids.dm_to_id(channel))
+
+    async def _history_pages(self, channel, oldest=None):
+        """
+        Yield lists of messages from a channel's history, newest first.
+        Args:
+            channel: Channel, group or DM ID
+            oldest: If given, only messages newer than this timestamp are fetched
+        """
+        method = ('channels.history' if channel[
+            0] == 'C' else 'groups.history' if channel[0] == 'G' else 'im.history')
+        params = {'channel': channel,
+                  'inclusive': False}
+        if oldest is not None:
+            params['oldest'] = oldest
+        seen_timestamps = set()  # Inclusive flag seems to be ignored
+        has_more = True
+        while has_more:
+            await self._history_limiter.acquire()
+            data = await self.web.get(method, params)
+            if 'has_more' not in data:
+                logger.error('Bad history response for %s: %s', self._history_channel_name(channel), data)
+                return
+            messages = data['messages']
+            has_more = data['has_more'] and bool(messages)
+            page = [message for message in messages
+                    if is_message(message, no_channel=True) and message['ts'] not in seen_timestamps]
+            seen_timestamps.update(message['ts'] for message in page)
+            if messages:
+                params['latest'] = min((message['ts'] for message in messages), key=float)
+            yield page
+
     async def _get_history(self, include_dms=False):
         found_messages = 0
         channels = chain(
             self.ids.channel_ids, self.ids.dm_ids if include_dms else [])
         events = defaultdict(list)
-        for channel in channels:
-            channel_name = (self.ids.cname if channel[0] in ('C', 'G') else
-                            self.ids.dmname)(channel)
-            print('Getting history for channel:', channel_name)
-            url = Slack.base_url +\
-                ('channels.history' if channel[
-                 0] == 'C' else 'groups.history' if channel[0] == 'G' else 'im.history')
-            latest = float('inf')
-            has_more = True
-            params = {'token': self._config.token,
-                      'channel': channel,
-                      'inclusive': False}
-            seen_timestamps = set() # Inclusive flag seems to be ignored
-            while has_more:
-                await asyncio.sleep(1)
-                data = await make_request(
-                    url,
-                    params=params
-                )
-                if 'has_more' not in data:
-                    print('has_more not in data')
-                    print(data)
-                    print(channel)
-                    print(self.ids.cname(channel))
-                    exit()
-                has_more = data['has_more']
-                messages = data['messages']
-                for message in messages:
-                    if is_message(message, no_channel=True) and message['ts'] not in seen_timestamps:
-                        events[channel].append(message)
-                        seen_timestamps.add(message['ts'])
-                        latest = min(float(message['ts']), latest)
-                params['latest'] = latest
-                found_messages += len(messages)
+        for channel in list(channels):
+            print('Getting history for channel:', self._history_channel_name(channel))
+            async for page in self._history_pages(channel):
+                events[channel].extend(page)
+                found_messages += len(page)
                 print('Found {} messages'.format(found_messages))
         return events
 
     async def _load_history(self):
         """Wipe the existing history and load the Slack message archive into the database"""
-        HistoryDoc.objects().delete()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, clear_history)
+        await loop.run_in_executor(None, lambda: HistorySyncDoc.objects().delete())
         print('History Cleared')
-        events = await self._get_history()
-        for channel, messages in events.items():
-            for message in messages:
-                try:
-                    await self.store_message(
-                        channel=channel,
-                        user=message['user'],
-                        text=message['text'],
-                        timestamp=message['ts'])
-                except KeyError:
-                    print([k for k in message])
-                    exit()
+        await self._sync_history()
+
+    async def _sync_history(self):
+        """Load every channel's messages newer than its last sync into the database"""
+        loop = asyncio.get_event_loop()
+        checkpoints = await loop.run_in_executor(
+            None, lambda: {doc.channel: doc.latest for doc in HistorySyncDoc.objects()})
+        limit = asyncio.Semaphore(self._config.history_concurrency)
+
+        async def sync_one(channel):
+            async with limit:
+                await self._sync_channel(channel, checkpoints.get(channel))
+
+        await asyncio.gather(*(sync_one(channel) for channel in list(self.ids.channel_ids)))
+        logger.info('History sync finished')
+
+    async def _sync_channel(self, channel, oldest):
+        loop = asyncio.get_event_loop()
+        bot_id = self.ids.uid(self._config.name)
+        c_name = self.ids.cname(channel)
+        newest = oldest
+        stored = 0
+        async for page in self._history_pages(channel, oldest=oldest):
+            docs = [HistoryDoc(uid=message['user'], channel=c_name, text=message['text'], time=message['ts'])
+                    for message in page if self._should_store(message.get('user'), message['text'], bot_id)]
+            stored += await loop.run_in_executor(None, insert_history, docs)
+            records = [Record(doc.channel, doc.uid, doc.text, doc.time) for doc in docs]
+            # Before they load, both read these from the database, so a backfill needn't be added one page at a time
+            if self.history_cache is not None and (self.history_cache.loaded or self.history_cache.loading):
+                self.history_cache.add_records(records)
+            if self.search_index is not None and (self.search_index.loaded or self.search_index.loading):
+                self.search_index.add_records(records)
+            page_timestamps = [message['ts'] for message in page]
+            if page_timestamps:
+                newest = max(page_timestamps + ([newest] if newest else []), key=float)
+
+        if newest != oldest:
+            await loop.run_in_executor(
+                None, lambda: HistorySyncDoc.objects(channel=channel).update_one(upsert=True, set__latest=newest))
+        logger.info('Stored %d new messages from %s', stored, c_name)
 
     async def _clear_commands(self):
         to_delete = []
@@ -403,35 +712,89 @@ class Slack:
         bot_id = self.ids.uid(self._config.name)
 
         c_name = self.ids.cname(channel)
-        if user != bot_id and text and text[0] != self._config.alert:
-            HistoryDoc(
-                uid=user, channel=c_name, text=text, time=timestamp).save()
+        if self._should_store(user, text, bot_id):
+            # First, as a failed flush raises here after keeping the message to retry
+            if self.history_cache is not None:
+                self.history_cache.add(user, c_name, text, timestamp)
+            if self.search_index is not None:
+                self.search_index.add(user, c_name, text, timestamp)
+            await self._history_buffer.add(HistoryDoc(
+                uid=user, channel=c_name, text=text, time=timestamp))
+
+    async def flush_history(self):
+        """Write any buffered messages to the history DB"""
+        await self._history_buffer.flush()
+
+    async def search(self, text, uid=None, channel=None, after=None, before=None, limit=10):
+        """
+        Find stored messages containing every word in text, with the same filters as HistoryCommand.
+        Returns the number of matches and Records for the newest of them, or None if the index isn't loaded.
+        """
+        if self.search_index is None or not self.search_index.loaded:
+            return None
+        count, timestamps = self.search_index.search(text, uid, channel, after, before, limit)
+        if not timestamps:
+            return count, []
+        # Matches may still be waiting to be written
+        await self.flush_history()
+        loop = asyncio.get_event_loop()
+        return count, await loop.run_in_executor(None, read_messages, timestamps)
+
+    async def random_message(self, uid=None, channel=None):
+        """
+        A random stored message from a user ID and channel name, picked from the history cache in constant time.
+        Returns a tuple of the Record, or None if no message matches, or None while the history cache is loading.
+        Without a history cache, the message is sampled in the database.
+        """
+        loop = asyncio.get_event_loop()
+        if self.history_cache is None:
+            return (await loop.run_in_executor(None, sample_message, history_query(channel=channel, uid=uid)),)
+        if not self.history_cache.loaded:
+            return None
+        record = self.history_cache.sample(uid, channel)
+        if record is not None and record.text is None:
+            found = await loop.run_in_executor(None, read_messages, [record.time])
+            record = found[0] if found else None
+        return (record,)
+
+    async def shutdown(self):
+        """Stop handling events and write out anything still buffered"""
+        await self._dispatcher.stop()
+        await self.flush_history()
+        await self.web.close()
+        if self._recorder:
+            self._recorder.close()
+
+    async def dm_channel(self, user):
+        """Get the DM room ID for a user, opening the room if it isn't known yet"""
+        if not self.ids.has_dm(user):
+            await self.ids.open_dm(self.web, user)
+            self._on_ids_changed()
+        return self.ids.dmid(user)
+
+    def _should_store(self, user, text, bot_id):
+        """Whether a message belongs in the history DB"""
+        return user is not None and user != bot_id and text and text[0] != self._config.alert
 
     async def upload_file(self, f_name, channel, user):
         """Upload a file to the specified channel or DM"""
-        channel = channel if channel else self.ids.dmid(user)
-        with open(f_name, 'rb') as f:
-            requests.post(Slack.base_url + 'files.upload',
-                          params={'token': self._config.token,
-                                  'filetype': f_name.split('.')[-1],
-                                  'channels': channel,
-                                  'filename': self._config.name + ' upload'
-                                  },
-                          files={'file': f}
-                          )
+        channel = channel if channel else await self.dm_channel(user)
+        await self.web.upload('files.upload',
+                              f_name,
+                              params={'filetype': f_name.split('.')[-1],
+                                      'channels': channel,
+                                      'filename': self._config.name + ' upload'})
 
     async def delete_message(self, channel, user, timestamp, admin_key=True):
         """Delete a message"""
-        channel = channel if channel else self.ids.dmid(user)
+        channel = channel if channel else await self.dm_channel(user)
         token = self._config.admin_token if admin_key else self._config.token
-        url = Slack.base_url + 'chat.delete'
-        params = {'token': token,
-                  'ts': str(timestamp),
+        params = {'ts': str(timestamp),
                   'channel': channel,
                   'as_user': True}
-        await make_request(url, params, request_type='POST')
+        await self.web.post('chat.delete', params, token=token)
 
-    def register_handler(self, func, data):
+    def register_handler(self, func, data, bot=None):
         """
         Registers a function with Slack to be called when certain conditions are matched.
         Args:
@@ -445,15 +808,20 @@ class Slack:
                 priority: Handlers are checked in order of descending priority.
                 admin: Whether or not this handler is only accessible to admins
                 include_timestamp: Whether the command receives message timestamps
+                requires_ready: Whether to hold off calling func until bot has warmed up
+            bot: The bot which func belongs to
         """
-        name, expr, channels, doc, priority, admin, include_ts = data
+        name, expr, channels, doc, priority, admin, include_ts, requires_ready = data
         if expr is None:
             uhandler = UnfilteredHandler(name=name,
                                          func=func,
                                          channels=channels,
                                          doc=doc,
-                                         include_timestamp=include_ts)
+                                         include_timestamp=include_ts,
+                                         bot=bot,
+                                         requires_ready=requires_ready)
             self._handlers.unfiltered.append(uhandler)
+            self._build_routes()
         else:
             self._parser.add_command(expr, name, priority)
             handler = Handler(name=name,
@@ -461,7 +829,9 @@ class Slack:
                               channels=channels,
                               doc=doc,
                               admin=admin,
-                              include_timestamp=include_ts)
+                              include_timestamp=include_ts,
+                              bot=bot,
+                              requires_ready=requires_ready)
             self._handlers.filtered[name] = handler
 
     def _make_message(self, text, channel_id, response_callback):
@@ -477,6 +847,42 @@ class Slack:
                            'channel': channel_id,
                            'text': text})
 
+    def stats_report(self):
+        """Lines of text describing handler latencies (in ms), slow events and queue depths"""
+        send_latency = LatencyHistogram()
+        for latency in self.outbox.latencies:
+            send_latency.add(latency)
+        p50, p95, p99 = send_latency.percentiles()
+
+        lines = self.stats.report()
+        lines.append('{:<40} {:>6} {:8.1f} {:8.1f} {:8.1f}'.format(
+            'send (queued to sent)', len(send_latency), 1000 * p50, 1000 * p95, 1000 * p99))
+        lines.append('')
+        lines.append('Slowest recent events:')
+        for seconds, description in self.stats.slowest_events():
+            lines.append('{:8.1f} ms  {}'.format(1000 * seconds, description))
+        lines.append('')
+        lines.append('Queued events: {}'.format(self._dispatcher.depth))
+        lines.append('Queued messages: {} {}'.format(self.outbox.depth, self.outbox.channel_depths()))
+        lines.append('Buffered history: {}'.format(len(self._history_buffer)))
+        if self.history_cache is not None:
+            messages, nbytes, evicted = self.history_cache.stats()
+            lines.append('History cache: {} messages, {:.1f} MB, {} evicted{}'.format(
+                messages, nbytes / 2 ** 20, evicted, '' if self.history_cache.loaded else ' (loading)'))
+        if self.search_index is not None:
+            messages, words, occurrences = self.search_index.stats()
+            lines.append('Search index: {} messages, {} words, {} occurrences{}'.format(
+                messages, words, occurrences, '' if self.search_index.loaded else ' (loading)'))
+        not_ready = ['{} ({})'.format(type(bot).__name__, state)
+                     for bot, state in self._bot_states.items() if state != READY]
+        lines.append('Bots not ready: {}'.format(', '.join(not_ready) if not_ready else 'none'))
+        return lines
+
+    def _not_ready_message(self, handler):
+        if self.bot_state(handler.bot) == FAILED:
+            return '{} is unavailable right now.'.format(handler.name)
+        return '{} is still warming up, try again in a minute.'.format(handler.name)
+
     def _help_message(self, uid):
         """Iterate over all handlers and join their help texts into one message."""
         res = []
@@ -0,0 +1,85 @@
+"""Latency tracking for handlers, commands and the event loop"""
+import asyncio
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import time
+
+
+class LatencyHistogram:
+
+    """Keeps the most recent samples of a latency and reports percentiles over them"""
+
+    def __init__(self, max_samples=1000):
+        self._samples = deque(maxlen=max_samples)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds):
+        """Record one sample"""
+        self._samples.append(seconds)
+
+    def percentiles(self, qs=(50, 95, 99)):
+        """Get the given percentiles (0-100) of the recorded samples"""
+        ordered = sorted(self._samples)
+        if not ordered:
+            return [0 for _ in qs]
+        return [ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))] for q in qs]
+
+
+class Stats:
+
+    """
+    Latency histograms keyed by stage ('parse', 'handler', 'command', ...) and handler name,
+    plus the slowest recent events and measurements of event loop lag.
+    """
+
+    def __init__(self, max_samples=1000, recent_events=500):
+        self._max_samples = max_samples
+        self.histograms = defaultdict(lambda: defaultdict(lambda: LatencyHistogram(self._max_samples)))
+        self.loop_lag = LatencyHistogram(max_samples)
+        self._recent_events = deque(maxlen=recent_events)
+
+    def record(self, stage, name, seconds):
+        """Record a latency sample"""
+        self.histograms[stage][name].add(seconds)
+
+    @contextmanager
+    def timer(self, stage, name):
+        """Context manager which records how long its body takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, name, time.perf_counter() - start)
+
+    def record_event(self, description, seconds):
+        """Record how long an event took to handle from start to finish"""
+        self._recent_events.append((seconds, description))
+
+    def slowest_events(self, n=5):
+        """The n slowest of the recently handled events, as (seconds, description) pairs"""
+        return sorted(self._recent_events, key=lambda event: event[0], reverse=True)[:n]
+
+    async def probe_loop_lag(self, interval=0.5):
+        """Repeatedly measure how late the event loop is in waking up a sleeping task"""
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag.add(max(0, loop.time() - start - interval))
+
+    def report(self, qs=(50, 95, 99)):
+        """Lines of text summarising every histogram"""
+        header = ' '.join('p{}'.format(q).rjust(8) for q in qs)
+        lines = ['{:<40} {:>6} {}'.format('stage/name', 'n', header)]
+
+        def row(label, histogram):
+            values = ' '.join('{:8.1f}'.format(1000 * v) for v in histogram.percentiles(qs))
+            return '{:<40} {:>6} {}'.format(label[:40], len(histogram), values)
+
+        lines.append(row('loop lag', self.loop_lag))
+        for stage in sorted(self.histograms):
+            for name, histogram in sorted(self.histograms[stage].items()):
+                lines.append(row('{}/{}'.format(stage, name), histogram))
+        return lines
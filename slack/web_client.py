@@ -0,0 +1,97 @@
+"""Asynchronous client for the Slack Web API"""
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_params(params):
+    """aiohttp only accepts strings and numbers as query or form values"""
+    encoded = {}
+    for key, val in params.items():
+        if val is None:
+            continue
+        if isinstance(val, bool):
+            val = 'true' if val else 'false'
+        encoded[key] = str(val)
+    return encoded
+
+
+class WebClient:
+
+    """
+    Sends Web API requests over a pool of keep-alive connections.
+    At most max_concurrent requests are in flight at once; the rest wait their turn.
+    """
+
+    def __init__(self, base_url, token, max_connections=16, max_concurrent=8, max_retries=3):
+        """
+        Args:
+            base_url: URL which API method names are appended to
+            token: Token used for requests which don't supply their own
+            max_connections: Size of the connection pool
+            max_concurrent: Maximum number of requests in flight
+            max_retries: How many times to retry a rate limited request
+        """
+        self.base_url = base_url
+        self._token = token
+        self._max_connections = max_connections
+        self._limit = asyncio.Semaphore(max_concurrent)
+        self._max_retries = max_retries
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._max_connections)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        """Close all pooled connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get(self, method, params=None, token=None):
+        """Call an API method with a GET request and return the decoded body"""
+        return await self._call('GET', method, params, token)
+
+    async def post(self, method, params=None, token=None):
+        """Call an API method with a form encoded POST request and return the decoded body"""
+        return await self._call('POST', method, params, token)
+
+    async def upload(self, method, f_name, params=None, token=None, field='file'):
+        """POST a file to an API method as multipart form data"""
+        return await self._call('POST', method, params, token, f_name=f_name, field=field)
+
+    async def _call(self, http_method, method, params, token, f_name=None, field=None):
+        params = _encode_params(dict(params or {}, token=token or self._token))
+        url = self.base_url + method
+        for attempt in range(self._max_retries + 1):
+            async with self._limit:
+                if f_name is None:
+                    kwargs = {'params': params} if http_method == 'GET' else {'data': params}
+                    body, retry_after = await self._send(http_method, url, **kwargs)
+                else:
+                    with open(f_name, 'rb') as f:
+                        form = aiohttp.FormData(params)
+                        form.add_field(field, f, filename=os.path.basename(f_name))
+                        body, retry_after = await self._send(http_method, url, data=form)
+            if retry_after is None or attempt == self._max_retries:
+                break
+            logger.warning('Rate limited on %s, retrying in %d seconds', method, retry_after)
+            await asyncio.sleep(retry_after)
+
+        if body.get('ok') is not True:
+            logger.warning('Bad return from %s: %s', method, body)
+        return body
+
+    async def _send(self, http_method, url, **kwargs):
+        """Returns the decoded body and, if the request was rate limited, the number of seconds to wait."""
+        async with self._get_session().request(http_method, url, **kwargs) as response:
+            if response.status == 429:
+                return {'ok': False, 'error': 'ratelimited'}, int(response.headers.get('Retry-After', 1))
+            return await response.json(content_type=None), None
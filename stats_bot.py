@@ -0,0 +1,20 @@
+from cpu_pool import cpu_pool
+from pyparsing import CaselessLiteral, StringEnd
+from slack.bot import SlackBot, register
+from slack.command import MessageCommand
+
+
+class StatsBot(SlackBot):
+    def __init__(self, slack=None):
+        self.slack = slack
+
+        self.name = 'Bot Stats'
+        self.expr = CaselessLiteral('stats') + StringEnd()
+        self.doc = ('Show latency percentiles per handler and process pool job, the slowest recent events and '
+                    'queue depths:\n'
+                    '\tstats')
+
+    @register(name='name', expr='expr', doc='doc', admin=True)
+    async def command_stats(self, user, in_channel, parsed):
+        lines = self.slack.stats_report() + [''] + cpu_pool.report()
+        return MessageCommand(user=user, text='```\n{}\n```'.format('\n'.join(lines)))
@@ -0,0 +1,38 @@
+"""Tests for indexing command grammars by their leading keywords"""
+import unittest
+
+from pyparsing import CaselessLiteral, FollowedBy, Literal, SkipTo, StringEnd, Word, alphas
+
+from slack.parsing.slack_parser import leading_keywords, SlackParser
+
+
+class LeadingKeywordsTest(unittest.TestCase):
+
+    def test_literal(self):
+        self.assertEqual(leading_keywords(CaselessLiteral('Quote') + StringEnd()), {'quote'})
+
+    def test_not_any_is_unindexed(self):
+        self.assertIsNone(leading_keywords(~Literal('x') + Word(alphas)))
+
+    def test_followed_by_is_unindexed(self):
+        self.assertIsNone(leading_keywords(FollowedBy(Literal('x')) + Word(alphas)))
+
+    def test_skip_to_is_unindexed(self):
+        self.assertIsNone(leading_keywords(SkipTo(Literal('x')) + Literal('x')))
+
+
+class SlackParserTest(unittest.TestCase):
+
+    def test_not_any_command_still_parses(self):
+        parser = SlackParser('!')
+        parser.add_command(~Literal('x') + Word(alphas).setResultsName('word') + StringEnd(), 'not_x')
+        self.assertEqual(parser.parse('!hello')['not_x']['word'], 'hello')
+
+    def test_skip_to_command_still_parses(self):
+        parser = SlackParser('!')
+        parser.add_command(SkipTo(Literal('x')).setResultsName('before') + Literal('x') + StringEnd(), 'to_x')
+        self.assertEqual(parser.parse('!abc x')['to_x']['before'].strip(), 'abc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,19 @@
+from functools import partial
+
 from pyparsing import alphanums, CaselessLiteral, Optional, StringEnd, Word
 from slack.bot import SlackBot, register
 from slack.command import MessageCommand
-from twitchlogger.markov import MarkovTwitchEmulator
+from util import Lazy
+
+
+def _make_emulator(twitch_db_alias, min_length):
+    from twitchlogger.markov import MarkovTwitchEmulator
+    return MarkovTwitchEmulator(twitch_db_alias, min_length=min_length)
 
 
 class TwitchBot(SlackBot):
     def __init__(self, twitch_db_alias, min_length=1, slack=None):
-        self.markov = MarkovTwitchEmulator(twitch_db_alias, min_length=min_length)
+        self.markov = Lazy(partial(_make_emulator, twitch_db_alias, min_length), name='MarkovTwitchEmulator')
 
         self.twitch_name = 'Twitch Chat'
         self.twitch_expr = (CaselessLiteral('twitch') + Optional(Word(alphanums + '_-').setResultsName('twitch_channel'))) + StringEnd()
@@ -19,12 +26,13 @@ class TwitchBot(SlackBot):
         if twitch_channel and not twitch_channel.startswith('#'):
             twitch_channel = '#' + twitch_channel
 
-        if twitch_channel not in self.markov.probabilities:
+        markov = await self.markov.get_async()
+        if twitch_channel not in markov.probabilities:
             out_text = "Channel {} not recognized. If you would like this channel added, ask a bot admin.".format(twitch_channel)
             out_channel = None
         else:
             out_channel = in_channel
-            out_text = self.markov.generate_message(twitch_channel)
+            out_text = markov.generate_message(twitch_channel)
 
         if out_channel is None:
             return MessageCommand(text=out_text, user=user)
@@ -1,9 +1,31 @@
-import db
+import argparse
+
+import db  # pylint: disable=unused-import
 from economy.econ_db import AccountDoc
+from migration import add_arguments, Migration, run_migration
+from pymongo import UpdateOne
+
+FIELDS = ('secondary_currency', 'level')
+
+
+class AddAccountFields(Migration):
+
+    """Set fields added to AccountDoc to 0 in accounts which don't have them"""
+
+    name = 'add_account_fields'
+    # Matches missing fields as well as nulls
+    query = {'$or': [{field: None} for field in FIELDS]}
+    projection = list(FIELDS)
+
+    def __init__(self):
+        self.collection = AccountDoc._get_collection()
+
+    def change(self, doc):
+        return UpdateOne({'_id': doc['_id']}, {'$set': {field: 0 for field in FIELDS if doc.get(field) is None}})
+
 
 if __name__ == '__main__':
-    for obj in AccountDoc.objects:
-        for field in ('secondary_currency', 'level'):
-            if getattr(obj, field) is None:
-                print('Adding field: {} to {}'.format(field, obj.user))
-                obj.update(**{field: 0})
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    run_migration(AddAccountFields(), args.batch_size, args.restart)
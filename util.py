@@ -6,6 +6,8 @@ import re
 import requests
 import tempfile
 import shutil
+import threading
+import time
 import traceback
 
 
@@ -44,6 +46,47 @@ def dict_merge(it):
     return dict(chain(*map(dict.items, it)))
 
 
+class Lazy:
+    """
+    A value which is built by calling factory the first time it is needed.
+    Bots use this for models, corpora and API clients which are slow to load.
+    """
+    def __init__(self, factory, name=None):
+        self._factory = factory
+        self.name = name or getattr(factory, '__qualname__', repr(factory))
+        self._loaded = False
+        self._value = None
+        self._lock = threading.Lock()
+        self.load_time = None
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        """Return the value, building it first if necessary"""
+        # Values may be first needed from executor threads
+        with self._lock:
+            if not self._loaded:
+                start = time.perf_counter()
+                self._value = self._factory()
+                self.load_time = time.perf_counter() - start
+                self._loaded = True
+        return self._value
+
+    async def get_async(self):
+        """Return the value, building it in an executor if necessary so the event loop isn't blocked"""
+        if self._loaded:
+            return self._value
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.get)
+
+
+def lazy_attributes(obj):
+    """All Lazy instances stored as attributes of obj"""
+    return [val for val in vars(obj).values() if isinstance(val, Lazy)]
+
+
 def kill_all_tasks():
     for task in asyncio.Task.all_tasks():
         task.cancel()
@@ -65,8 +108,9 @@ _request_funcs = {'GET': requests.get, 'POST': requests.post}
 
 async def make_request(url, params, request_type='GET'):
     loop = asyncio.get_event_loop()
-    get = partial(requests.get, params=params)
-    res = (await loop.run_in_executor(None, get, url)).json()
+    param_key = 'params' if request_type == 'GET' else 'data'
+    send = partial(_request_funcs[request_type], **{param_key: params})
+    res = (await loop.run_in_executor(None, send, url)).json()
     if res['ok'] is not True:
         print('Bad return:', res)
     return res
@@ -1,3 +1,5 @@
+from collections import Counter, defaultdict
+from cpu_pool import cpu_pool
 from functools import partial
 import numpy as np
 import os
@@ -9,10 +11,14 @@ import shutil
 from slack.bot import register, SlackBot
 from slack.command import HistoryCommand, MessageCommand, UploadCommand
 from slack.parsing import symbols
-from wordcloud import WordCloud, STOPWORDS, ImageColorGenerator
 import tempfile
 from util import get_image, mention_to_uid
 
+# Leslie's regex for cleaning mentions, emoji and uploads
+MARKUP = re.compile('<[^>]*>|:[^\s:]*:|uploaded a file:')
+# The words WordCloud itself would pick out
+WORD = re.compile(r"\w[\w']+")
+
 class WordcloudBot(SlackBot):
     def __init__(self, slack):
         self.name = 'Display a wordcloud'
@@ -43,48 +49,67 @@ class WordcloudBot(SlackBot):
                                      user,
                                      in_channel,
                                      parsed['image'][1:-1] if 'image' in parsed else None)
-        return HistoryCommand(**kwargs)
+        return HistoryCommand(fields=('text',), stream=True, **kwargs)
 
-    async def _history_handler(self, user, in_channel, image_url, hist_list):
-        if not hist_list:
+    async def _history_handler(self, user, in_channel, image_url, hist_stream):
+        # Counted as the history streams in, so the messages are never all held at once
+        frequencies = Counter()
+        async for rec in hist_stream:
+            if rec.text is not None:
+                frequencies.update(WORD.findall(MARKUP.sub('', rec.text)))
+        if not frequencies:
             return
         try:
             image_file = await get_image(image_url) if image_url else None
         except ValueError:
             return MessageCommand(channel=None, user=user, text='Image {} not found.'.format(image_url))
 
-        text = (rec.text for rec in hist_list)
-        # Leslie's regex for cleaning mentions, emoji and uploads
-        text = (re.sub('<[^>]*>|:[^\s:]*:|uploaded a file:', '', t) for t in text)
-
         try:
-            out_file = await WordcloudBot.make_wordcloud(' '.join(text), image_file)
+            out_file = await WordcloudBot.make_wordcloud(frequencies, image_file)
         except NotImplementedError as e:
             return MessageCommand(channel=None, user=user, text="Apparently can't handle that image: {}".format(e.message()))
         return UploadCommand(channel=in_channel, user=user, file_name=out_file, delete=True)
 
     @staticmethod
-    async def make_wordcloud(text, image_file=None):
-        kwargs = {}
-        if image_file:
-            ttd_coloring = np.array(Image.open(image_file))
-            kwargs['mask'] = ttd_coloring
-            kwargs['color_func'] = ImageColorGenerator(ttd_coloring)
-
-        # TODO: Turn some of the options into flags
-        wc = WordCloud(background_color='white',
-                       max_words=2000,
-                       stopwords=STOPWORDS,
-                       max_font_size=40,
-                       random_state=42,
-                       **kwargs)
-
-        wc.generate(text)
-        # TODO: Replace this with a tempfile
-        name = next(tempfile._get_candidate_names()) + '.png'
-        wc.to_file(name)
-
-        if image_file:
-            os.remove(image_file)
-        return name
+    async def make_wordcloud(frequencies, image_file=None):
+        return await cpu_pool.run('wordcloud', render_wordcloud, frequencies, image_file)
+
+
+def _merge_words(frequencies, stopwords):
+    """Drop stopwords and trailing 's, and merge case variants under the most common one, as WordCloud does"""
+    variants = defaultdict(Counter)
+    for word, count in frequencies.items():
+        if word.lower().endswith("'s"):
+            word = word[:-2]
+        if word.lower() not in stopwords:
+            variants[word.lower()][word] += count
+    return {forms.most_common(1)[0][0]: sum(forms.values()) for forms in variants.values()}
+
+
+def render_wordcloud(frequencies, image_file=None):
+    """Draw a wordcloud of word counts to a new png file and return its name. Runs in the process pool."""
+    # wordcloud is slow to import, so wait until it's needed
+    from wordcloud import WordCloud, STOPWORDS, ImageColorGenerator
+    kwargs = {}
+    if image_file:
+        ttd_coloring = np.array(Image.open(image_file))
+        kwargs['mask'] = ttd_coloring
+        kwargs['color_func'] = ImageColorGenerator(ttd_coloring)
+
+    # TODO: Turn some of the options into flags
+    wc = WordCloud(background_color='white',
+                   max_words=2000,
+                   stopwords=STOPWORDS,
+                   max_font_size=40,
+                   random_state=42,
+                   **kwargs)
+
+    wc.generate_from_frequencies(_merge_words(frequencies, {word.lower() for word in STOPWORDS}))
+    # TODO: Replace this with a tempfile
+    name = next(tempfile._get_candidate_names()) + '.png'
+    wc.to_file(name)
+
+    if image_file:
+        os.remove(image_file)
+    return name
 